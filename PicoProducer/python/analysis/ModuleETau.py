@@ -9,6 +9,7 @@ from TauFW.PicoProducer import datadir
 from TauFW.PicoProducer.analysis.TreeProducerETau import *
 from TauFW.PicoProducer.analysis.ModuleTauPair import *
 from TauFW.PicoProducer.analysis.utils import LeptonTauPair, loosestIso, idIso
+from TauFW.PicoProducer.analysis.columnar import ChunkEvent, getpairs, bestpairs, deltaR
 from TauFW.PicoProducer.corrections.ElectronSFs import *
 from TauFW.PicoProducer.corrections.TrigObjMatcher import loadTriggerDataFromJSON, TrigObjMatcher
 from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool
@@ -30,6 +31,12 @@ class ModuleETau(ModuleTauPair):
     self.eleCutEta = 2.3
     self.tauCutEta = 2.3
     
+    # PRE-SELECTION (see ModuleTauPair.setpreselection)
+    self.preselection = {
+      'triggers': self.trigger.triggers,
+      'objects':  [('Electron',self.eleCutPt,self.eleCutEta)], # no tau: the 'electron' bin is filled before
+    }
+    
     # CORRECTIONS
     if self.ismc:
       self.eleSFs  = ElectronSFs(year=self.year)
@@ -58,6 +65,17 @@ class ModuleETau(ModuleTauPair):
     pass
     
   
+  def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    """Before processing a new file."""
+    super(ModuleETau,self).beginFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+    self.trigger.setup(inputTree)
+    
+  
+  def getbranches(self):
+    """Return list of glob patterns of the nanoAOD branches used in the columnar mode."""
+    return super(ModuleETau,self).getbranches() + [ 'HLT_Ele*', 'nTrigObj', 'TrigObj_*' ]
+    
+  
   def analyze(self, event):
     """Process and pre-select events; fill branches and return True if the events passes,
     return False otherwise."""
@@ -65,26 +83,15 @@ class ModuleETau(ModuleTauPair):
     
     
     ##### NO CUT #####################################
-    self.out.cutflow.fill('none')
-    if self.isdata:
-      self.out.cutflow.fill('weight',1.)
-      if event.PV_npvs>0:
-        self.out.cutflow.fill('weight_no0PU',1.)
-      else:
-        return False
-    else:
-      self.out.cutflow.fill('weight',event.genWeight)
-      self.out.pileup.Fill(event.Pileup_nTrueInt)
-      if event.Pileup_nTrueInt>0:
-        self.out.cutflow.fill('weight_no0PU',event.genWeight)
-      else:
-        return False
+    if not self.presel and not self.countevent(event): # if pre-selected, filled in bulk (see beginFile)
+      return False
     
     
     ##### TRIGGER ####################################
     if not self.trigger.fired(event):
       return False
-    self.out.cutflow.fill('trig')
+    if not self.presel:
+      self.out.cutflow.fill('trig')
     
     
     ##### MUON #######################################
@@ -100,8 +107,10 @@ class ModuleETau(ModuleTauPair):
       if not electron.convVeto: continue
       if electron.lostHits>1: continue
       if not (electron.mvaFall17V2Iso_WP90 or electron.mvaFall17V2noIso_WP90): continue
-      if not self.trigger.match(event,electron): continue
       electrons.append(electron)
+    if electrons: # match all candidates to trigger objects at once
+      matches   = self.trigger.matchindices(event,[electrons])[0]
+      electrons = [e for e, i in zip(electrons,matches) if i>=0]
     if len(electrons)==0:
       return False
     self.out.cutflow.fill('electron')
@@ -155,12 +164,69 @@ class ModuleETau(ModuleTauPair):
     tau.tlv       = tau.p4()
     self.out.cutflow.fill('pair')
     
+    self.fillPairBranches(event,electron,tau)
+    self.out.fill()
+    return True
+    
+  
+  def analyzechunk(self, arrays):
+    """Process and pre-select a chunk of events in columnar mode with the same selections as
+    analyze, using array operations; fill branches for the selected events and return their number."""
+    
+    
+    ##### NO CUT #####################################
+    mask = self.countchunk(arrays)
+    
+    
+    ##### TRIGGER ####################################
+    mask &= self.trigger.fired.chunk(arrays)
+    self.out.cutflow.fillbulk('trig',mask.sum())
+    
+    
+    ##### ELECTRON ###################################
+    electrons = arrays.Electron_pt
+    elemask   = mask[electrons.parents] &\
+      (electrons.content>=self.eleCutPt) & (abs(arrays.Electron_eta.content)<=self.eleCutEta) &\
+      (abs(arrays.Electron_dz.content)<=0.2) & (abs(arrays.Electron_dxy.content)<=0.045) &\
+      (arrays.Electron_convVeto.content!=0) & (arrays.Electron_lostHits.content<=1) &\
+      (arrays.Electron_mvaFall17V2Iso_WP90.content | arrays.Electron_mvaFall17V2noIso_WP90.content)
+    for ievt in np.flatnonzero(electrons.count(elemask)): # trigger matching per event with candidates
+      event   = ChunkEvent(arrays,ievt)
+      icands  = np.flatnonzero(elemask[electrons.starts[ievt]:electrons.starts[ievt]+electrons.counts[ievt]])
+      matches = self.trigger.matchindices(event,[[event.getobject('Electron',i) for i in icands.tolist()]])[0]
+      elemask[electrons.starts[ievt]+icands[matches<0]] = False
+    mask &= electrons.count(elemask)>0
+    self.out.cutflow.fillbulk('electron',mask.sum())
+    
+    
+    ##### TAU ########################################
+    taus, taumask, taupt, taumass = self.selecttauchunk(arrays,mask)
+    mask &= taus.count(taumask)>0
+    self.out.cutflow.fillbulk('tau',mask.sum())
+    
+    
+    ##### ETAU PAIR ##################################
+    evts, ielectrons, itaus = getpairs(electrons,elemask,taus,taumask)
+    dR      = deltaR(arrays.Tau_eta.content[itaus],arrays.Tau_phi.content[itaus],
+                     arrays.Electron_eta.content[ielectrons],arrays.Electron_phi.content[ielectrons])
+    passed  = dR>=0.5
+    evts, ielectrons, itaus = evts[passed], ielectrons[passed], itaus[passed]
+    best    = bestpairs(evts,electrons.content[ielectrons],taupt[itaus],-arrays.Electron_pfRelIso03_all.content[ielectrons],
+                        arrays.Tau_rawDeepTau2017v2p1VSjet.content[itaus])
+    self.out.cutflow.fillbulk('pair',len(best))
+    
+    self.fillchunk(arrays,evts[best],ielectrons[best],itaus[best],'Electron',taupt,taumass)
+    return len(best)
+    
+  
+  def fillPairBranches(self, event, electron, tau):
+    """Fill branches for the selected etau pair."""
+    
     
     # VETOS
-    extramuon_veto, extraelec_veto, dilepton_veto = getLeptonVetoes(event,[electron],[ ],[tau],self.channel)
-    self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0] = getLeptonVetoes(event,[electron],[ ],[ ],self.channel)
-    self.out.lepton_vetoes[0]       = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
-    self.out.lepton_vetoes_notau[0] = extramuon_veto or extraelec_veto or dilepton_veto
+    vetoes_notau, vetoes = getLeptonVetoSets(event,[electron],[ ],[[tau],[ ]],self.channel) # with & without tau overlap removal
+    self.out.setrow(('extramuon_veto','extraelec_veto','dilepton_veto','lepton_vetoes','lepton_vetoes_notau'),
+                    vetoes+(any(vetoes),any(vetoes_notau)))
     
     
     # EVENT
@@ -290,7 +356,3 @@ class ModuleETau(ModuleTauPair):
     # MET & DILEPTON VARIABLES
     self.fillMETAndDiLeptonBranches(event,electron.tlv,tau.tlv,met,met_vars)
     
-    
-    self.out.fill()
-    return True
-    
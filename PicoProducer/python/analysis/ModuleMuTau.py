@@ -8,8 +8,9 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from TauFW.PicoProducer.analysis.TreeProducerMuTau import *
 from TauFW.PicoProducer.analysis.ModuleTauPair import *
 from TauFW.PicoProducer.analysis.utils import LeptonTauPair, loosestIso, idIso
+from TauFW.PicoProducer.analysis.columnar import getpairs, bestpairs, deltaR
 from TauFW.PicoProducer.corrections.MuonSFs import *
-#from TauFW.PicoProducer.corrections.TrigObjMatcher import loadTriggerDataFromJSON, TrigObjMatcher
+from TauFW.PicoProducer.corrections.TrigObjMatcher import TriggerDecision
 from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool, TauESTool
 
 
@@ -20,22 +21,28 @@ class ModuleMuTau(ModuleTauPair):
     super(ModuleMuTau,self).__init__(fname,**kwargs)
     self.out = TreeProducerMuTau(fname,self)
     
-    # TRIGGERS
+    # TRIGGERS (use np.where in cuts to evaluate per event, or for chunk of events)
     if self.year==2016:
-      self.trigger    = lambda e: e.HLT_IsoMu22 or e.HLT_IsoMu22_eta2p1 or e.HLT_IsoTkMu22 or e.HLT_IsoTkMu22_eta2p1 #or e.HLT_IsoMu19_eta2p1_LooseIsoPFTau20_SingleL1
+      self.trigger    = TriggerDecision(['HLT_IsoMu22','HLT_IsoMu22_eta2p1','HLT_IsoTkMu22','HLT_IsoTkMu22_eta2p1']) #,'HLT_IsoMu19_eta2p1_LooseIsoPFTau20_SingleL1'
       self.muonCutPt  = lambda e: 23
-      self.muonCutEta = lambda e: 2.4 if e.HLT_IsoMu22 or e.HLT_IsoTkMu22 else 2.1
+      self.muonCutEta = lambda e: np.where(e.HLT_IsoMu22 | e.HLT_IsoTkMu22,2.4,2.1)
     elif self.year==2017:
-      self.trigger    = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
-      self.muonCutPt  = lambda e: 25 if e.HLT_IsoMu24 else 28
+      self.trigger    = TriggerDecision(['HLT_IsoMu24','HLT_IsoMu27']) #,'HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1'
+      self.muonCutPt  = lambda e: np.where(e.HLT_IsoMu24,25,28)
       self.muonCutEta = lambda e: 2.4
     else:
-      self.trigger    = lambda e: e.HLT_IsoMu24 or e.HLT_IsoMu27 #or e.HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1
+      self.trigger    = TriggerDecision(['HLT_IsoMu24','HLT_IsoMu27']) #,'HLT_IsoMu20_eta2p1_LooseChargedIsoPFTau27_eta2p1_CrossL1'
       self.muonCutPt  = lambda e: 25
       self.muonCutEta = lambda e: 2.4
     self.tauCutPt     = 20
     self.tauCutEta    = 2.3
     
+    # PRE-SELECTION (see ModuleTauPair.setpreselection)
+    self.preselection = {
+      'triggers': self.trigger.paths,
+      'objects':  [('Muon',23 if self.year==2016 else 25,2.4)], # no tau: the 'muon' bin is filled before
+    }
+    
     # CORRECTIONS
     if self.ismc:
       self.muSFs   = MuonSFs(year=self.year)
@@ -64,6 +71,17 @@ class ModuleMuTau(ModuleTauPair):
     pass
     
   
+  def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+    """Before processing a new file."""
+    super(ModuleMuTau,self).beginFile(inputFile,outputFile,inputTree,wrappedOutputTree)
+    self.trigger.setup(inputTree)
+    
+  
+  def getbranches(self):
+    """Return list of glob patterns of the nanoAOD branches used in the columnar mode."""
+    return super(ModuleMuTau,self).getbranches() + [ 'HLT_IsoMu*', 'HLT_IsoTkMu*' ]
+    
+  
   def analyze(self, event):
     """Process and pre-select events; fill branches and return True if the events passes,
     return False otherwise."""
@@ -71,26 +89,15 @@ class ModuleMuTau(ModuleTauPair):
     
     
     ##### NO CUT #####################################
-    self.out.cutflow.fill('none')
-    if self.isdata:
-      self.out.cutflow.fill('weight',1.)
-      if event.PV_npvs>0:
-        self.out.cutflow.fill('weight_no0PU',1.)
-      else:
-        return False
-    else:
-      self.out.cutflow.fill('weight',event.genWeight)
-      self.out.pileup.Fill(event.Pileup_nTrueInt)
-      if event.Pileup_nTrueInt>0:
-        self.out.cutflow.fill('weight_no0PU',event.genWeight)
-      else:
-        return False
+    if not self.presel and not self.countevent(event): # if pre-selected, filled in bulk (see beginFile)
+      return False
     
     
     ##### TRIGGER ####################################
     if not self.trigger(event):
       return False
-    self.out.cutflow.fill('trig')
+    if not self.presel:
+      self.out.cutflow.fill('trig')
     
     
     ##### MUON #######################################
@@ -155,12 +162,65 @@ class ModuleMuTau(ModuleTauPair):
     tau.tlv   = tau.p4()
     self.out.cutflow.fill('pair')
     
+    self.fillPairBranches(event,muon,tau)
+    self.out.fill()
+    return True
+    
+  
+  def analyzechunk(self, arrays):
+    """Process and pre-select a chunk of events in columnar mode with the same selections as
+    analyze, using array operations; fill branches for the selected events and return their number."""
+    
+    
+    ##### NO CUT #####################################
+    mask = self.countchunk(arrays)
+    
+    
+    ##### TRIGGER ####################################
+    mask &= self.trigger.chunk(arrays)
+    self.out.cutflow.fillbulk('trig',mask.sum())
+    
+    
+    ##### MUON #######################################
+    muons    = arrays.Muon_pt
+    muonpt   = muons.content
+    muonmask = mask[muons.parents] &\
+      (muonpt>=muons.broadcast(self.muonCutPt(arrays))) &\
+      (abs(arrays.Muon_eta.content)<=muons.broadcast(self.muonCutEta(arrays))) &\
+      (abs(arrays.Muon_dz.content)<=0.2) & (abs(arrays.Muon_dxy.content)<=0.045) &\
+      arrays.Muon_mediumId.content & (arrays.Muon_pfRelIso04_all.content<=0.50)
+    mask &= muons.count(muonmask)>0
+    self.out.cutflow.fillbulk('muon',mask.sum())
+    
+    
+    ##### TAU ########################################
+    taus, taumask, taupt, taumass = self.selecttauchunk(arrays,mask)
+    mask &= taus.count(taumask)>0
+    self.out.cutflow.fillbulk('tau',mask.sum())
+    
+    
+    ##### MUTAU PAIR #################################
+    evts, imuons, itaus = getpairs(muons,muonmask,taus,taumask)
+    dR      = deltaR(arrays.Tau_eta.content[itaus],arrays.Tau_phi.content[itaus],
+                     arrays.Muon_eta.content[imuons],arrays.Muon_phi.content[imuons])
+    passed  = dR>=0.5
+    evts, imuons, itaus = evts[passed], imuons[passed], itaus[passed]
+    best    = bestpairs(evts,muonpt[imuons],taupt[itaus],-arrays.Muon_pfRelIso04_all.content[imuons],
+                        arrays.Tau_rawDeepTau2017v2p1VSjet.content[itaus])
+    self.out.cutflow.fillbulk('pair',len(best))
+    
+    self.fillchunk(arrays,evts[best],imuons[best],itaus[best],'Muon',taupt,taumass)
+    return len(best)
+    
+  
+  def fillPairBranches(self, event, muon, tau):
+    """Fill branches for the selected mutau pair."""
+    
     
     # VETOS
-    extramuon_veto, extraelec_veto, dilepton_veto = getLeptonVetoes(event,[ ],[muon],[tau],self.channel)
-    self.out.extramuon_veto[0], self.out.extraelec_veto[0], self.out.dilepton_veto[0] = getLeptonVetoes(event,[ ],[muon],[ ],self.channel)
-    self.out.lepton_vetoes[0]       = self.out.extramuon_veto[0] or self.out.extraelec_veto[0] or self.out.dilepton_veto[0]
-    self.out.lepton_vetoes_notau[0] = extramuon_veto or extraelec_veto or dilepton_veto
+    vetoes_notau, vetoes = getLeptonVetoSets(event,[ ],[muon],[[tau],[ ]],self.channel) # with & without tau overlap removal
+    self.out.setrow(('extramuon_veto','extraelec_veto','dilepton_veto','lepton_vetoes','lepton_vetoes_notau'),
+                    vetoes+(any(vetoes),any(vetoes_notau)))
     
     
     # EVENT
@@ -294,7 +354,3 @@ class ModuleMuTau(ModuleTauPair):
     # MET & DILEPTON VARIABLES
     self.fillMETAndDiLeptonBranches(event,muon.tlv,tau.tlv,met,met_vars)
     
-    
-    self.out.fill()
-    return True
-    
@@ -2,16 +2,19 @@
 # Description: Base class for tau pair analysis
 from ROOT import TFile, TTree
 import sys, re
+import numpy as np
 from math import sqrt, exp, cos
 from ROOT import TLorentzVector, TVector3
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Event
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object, Event
 from TauFW.PicoProducer.corrections.PileupTool import *
 from TauFW.PicoProducer.corrections.RecoilCorrectionTool import *
 #from TauFW.PicoProducer.corrections.PreFireTool import *
 from TauFW.PicoProducer.corrections.BTagTool import BTagWeightTool, BTagWPs
+from TauFW.PicoProducer.corrections.CorrectionBundle import openbundle, closebundle
 from TauFW.common.tools.log import header
-from TauFW.PicoProducer.analysis.utils import ensurebranches, deltaPhi, getmet, getmetfilters, correctmet, getLeptonVetoes
+from TauFW.PicoProducer.analysis.utils import ensurebranches, deltaPhi, getmet, getmetfilters, correctmet, getLeptonVetoes, getLeptonVetoSets, counttree, LOG
+from TauFW.PicoProducer.analysis.columnar import ChunkEvent, getarray, deltaR
 __metaclass__ = type # to use super() with subclasses from CommonProducer
 tauSFVersion  = { 2016: '2016Legacy', 2017: '2017ReReco', 2018: '2018ReReco' }
 
@@ -41,6 +44,8 @@ class ModuleTauPair(Module):
     self.dotight    = kwargs.get('tight',   self.tes not in [1,None] or self.tessys!=None or self.ltf!=1 or self.jtf!=1) # save memory
     self.dojec      = kwargs.get('jec',     True          ) and self.ismc #and self.year==2016 #False
     self.dojecsys   = kwargs.get('jecsys',  self.dojec    ) and not self.dotight and self.ismc #and self.dojec #and False
+    self.dolazy     = kwargs.get('lazy',    True          ) # only read branches listed in getbranches (see picojob.py)
+    self.dobundle   = kwargs.get('bundle',  True          ) # load correction histograms from cached bundle; 'write' to update it
     self.jetCutPt   = 30
     self.bjetCutEta = 2.7
     
@@ -52,6 +57,8 @@ class ModuleTauPair(Module):
     self.filter     = getmetfilters(self.year,self.isdata)
     
     # CORRECTIONS
+    if self.dobundle:
+      openbundle(self.year,readonly=(self.dobundle!='write')) # used by correction tools until beginJob (see CorrectionBundle)
     self.ptnom            = lambda j: j.pt # use 'pt' as nominal jet pt (not corrected)
     self.jecUncLabels     = [ ]
     self.metUncLabels     = [ ]
@@ -66,16 +73,25 @@ class ModuleTauPair(Module):
     #    self.prefireTool  = PreFireTool(self.year)
       if self.dojec:
         self.ptnom = lambda j: j.pt_nom # use 'pt_nom' as nominal jet pt
-    #  if self.dojecsys:
-    #    self.jecUncLabels = [ u+v for u in ['jer','jesTotal'] for v in ['Down','Up']]
+      if self.dojecsys:
+        self.jecUncLabels = [ u+v for u in ['jer','jesTotal'] for v in ['Down','Up']]
+        self.jecbranches  = tuple(b+'_'+u for u in self.jecUncLabels for b in ['njets','nbtag','jpt_1','jpt_2'])
     #    self.metUncLabels = [ u+v for u in ['jer','jesTotal','unclustEn'] for v in ['Down','Up']]
     #    self.met_vars     = { u: getMET(self.year,u) for u in self.metUncLabels }
     
     self.deepcsv_wp       = BTagWPs('DeepCSV',year=self.year)
     
+    # PRE-SELECTION
+    self.preselection     = { } # declarative pre-selection, defined by channel modules (see setpreselection)
+    self.presel           = None # cut string applied before analyze, if set
+    self.maxevts          = None # maximum number of events per file, for counting the pre-selection
+    self.firstevt         = 0    # first entry per file, for counting the pre-selection
+    self.chunkjets        = None # jet indices per selected event of a chunk in columnar mode (see fillchunk)
+    
   
   def beginJob(self):
     """Before processing any events or files."""
+    closebundle() # save correction bundle if rebuilt by the tools of this module, and not read-only
     print '-'*80
     print ">>> %-12s = %r"%('filename',  self.filename)
     print ">>> %-12s = %s"%('year',      self.year)
@@ -111,6 +127,21 @@ class ModuleTauPair(Module):
   def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
     """Before processing a new file."""
     sys.stdout.flush()
+    ensurebranches(inputTree,self.getbranchaliases())
+    if self.jecUncLabels: # check JEC variations, which may be missing in skimmed nanoAOD
+      branches = [b.GetName() for b in inputTree.GetListOfBranches()]
+      missing  = ['Jet_pt_'+u for u in self.jecUncLabels if 'Jet_pt_'+u not in branches]
+      if missing:
+        LOG.warning("ModuleTauPair.beginFile: Input tree does not have JEC variations %s! Disabling jecsys..."%(', '.join(missing)))
+        self.dojecsys     = False
+        self.jecUncLabels = [ ]
+    if self.presel:
+      self.countpreselection(inputTree)
+    
+  
+  def getbranchaliases(self):
+    """Return list of branches that may be missing in some nanoAOD versions,
+    with the branch they should be redirected to, or their default value."""
     branches = [
       ('Electron_mvaFall17V2Iso',        'Electron_mvaFall17Iso'        ),
       ('Electron_mvaFall17V2Iso_WPL',    'Electron_mvaFall17Iso_WPL'    ),
@@ -126,152 +157,284 @@ class ModuleTauPair(Module):
         ('HLT_IsoMu22_eta2p1',   False ),
         ('HLT_IsoTkMu22_eta2p1', False ),
       ]
-    ensurebranches(inputTree,branches)
+    return branches
+    
+  
+  def getbranches(self):
+    """Return list of glob patterns of the nanoAOD branches used by this module:
+    only these are read in the columnar mode (see analysis/columnar.py),
+    or kept via the PostProcessor's branchsel (see writebranchsel), so all others are not decompressed."""
+    branches = [
+      'run', 'luminosityBlock', 'event', 'PV_npvs*', 'Flag_*', 'fixedGridRhoFastjetAll',
+      'MET_*', 'METFixEE2017_*', 'PuppiMET_*',
+      'nMuon', 'Muon_*', 'nElectron', 'Electron_*', 'nTau', 'Tau_*', 'nJet', 'Jet_*',
+    ]
+    if self.ismc:
+      branches += [
+        'genWeight', 'Pileup_*', 'GenMET_*', 'LHE_Njets',
+        'nGenPart', 'GenPart_*', 'nGenVisTau', 'GenVisTau_*', 'nGenJet', 'GenJet_*',
+      ]
+    elif self.isembed:
+      branches += [ 'genWeight' ]
+    return branches
+    
+  
+  def setpreselection(self, maxevts=None, firstevt=0, json=None):
+    """Compile the declarative pre-selection of the channel module to a cut string,
+    and return it, to be applied before analyze, e.g. via PostProcessor's cut.
+    The pre-selection is defined in self.preselection as
+      'triggers': list of HLT paths, or Trigger objects (see TrigObjMatcher)
+      'objects':  list of (collection, minimum pt, maximum |eta|)
+    The cutflow bins of events that fail it, are filled in bulk in beginFile.
+    Only objects required before the first cutflow bin filled in analyze may be listed,
+    with cuts looser than in analyze, else that bin is undercounted.
+    If a golden JSON is applied before analyze, no pre-selection is set, as the bulk counting
+    would include the rejected lumi sections, and the cutflow is filled per event instead."""
+    if json:
+      print ">>> setpreselection: Not setting pre-selection, as the JSON %s is applied before the module"%(json)
+      return None
+    optional = [b for b, d in self.getbranchaliases() if not isinstance(d,str)] # branches that may be missing
+    triggers = [getattr(t,'path',t) for t in self.preselection.get('triggers',[ ])]
+    cuts     = [ "PV_npvs>0" if self.isdata else "Pileup_nTrueInt>0" ]
+    if any(p in optional for p in triggers):
+      print ">>> setpreselection: Not adding triggers to pre-selection, as some branches may be missing: %s"%(triggers)
+    elif triggers:
+      cuts.append(self.gettriggercut())
+    for obj, ptmin, etamax in self.preselection.get('objects',[ ]):
+      cuts.append("Sum$(%s_pt>=%s && abs(%s_eta)<=%s)>0"%(obj,ptmin,obj,etamax))
+    self.presel  = " && ".join(cuts)
+    self.maxevts  = maxevts
+    self.firstevt = firstevt
+    print ">>> %-12s = %r"%('presel',self.presel)
+    return self.presel
+    
+  
+  def gettriggercut(self, branches=None):
+    """Return the OR of the pre-selection triggers as cut string. If a list of available
+    branches is given, missing branches are replaced by their default (see getbranchaliases)."""
+    defaults = { b: d for b, d in self.getbranchaliases() if not isinstance(d,str) }
+    paths    = [ ]
+    for trigger in self.preselection.get('triggers',[ ]):
+      path     = getattr(trigger,'path',trigger)
+      runrange = getattr(trigger,'runrange',None)
+      if branches!=None and path not in branches and path in defaults:
+        path = str(int(defaults[path]))
+      if runrange:
+        path = "(run>=%d && run<=%d && %s)"%(runrange[0],runrange[1],path)
+      paths.append(path)
+    return "(%s)"%(" || ".join(paths)) if paths else "1"
+    
+  
+  def countpreselection(self, tree):
+    """Fill the first bins of the cutflow in bulk from counters over all events in the input tree,
+    as events failing the pre-selection never reach analyze."""
+    first    = self.firstevt
+    nevts    = max(0,tree.GetEntries()-first)
+    if self.maxevts and self.maxevts<nevts:
+      nevts  = self.maxevts
+    branches = [b.GetName() for b in tree.GetListOfBranches()]
+    trigger  = self.gettriggercut(branches)
+    self.out.cutflow.fillbulk('none',nevts)
+    if self.isdata:
+      self.out.cutflow.fillbulk('weight',nevts)
+      self.out.cutflow.fillbulk('weight_no0PU',counttree(tree,"PV_npvs>0",nevts=nevts,first=first)[0])
+      self.out.cutflow.fillbulk('trig',counttree(tree,"PV_npvs>0 && "+trigger,nevts=nevts,first=first)[0])
+    else:
+      self.out.cutflow.fillbulk('weight',nevts,*counttree(tree,"",weight="genWeight",nevts=nevts,first=first)[1:])
+      nevts_pu = counttree(tree,"Pileup_nTrueInt>0",nevts=nevts,first=first)[0] # including zero weights
+      self.out.cutflow.fillbulk('weight_no0PU',nevts_pu,*counttree(tree,"Pileup_nTrueInt>0",weight="genWeight",nevts=nevts,first=first)[1:3])
+      self.out.cutflow.fillbulk('trig',counttree(tree,"Pileup_nTrueInt>0 && "+trigger,nevts=nevts,first=first)[0])
+      self.out.pileup.Add(counttree(tree,"",var="Pileup_nTrueInt",bins=(100,0,100),nevts=nevts,first=first)[3])
+    
+  
+  def countevent(self, event):
+    """Fill the first bins of the cutflow for a single event, and return True if the event
+    has pileup (MC) or a primary vertex (data)."""
+    self.out.cutflow.fill('none')
+    if self.isdata:
+      self.out.cutflow.fill('weight',1.)
+      if event.PV_npvs>0:
+        self.out.cutflow.fill('weight_no0PU',1.)
+      else:
+        return False
+    else:
+      self.out.cutflow.fill('weight',event.genWeight)
+      self.out.pileup.Fill(event.Pileup_nTrueInt)
+      if event.Pileup_nTrueInt>0:
+        self.out.cutflow.fill('weight_no0PU',event.genWeight)
+      else:
+        return False
+    return True
+    
+  
+  def countchunk(self, arrays):
+    """Fill the first bins of the cutflow in bulk for a chunk of events in columnar mode,
+    and return the mask of events with pileup (MC) or a primary vertex (data)."""
+    nevts = len(arrays)
+    self.out.cutflow.fillbulk('none',nevts)
+    if self.isdata:
+      mask = arrays.PV_npvs>0
+      self.out.cutflow.fillbulk('weight',nevts)
+      self.out.cutflow.fillbulk('weight_no0PU',mask.sum())
+    else:
+      weights = arrays.genWeight
+      mask    = arrays.Pileup_nTrueInt>0
+      self.out.cutflow.fillbulk('weight',nevts,weights.sum(),(weights**2).sum())
+      self.out.pileup.FillN(nevts,arrays.Pileup_nTrueInt,np.ones(nevts))
+      self.out.cutflow.fillbulk('weight_no0PU',mask.sum(),weights[mask].sum(),(weights[mask]**2).sum())
+    return mask
+    
+  
+  def selecttauchunk(self, arrays, mask):
+    """Select taus in events passing a mask in columnar mode, after applying the same
+    energy scale corrections (TES, LTF, JTF) as analyze.
+    Return the jagged tau array, the tau mask and the corrected tau pt and mass."""
+    taus    = arrays.Tau_pt
+    taupt   = taus.content
+    taumass = arrays.Tau_mass.content
+    taudm   = arrays.Tau_decayMode.content
+    taumask = mask[taus.parents] &\
+      (abs(arrays.Tau_eta.content)<=self.tauCutEta) & (abs(arrays.Tau_dz.content)<=0.2) &\
+      np.in1d(taudm,[0,1,10,11]) & (abs(arrays.Tau_charge.content)==1)
+    if self.ismc:
+      genmatch = arrays.Tau_genPartFlav.content
+      scale    = np.ones(len(taupt))
+      real     = taumask & (genmatch==5) # real tau
+      if self.tes!=None:
+        scale[real] = self.tes
+      elif real.any():
+        scale[real] = [self.tesTool.getTES(p,dm,unc=self.tessys) for p, dm in zip(taupt[real].tolist(),taudm[real].tolist())]
+      if self.ltf!=1.0: # lepton -> tau fake
+        scale[taumask & (0<genmatch) & (genmatch<5)] = self.ltf
+      if self.jtf!=1.0: # jet -> tau fake
+        scale[taumask & (genmatch==0)] = self.jtf
+      taupt   = taupt*scale
+      taumass = taumass*scale
+    taumask &= (taupt>=self.tauCutPt) &\
+      (arrays.Tau_idDeepTau2017v2p1VSe.content>=1) & (arrays.Tau_idDeepTau2017v2p1VSmu.content>=1)
+    return taus, taumask, taupt, taumass
+    
+  
+  def fillchunk(self, arrays, evts, ileps, itaus, lepton, taupt, taumass):
+    """Fill the branches of the selected lepton-tau pairs in columnar mode, given
+    the event index and the flat indices of the lepton and tau in each event."""
+    leptons = arrays[lepton+'_pt']
+    taus    = arrays.Tau_pt
+    rows    = [ ] # MC rows are filled after computing the b tag weights for the chunk
+    if self.ismc:
+      self.chunkjets = [ ]
+    for ievt, ilep, itau in zip(evts,ileps,itaus):
+      event     = ChunkEvent(arrays,ievt)
+      lep       = event.getobject(lepton,ilep-leptons.starts[ievt])
+      tau       = event.getobject('Tau',itau-taus.starts[ievt])
+      tau.pt    = taupt[itau].item()
+      tau.mass  = taumass[itau].item()
+      lep.tlv   = lep.p4()
+      tau.tlv   = tau.p4()
+      self.fillPairBranches(event,lep,tau)
+      if self.ismc:
+        rows.append(self.out.getrow())
+      else:
+        self.out.fill()
+    if self.ismc:
+      self.fillchunkbtagweights(arrays,evts,rows)
+    
+  
+  def fillchunkbtagweights(self, arrays, evts, rows):
+    """Compute the b tag weights of the jets collected by fillCommonCorrBraches
+    for all selected events of a chunk at once, and fill the rows."""
+    chunkjets, self.chunkjets = self.chunkjets, None
+    if not rows: return
+    rows    = np.concatenate(rows)
+    counts  = np.array([len(j) for j in chunkjets],dtype=np.int64)
+    jetpt   = arrays.Jet_pt
+    ijets   = np.repeat(jetpt.starts[evts],counts) + np.array([i for j in chunkjets for i in j],dtype=np.int64)
+    tagged  = arrays['Jet_'+self.btagTool.tagbranch].content[ijets]>self.btagTool.wp
+    weights = self.btagTool.getWeights(jetpt.content[ijets],arrays.Jet_eta.content[ijets],
+                                       arrays.Jet_partonFlavour.content[ijets],tagged,counts)
+    for unc, weight in weights.iteritems():
+      branch = 'btagweight' if unc=='Nom' else 'btagweight'+unc
+      if branch in rows.dtype.names:
+        rows[branch] = weight
+    self.out.fillrows(rows)
     
   
   def fillEventBranches(self,event):
     """Help function to fill branches of common event variables."""
     
     # EVENT
-    self.out.evt[0]             = event.event & 0xffffffffffffffff
-    self.out.data[0]            = self.isdata
-    self.out.run[0]             = event.run
-    self.out.lumi[0]            = event.luminosityBlock
-    self.out.npv[0]             = event.PV_npvs
-    self.out.npv_good[0]        = event.PV_npvsGood
-    self.out.metfilter[0]       = self.filter(event)
+    self.out.setrow(('evt','data','run','lumi','npv','npv_good','metfilter'),
+                    (event.event & 0xffffffffffffffff, self.isdata, event.run, event.luminosityBlock,
+                     event.PV_npvs, event.PV_npvsGood, self.filter(event)))
     
     if self.ismc:
       ###self.out.ngentauhads[0]   = ngentauhads
       ###self.out.ngentaus[0]      = ngentaus
-      self.out.genmet[0]        = event.GenMET_pt
-      self.out.genmetphi[0]     = event.GenMET_phi
-      self.out.npu[0]           = event.Pileup_nPU
-      self.out.npu_true[0]      = event.Pileup_nTrueInt
       try:
-        self.out.NUP[0]         = event.LHE_Njets
+        nup = event.LHE_Njets
       except RuntimeError:
-        self.out.NUP[0]         = -1
+        nup = -1
+      self.out.setrow(('genmet','genmetphi','npu','npu_true','NUP'),
+                      (event.GenMET_pt, event.GenMET_phi, event.Pileup_nPU, event.Pileup_nTrueInt, nup))
     elif self.isembed:
       self.out.isdata[0]        = False
     
   
   def fillJetBranches(self,event,tau1,tau2):
     """Help function to select jets and b tags, after removing overlap with tau decay candidates,
-    and fill the jet variable branches."""
+    and fill the jet variable branches. The jets are selected with array operations
+    for the nominal pT and all JEC variations at once."""
     
     # NOMINAL AND VARIATIONS
     metnom     = self.met(event)
     met_vars   = { }
     if self.dojecsys:
-      jets_vars = { u: [ ] for u in self.jecUncLabels }
       met_vars  = { u: self.met_vars[u](event) for u in self.metUncLabels } # TLVs
     
-    # COUNTERS
-    njets_vars     = { }
-    jets,   bjets  = [ ], [ ]
-    nfjets, ncjets = 0, 0
-    nbtag          = 0
-    
-    # SELECT JET, remove overlap with selected objects
-    for jet in Collection(event,'Jet'):
-      if abs(jet.eta)>4.7: continue
-      if jet.DeltaR(tau1)<0.5: continue
-      if jet.DeltaR(tau2)<0.5: continue
-      if jet.jetId<2: continue # Tight
+    # SELECT JETS, remove overlap with selected objects
+    njet       = event.nJet
+    eta        = getarray(event.Jet_eta,njet)
+    phi        = getarray(event.Jet_phi,njet)
+    btag       = getarray(event.Jet_btagDeepB,njet)
+    jetid      = getarray(event.Jet_jetId,njet,np.int32)
+    clean      = (abs(eta)<=4.7) & (jetid>=2) & (deltaR(eta,phi,tau1.eta,tau1.phi)>=0.5) & (deltaR(eta,phi,tau2.eta,tau2.phi)>=0.5) # Tight
+    btagged    = (btag>self.deepcsv_wp.medium) & (abs(eta)<self.bjetCutEta)
+    
+    # PT CUT for nominal pt (first row) & JEC variations (other rows)
+    ptvars     = [event.Jet_pt_nom if self.dojec else event.Jet_pt]
+    ptvars    += [getattr(event,'Jet_pt_'+u) for u in self.jecUncLabels]
+    pts        = np.array([getarray(p,njet) for p in ptvars]).reshape(len(ptvars),njet)
+    passed     = clean & (pts>=self.jetCutPt)
+    njets      = np.count_nonzero(passed,axis=1)
+    nbtags     = np.count_nonzero(passed & btagged,axis=1)
       
-      # SAVE JEC VARIATIONS
-      if self.dojec:
-        jetpt = jet.pt_nom
-        for unc in self.jecUncLabels:
-          if getattr(jet,'pt_'+unc) < self.jetCutPt: continue
-          jets_vars[unc].append(jet)
-      else:
-        jetpt = jet.pt
-      
-      # PT CUT
-      if jetpt<self.jetCutPt: continue
-      jets.append(jet)
-      
-      # COUNT FORWARD/CENTRAL
-      if abs(jet.eta)>2.4:
-        nfjets += 1
-      else:
-        ncjets += 1
-      
-      # B TAGGING
-      if jet.btagDeepB>self.deepcsv_wp.medium and abs(jet.eta)<self.bjetCutEta:
-        nbtag += 1
-        bjets.append(jet)
-    
-    #### TOTAL MOMENTUM
-    ###eventSum = TLorentzVector()
-    ###for lep in muons :
-    ###    eventSum += lep.p4()
-    ###for lep in electrons :
-    ###    eventSum += lep.p4()
-    ###for j in filter(self.jetSel,jets):
-    ###    eventSum += j.p4()
-    
-    # FILL JET BRANCHES
-    jets.sort( key=lambda j: self.ptnom(j),reverse=True)
-    bjets.sort(key=lambda j: self.ptnom(j),reverse=True)
-    self.out.njets[0]         = len(jets)
-    self.out.nfjets[0]        = nfjets
-    self.out.ncjets[0]        = ncjets
-    self.out.nbtag[0]         = nbtag
-    
-    # LEADING JET
-    if len(jets)>0:
-      self.out.jpt_1[0]       = self.ptnom(jets[0])
-      self.out.jeta_1[0]      = jets[0].eta
-      self.out.jphi_1[0]      = jets[0].phi
-      self.out.jdeepb_1[0]    = jets[0].btagDeepB
-    else:
-      self.out.jpt_1[0]       = -1.
-      self.out.jeta_1[0]      = -9.
-      self.out.jphi_1[0]      = -9.
-      self.out.jdeepb_1[0]    = -9.
-    
-    # SUBLEADING JET
-    if len(jets)>1:
-      self.out.jpt_2[0]       = self.ptnom(jets[1])
-      self.out.jeta_2[0]      = jets[1].eta
-      self.out.jphi_2[0]      = jets[1].phi
-      self.out.jdeepb_2[0]    = jets[1].btagDeepB
-    else:
-      self.out.jpt_2[0]       = -1.
-      self.out.jeta_2[0]      = -9.
-      self.out.jphi_2[0]      = -9.
-      self.out.jdeepb_2[0]    = -9.
-    
-    # LEADING B JETS
-    if len(bjets)>0:
-      self.out.bpt_1[0]       = self.ptnom(bjets[0])
-      self.out.beta_1[0]      = bjets[0].eta
-    else:
-      self.out.bpt_1[0]       = -1.
-      self.out.beta_1[0]      = -9.
-    
-    # SUBLEADING B JETS
-    if len(bjets)>1:
-      self.out.bpt_2[0]       = self.ptnom(bjets[1])
-      self.out.beta_2[0]      = bjets[1].eta
-    else:
-      self.out.bpt_2[0]       = -1.
-      self.out.beta_2[0]      = -9.
-    
-    ## FILL JET VARIATION BRANCHES
-    #if self.dojecsys:
-    #  for unc, jets_var in jets_vars.iteritems():
-    #    ptvar = 'pt_'+unc
-    #    jets_var.sort(key=lambda j: getattr(j,ptvar),reverse=True)
-    #    njets_vars[unc] = len(jets_var)
-    #    bjets_vars      = [j for j in jets_vars if j.btagDeepB > self.deepcsv_wp.medium and abs(j.eta)<self.bjetCutEta]
-    #    getattr(self.out,"njets_"+unc)[0] = njets_vars[unc]
-    #    getattr(self.out,"nbtag_"+unc)[0] = len(bjets_vars)
-    #    getattr(self.out,"jpt_1_"+unc)[0] = getattr(jets_var[0],ptvar) if len(jets_var)>=1 else -1
-    #    getattr(self.out,"jpt_2_"+unc)[0] = getattr(jets_var[1],ptvar) if len(jets_var)>=2 else -1
+    # NOMINAL JETS, sorted by pt like list.sort (stable)
+    ijets      = np.flatnonzero(passed[0])
+    ijets      = ijets[np.argsort(-pts[0][ijets],kind='mergesort')]
+    ibjets     = ijets[btagged[ijets]]
+    ncjets     = np.count_nonzero(abs(eta[ijets])<=2.4)
+    jets       = [Object(event,'Jet',i) for i in ijets.tolist()]
+    
+    # LEADING & SUBLEADING (B) JETS
+    jet1  = (pts[0][ijets[0]],eta[ijets[0]],phi[ijets[0]],btag[ijets[0]]) if len(ijets)>0 else (-1.,-9.,-9.,-9.)
+    jet2  = (pts[0][ijets[1]],eta[ijets[1]],phi[ijets[1]],btag[ijets[1]]) if len(ijets)>1 else (-1.,-9.,-9.,-9.)
+    bjet1 = (pts[0][ibjets[0]],eta[ibjets[0]]) if len(ibjets)>0 else (-1.,-9.)
+    bjet2 = (pts[0][ibjets[1]],eta[ibjets[1]]) if len(ibjets)>1 else (-1.,-9.)
+    self.out.setrow(('njets','nfjets','ncjets','nbtag',
+                     'jpt_1','jeta_1','jphi_1','jdeepb_1','jpt_2','jeta_2','jphi_2','jdeepb_2',
+                     'bpt_1','beta_1','bpt_2','beta_2'),
+                    (len(ijets),len(ijets)-ncjets,ncjets,len(ibjets))+jet1+jet2+bjet1+bjet2)
+    
+    # FILL JET VARIATION BRANCHES
+    njets_vars = { }
+    if self.jecUncLabels:
+      leading  = np.full((len(ptvars),max(njet,2)),-1.)
+      leading[:,:njet] = np.where(passed,pts,-1.)
+      leading  = -np.sort(-leading,axis=1)[:,:2] # leading and subleading pt
+      for i, unc in enumerate(self.jecUncLabels,1):
+        njets_vars[unc] = njets[i]
+      self.out.setrow(self.jecbranches,
+                      tuple(v for i in xrange(1,len(ptvars)) for v in (njets[i],nbtags[i],leading[i][0],leading[i][1])))
     
     return jets, metnom, njets_vars, met_vars
     
@@ -304,7 +467,10 @@ class ModuleTauPair(Module):
     
     self.out.genweight[0]          = event.genWeight
     self.out.puweight[0]           = self.puTool.getWeight(event.Pileup_nTrueInt)
-    self.out.btagweight[0]         = self.btagTool.getWeight(jets)
+    if self.chunkjets!=None: # b tag weights are computed for the whole chunk (see fillchunk)
+      self.chunkjets.append([j._index for j in jets])
+    else:
+      self.out.btagweight[0]       = self.btagTool.getWeight(jets)
     #if not self.dotight:
     #  self.out.btagweightUp[0]   = self.btagTool.getWeight(jets,unc='Up')
     #  self.out.btagweightDown[0] = self.btagTool.getWeight(jets,unc='Down')
@@ -331,10 +497,10 @@ class ModuleTauPair(Module):
         correctmet(met,dp)
     
     # MET
-    self.out.met[0]       = met.Pt()
-    self.out.metphi[0]    = met.Phi()
-    self.out.mt_1[0]      = sqrt( 2*self.out.pt_1[0]*met.Pt()*(1-cos(deltaPhi(self.out.phi_1[0],met.Phi()))) )
-    self.out.mt_2[0]      = sqrt( 2*self.out.pt_2[0]*met.Pt()*(1-cos(deltaPhi(self.out.phi_2[0],met.Phi()))) )
+    metpt                 = met.Pt()
+    metphi                = met.Phi()
+    mt_1                  = sqrt( 2*self.out.pt_1[0]*metpt*(1-cos(deltaPhi(self.out.phi_1[0],metphi))) )
+    mt_2                  = sqrt( 2*self.out.pt_2[0]*metpt*(1-cos(deltaPhi(self.out.phi_2[0],metphi))) )
     ###self.out.puppimetpt[0]             = event.PuppiMET_pt
     ###self.out.puppimetphi[0]            = event.PuppiMET_phi
     ###self.out.metsignificance[0]        = event.MET_significance
@@ -349,9 +515,6 @@ class ModuleTauPair(Module):
     zetaAxis              = TVector3(leg1.Unit()+leg2.Unit()).Unit()
     pzetavis              = leg1*zetaAxis + leg2*zetaAxis
     pzetamiss             = met.Vect()*zetaAxis
-    self.out.pzetamiss[0] = pzetamiss
-    self.out.pzetavis[0]  = pzetavis
-    self.out.dzeta[0]     = pzetamiss - 0.85*pzetavis
     
     # MET SYSTEMATICS
     for unc, met_var in met_vars.iteritems():
@@ -361,11 +524,11 @@ class ModuleTauPair(Module):
       getattr(self.out,"dzeta_"+unc)[0]  = met_var.Vect()*zetaAxis - 0.85*pzeta_vis
     
     # DILEPTON
-    self.out.m_vis[0]     = (tau1 + tau2).M()
-    self.out.pt_ll[0]     = (tau1 + tau2).Pt()
-    self.out.dR_ll[0]     = tau1.DeltaR(tau2)
-    self.out.dphi_ll[0]   = deltaPhi(self.out.phi_1[0], self.out.phi_2[0])
-    self.out.deta_ll[0]   = abs(self.out.eta_1[0] - self.out.eta_2[0])
-    self.out.chi[0]       = exp(abs(tau1.Rapidity() - tau2.Rapidity()))
+    ditau                 = tau1 + tau2
+    self.out.setrow(('met','metphi','mt_1','mt_2','pzetamiss','pzetavis','dzeta',
+                     'm_vis','pt_ll','dR_ll','dphi_ll','deta_ll','chi'),
+                    (metpt, metphi, mt_1, mt_2, pzetamiss, pzetavis, pzetamiss - 0.85*pzetavis,
+                     ditau.M(), ditau.Pt(), tau1.DeltaR(tau2), deltaPhi(self.out.phi_1[0],self.out.phi_2[0]),
+                     abs(self.out.eta_1[0] - self.out.eta_2[0]), exp(abs(tau1.Rapidity() - tau2.Rapidity()))))
     
 
@@ -34,18 +34,26 @@ class TreeProducer(object):
   """Base class to create and prepare a custom output file & tree for analysis modules."""
   
   def __init__(self, filename, module, **kwargs):
-    self.filename = filename
-    self.module   = module
-    self.outfile  = TFile(filename,'RECREATE')
-    ncuts         = kwargs.get('ncuts',25)
-    self.cutflow  = Cutflow('cutflow',ncuts)
-    self.pileup   = TH1D('pileup', 'pileup', 100, 0, 100)
-    self.tree     = TTree('tree','tree')
+    self.filename   = filename
+    self.module     = module
+    self.outfile    = TFile(filename,'RECREATE')
+    ncuts           = kwargs.get('ncuts',25)
+    self.cutflow    = Cutflow('cutflow',ncuts)
+    self.pileup     = TH1D('pileup', 'pileup', 100, 0, 100)
+    self.tree       = TTree('tree','tree')
+    self.buffersize = kwargs.get('buffersize',0) # number of rows buffered before filling the tree in one go; 0 to fill directly
+    self._branches  = [ ]   # list of (branch name, array name, TBranch)
+    self._record    = None  # structured array with current row; branch addresses point to its fields
+    self._buffer    = None  # preallocated rows, filled into the tree in blocks
+    self._nrows     = 0     # number of rows in buffer
+    self._fields    = { }   # branch name -> field of the record
   
   def addBranch(self, name, dtype='f', default=None, title=None, arrname=None):
     """Add branch with a given name, and create an array of the same name as address."""
     if hasattr(self,name):
       raise IOError("Branch of name '%s' already exists!"%(name))
+    if self._record is not None:
+      raise IOError("Cannot add branch '%s' after the first row has been filled!"%(name))
     if not arrname:
       arrname = name
     if isinstance(dtype,str): # Set correct data type for numpy:
@@ -60,13 +68,95 @@ class TreeProducer(object):
       getattr(self,name)[0] = default
     if title:
       branch.SetTitle(title)
+    self._branches.append((name,arrname,branch))
+  
+  def initbuffer(self):
+    """Create a structured array as record of the current row with a field per branch,
+    and point the arrays and branch addresses to its fields. Also preallocate the buffer."""
+    dtype        = [(n,getattr(self,a).dtype) for n, a, b in self._branches]
+    self._record = np.zeros(1,dtype=dtype)
+    for name, arrname, branch in self._branches:
+      self._record[name] = getattr(self,arrname) # keep defaults & values set so far
+      field = self._record[name]
+      setattr(self,arrname,field)
+      branch.SetAddress(field)
+      self._fields[name] = field
+    self._buffer = np.zeros(max(self.buffersize,0),dtype=dtype)
+    self._nrows  = 0
+  
+  def setrow(self, names, values):
+    """Set several branches of the current row at once, e.g.
+      self.out.setrow(('pt_1','eta_1'),(muon.pt,muon.eta))
+    instead of setting each array separately."""
+    if self._record is None:
+      self.initbuffer()
+    fields = self._fields # set field by field, as multi-field indexing returns a copy in numpy<1.16
+    for name, value in zip(names,values):
+      fields[name][0] = value
   
   def fill(self):
-    """Fill tree."""
-    return self.tree.Fill()
+    """Add current row to the buffer, and fill the tree if the buffer is full."""
+    if self._record is None:
+      self.initbuffer()
+    if self.buffersize<=0:
+      return self.tree.Fill()
+    self._buffer[self._nrows] = self._record[0]
+    self._nrows += 1
+    if self._nrows>=self.buffersize:
+      self.flush()
+  
+  def getrow(self):
+    """Return a copy of the current row as a structured array of length one,
+    e.g. to complete some branches for several rows at once before passing them to fillrows."""
+    if self._record is None:
+      self.initbuffer()
+    return self._record.copy()
+  
+  def fillrows(self, rows):
+    """Add several rows at once, given as a structured array with the same fields as the record,
+    or as a dictionary of column arrays; missing branches get the value of the current row."""
+    if self._record is None:
+      self.initbuffer()
+    if isinstance(rows,dict):
+      columns = rows
+      nrows   = len(columns.itervalues().next()) if columns else 0
+      rows    = np.repeat(self._record,nrows)
+      for name, column in columns.iteritems():
+        rows[name] = column
+    if self.buffersize<=0:
+      return self.filltree(rows)
+    nrows = len(rows)
+    first = 0
+    while first<nrows:
+      nfill = min(nrows-first,self.buffersize-self._nrows)
+      self._buffer[self._nrows:self._nrows+nfill] = rows[first:first+nfill]
+      self._nrows += nfill
+      first       += nfill
+      if self._nrows>=self.buffersize:
+        self.flush()
+  
+  def flush(self):
+    """Fill the buffered rows into the tree."""
+    if self._nrows>0:
+      self.filltree(self._buffer[:self._nrows])
+      self._nrows = 0
+  
+  def filltree(self, rows):
+    """Fill rows into the tree by copying each whole row to the branch addresses,
+    and restore the current row afterwards."""
+    if not len(rows):
+      return
+    record  = self._record
+    current = record.copy()
+    fill    = self.tree.Fill
+    for row in rows:
+      record[0] = row
+      fill()
+    record[0] = current[0]
   
   def endJob(self):
     """Write and close files after the job ends."""
+    self.flush()
     self.outfile.Write()
     self.outfile.Close()
   
@@ -79,15 +79,11 @@ class TreeProducerTauPair(TreeProducer):
     self.addBranch('bpt_2',               'f')
     self.addBranch('beta_2',              'f')
     
-    ###for unc in module.jecUncLabels:
-    ###  unc  = '_'+unc
-    ###  unc2 = unc.replace('Total','') # shorthand
-    ###  self.addBranch('njets'+unc2,         'i', arrname='njets'+unc        )
-    ###  self.addBranch('njets50'+unc2,       'i', arrname='njets50'+unc      )
-    ###  self.addBranch('nbtag50'+unc2,       'i', arrname='nbtag50'+unc      )
-    ###  self.addBranch('nbtag50_loose'+unc2, 'i', arrname='nbtag50_loose'+unc)
-    ###  self.addBranch('jpt_1'+unc2,         'f', arrname='jpt_1'+unc        )
-    ###  self.addBranch('jpt_2'+unc2,         'f', arrname='jpt_2'+unc        )
+    for unc in module.jecUncLabels:
+      self.addBranch('njets_'+unc,        'i', title="number of jets with %s JEC variation"%(unc))
+      self.addBranch('nbtag_'+unc,        'i', title="number of b tagged jets with %s JEC variation"%(unc))
+      self.addBranch('jpt_1_'+unc,        'f', -1)
+      self.addBranch('jpt_2_'+unc,        'f', -1)
     
     self.addBranch('met',                 'f')
     self.addBranch('metphi',              'f')
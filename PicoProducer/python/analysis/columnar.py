@@ -0,0 +1,239 @@
+# Description: Tools for the columnar processing mode of analysis modules: read nanoAOD in
+#              large chunks of events as (jagged) numpy arrays, select objects and pairs with
+#              array operations, and reuse the per-event help functions of the modules
+#              only for the few selected events.
+#              Branches are read with uproot3 (if available) or root_numpy.
+import time
+from fnmatch import fnmatch
+from math import pi
+import numpy as np
+from ROOT import TFile
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Object
+from TauFW.PicoProducer.analysis.utils import LOG
+try:
+  import uproot
+  if not uproot.__version__.startswith('3.'): # only uproot3's API (entrysteps, namedecode) is supported
+    uproot = None
+except ImportError:
+  uproot = None
+try:
+  from root_numpy import tree2array
+except ImportError:
+  tree2array = None
+  
+
+class Jagged(object):
+  """Minimal jagged array: flat content of the objects of all events,
+  and the number of objects per event."""
+  
+  def __init__(self, content, counts):
+    self.content = np.asarray(content)
+    self.counts  = np.asarray(counts,dtype=np.int64)
+    self.starts  = np.cumsum(self.counts)-self.counts
+    self.parents = np.repeat(np.arange(len(self.counts)),self.counts) # event index of each object
+  
+  def __len__(self):
+    """Number of events."""
+    return len(self.counts)
+  
+  def __getitem__(self, index):
+    """Return objects of a single event."""
+    return self.content[self.starts[index]:self.starts[index]+self.counts[index]]
+  
+  def broadcast(self, value):
+    """Broadcast per-event values (or a scalar) to all objects."""
+    value = np.asarray(value)
+    if value.ndim==0:
+      return value
+    return value[self.parents]
+  
+  def count(self, mask):
+    """Count objects passing a (flat) mask per event."""
+    return np.bincount(self.parents[mask],minlength=len(self))
+  
+
+class Columns(dict):
+  """Dictionary of branch arrays for a chunk of events, with attribute access,
+  so lambdas like 'lambda e: e.HLT_IsoMu24 | e.HLT_IsoMu27' can be evaluated
+  for a single event, as well as for a whole chunk."""
+  
+  def __init__(self, arrays, nevents):
+    dict.__init__(self,arrays)
+    self.nevents = nevents
+  
+  def __len__(self):
+    """Number of events."""
+    return self.nevents
+  
+  def __getattr__(self, name):
+    if name[:2]=='__' and name[-2:]=='__':
+      raise AttributeError(name)
+    if name not in self:
+      raise RuntimeError("Unknown branch %r"%(name))
+    return self[name]
+  
+
+class ChunkEvent(object):
+  """Stand-in for nanoAOD-tools' Event for one entry of a chunk, so the help functions
+  (Collection, Object, vetoes, jets, corrections, ...) can be reused for selected events.
+  Values are converted to python types as they would be read with PyROOT."""
+  
+  def __init__(self, arrays, index):
+    self._arrays = arrays
+    self._entry  = index
+  
+  def __getattr__(self, name):
+    if name[0]=='_':
+      raise AttributeError(name)
+    if name not in self._arrays:
+      raise RuntimeError("Unknown branch %r"%(name))
+    array = self._arrays[name]
+    if isinstance(array,Jagged):
+      value = array[self._entry].tolist()
+    else:
+      value = array[self._entry].item()
+    self.__dict__[name] = value # cache
+    return value
+  
+  def getobject(self, prefix, index):
+    """Return nanoAOD-tools Object of a collection with a given index in this event."""
+    return Object(self,prefix,index=index)
+  
+
+def getarray(values, count, dtype=np.float64):
+  """Convert the values of a branch of a single event (TTreeReaderArray, or list of ChunkEvent)
+  to a numpy array, e.g. to select all objects of a collection at once."""
+  return np.fromiter(values,dtype,count)
+  
+
+def deltaR(eta1, phi1, eta2, phi2):
+  """Compute DeltaR for arrays, like nanoAOD-tools' Object.DeltaR(other) for objects 1 and 2."""
+  deta = abs(eta2 - eta1)
+  dphi = abs(phi2 - phi1)
+  dphi = np.where(dphi>pi,abs(dphi-2*pi),dphi)
+  return np.sqrt(dphi**2 + deta**2)
+  
+
+def getpairs(jagged1, mask1, jagged2, mask2):
+  """Return event index and flat object indices of all combinations of selected objects
+  of two collections in the same event, ordered like nested loops over both collections."""
+  idx1    = np.flatnonzero(mask1)
+  idx2    = np.flatnonzero(mask2)
+  counts1 = jagged1.count(mask1)
+  counts2 = jagged2.count(mask2)
+  npairs  = counts1*counts2
+  evts    = np.repeat(np.arange(len(npairs)),npairs)
+  local   = np.arange(npairs.sum()) - np.repeat(np.cumsum(npairs)-npairs,npairs)
+  ipair1  = idx1[(np.cumsum(counts1)-counts1)[evts] + local//counts2[evts]]
+  ipair2  = idx2[(np.cumsum(counts2)-counts2)[evts] + local%counts2[evts]]
+  return evts, ipair1, ipair2
+  
+
+def bestpairs(evts, *keys):
+  """Return the index of the best pair in each event by maximizing the keys (in order of
+  importance). Like max() of a list of LeptonPair objects, ties return the last pair."""
+  order = np.lexsort((np.arange(len(evts)),)+keys[::-1]+(evts,))
+  last  = np.ones(len(order),dtype=bool)
+  last[:-1] = evts[order][1:]!=evts[order][:-1]
+  return order[last]
+  
+
+def getbranchlist(available, patterns):
+  """Return list of available branches that match any glob pattern."""
+  return [b for b in available if any(fnmatch(b,p) for p in patterns)]
+  
+
+def toarray(array):
+  """Convert to flat numpy array, or to Jagged for arrays of variable length;
+  floats are converted to double precision to compute like python does."""
+  if hasattr(array,'counts'): # awkward JaggedArray (uproot)
+    array = Jagged(array.content,array.counts)
+  elif array.dtype==object: # numpy array of arrays (root_numpy)
+    counts  = np.array([len(a) for a in array],dtype=np.int64)
+    content = np.concatenate(array) if len(array) else np.array([ ])
+    array   = Jagged(content,counts)
+  if isinstance(array,Jagged):
+    if array.content.dtype.kind=='f':
+      array.content = array.content.astype(np.float64)
+  else:
+    array = np.asarray(array)
+    if array.dtype.kind=='f':
+      array = array.astype(np.float64)
+  return array
+  
+
+def iterchunks(filename, patterns, aliases=[ ], chunksize=100000, maxevts=None, firstevt=0, treename='Events'):
+  """Read branches matching a list of glob patterns from a nanoAOD file in chunks of events,
+  starting from entry firstevt.
+  Missing branches listed in aliases as (newbranch, oldbranch) are redirected to old branch,
+  or set to a default value (see ensurebranches)."""
+  if uproot:
+    utree     = uproot.open(filename)[treename]
+    available = [b.decode('utf-8') if isinstance(b,bytes) else b for b in utree.keys()]
+  elif tree2array:
+    file      = TFile.Open(filename,'READ')
+    tree      = file.Get(treename)
+    available = [b.GetName() for b in tree.GetListOfBranches()]
+  else:
+    LOG.throw(ImportError,"iterchunks: Columnar mode needs uproot3 or root_numpy!")
+  redirects = { }
+  defaults  = { }
+  for newbranch, oldbranch in aliases:
+    if newbranch in available: continue
+    if isinstance(oldbranch,str):
+      if oldbranch in available:
+        redirects[oldbranch] = newbranch
+    else:
+      defaults[newbranch] = oldbranch
+  branches  = getbranchlist(available,patterns)
+  if uproot:
+    stop    = None if maxevts==None else firstevt+maxevts
+    chunks  = utree.iterate(branches,entrysteps=chunksize,entrystart=firstevt,entrystop=stop,namedecode='utf-8')
+  else:
+    nevts   = tree.GetEntries() if maxevts==None else min(firstevt+maxevts,tree.GetEntries())
+    chunks  = (tree2array(tree,branches=branches,start=i,stop=min(i+chunksize,nevts)) for i in xrange(firstevt,nevts,chunksize))
+  for chunk in chunks:
+    if not uproot: # structured array
+      chunk   = { b: chunk[b] for b in chunk.dtype.names }
+    arrays    = { }
+    nevents   = 0
+    for branch, array in chunk.iteritems():
+      arrays[redirects.get(branch,branch)] = toarray(array)
+      nevents = len(array)
+    for branch, default in defaults.iteritems():
+      arrays[branch] = np.full(nevents,default)
+    yield Columns(arrays,nevents)
+  if not uproot:
+    file.Close()
+  
+
+def runcolumnar(module, infiles, maxevts=None, firstevt=0, chunksize=100000):
+  """Run an analysis module in columnar mode over a list of nanoAOD files:
+  pass chunks of the branches the module needs to module.analyzechunk.
+  The module's beginFile and endFile are called with the input file and tree for each file.
+  An event range (firstevt>0) can only be processed for a single file."""
+  if not hasattr(module,'analyzechunk'):
+    LOG.throw(IOError,"runcolumnar: Module %s does not support the columnar mode!"%(module.__class__.__name__))
+  if firstevt>0 and len(infiles)>1:
+    LOG.throw(ValueError,"runcolumnar: Cannot start from entry %d for more than one file: %s"%(firstevt,infiles))
+  time0     = time.time()
+  patterns  = module.getbranches()
+  aliases   = module.getbranchaliases()
+  nevts     = 0
+  nselected = 0
+  module.beginJob()
+  for infile in infiles:
+    if maxevts and nevts>=maxevts: break
+    print ">>> runcolumnar: Processing %s..."%(infile)
+    file = TFile.Open(infile,'READ')
+    tree = file.Get('Events')
+    module.beginFile(file,None,tree,None) # per-file setup, e.g. of triggers
+    for arrays in iterchunks(infile,patterns,aliases,chunksize=chunksize,maxevts=(maxevts-nevts if maxevts else None),firstevt=firstevt):
+      nevts     += len(arrays)
+      nselected += module.analyzechunk(arrays)
+      print ">>> runcolumnar: Processed %d events (%d selected) in %.1f seconds"%(nevts,nselected,time.time()-time0)
+    module.endFile(file,None,tree,None)
+    file.Close()
+  module.endJob()
+  return nevts, nselected
+  
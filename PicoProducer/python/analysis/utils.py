@@ -1,7 +1,8 @@
 # Author: Izaak Neutelings (May 2020)
 import os, sys
+import numpy as np
 from math import sqrt, sin, cos, pi
-from itertools import combinations
+from itertools import combinations, count
 from ROOT import TH1D, TLorentzVector
 from TauFW.PicoProducer import basedir
 from TauFW.common.tools.utils import convertstr # for picojob.py
@@ -49,6 +50,43 @@ def redirectbranch(oldbranch,newbranch):
     exec "setattr(Event,newbranch,%s)"%(oldbranch)  
   
 
+def writebranchsel(fname,patterns):
+  """Write a keep-and-drop file for the PostProcessor's branchsel that only keeps the branches
+  matching any glob pattern, so the others are not read (decompressed).
+  The branch status has to be set before nanoAOD-tools creates its TTreeReader for the input tree."""
+  with open(fname,'w') as file:
+    file.write("drop *\n")
+    for pattern in patterns:
+      file.write("keep %s\n"%(pattern))
+  print ">>> writebranchsel: Only reading %d branch patterns, see %s"%(len(patterns),fname)
+  return fname
+  
+
+_ncounttree = count() # for unique histogram names
+
+
+def counttree(tree,selection="",weight="",var="0.5",bins=(1,0,1),nevts=None,first=0):
+  """Fill a histogram with TTree::Draw to count the entries passing a selection in C++,
+  optionally for a range of nevts entries starting from entry first. Return the number of selected entries,
+  the sum of weights, the sum of squared weights, and the histogram.
+  NOTE: TTree::Draw only counts entries with nonzero selection*weight, so with a weight,
+  the number of selected entries excludes entries with zero weight."""
+  cut   = "(%s)*(%s)"%(weight,selection) if weight and selection else weight or selection
+  hname = "counttree_%d"%(next(_ncounttree)) # unique name to avoid replacing existing histograms
+  hist  = TH1D(hname,hname,*bins) # TTree::Draw needs it in the current directory
+  hist.Sumw2()
+  if nevts!=None or first>0:
+    if nevts==None:
+      nevts = tree.GetEntries()-first
+    nsel = tree.Draw("%s>>%s"%(var,hname),cut,"goff",nevts,first)
+  else:
+    nsel = tree.Draw("%s>>%s"%(var,hname),cut,"goff")
+  hist.SetDirectory(0)
+  sumw  = hist.Integral(0,bins[0]+1)
+  sumw2 = sum(hist.GetBinError(i)**2 for i in xrange(0,bins[0]+2))
+  return nsel, sumw, sumw2, hist
+  
+
 def hasbit(value,bit):
   """Check if i'th bit is set to 1, i.e. binary of 2^i,
   from the right to the left, starting from position i=0."""
@@ -155,54 +193,81 @@ def idIso(tau):
 
 def getLeptonVetoes(event, electrons, muons, taus, channel):
   """Check if event has extra electrons or muons. (HTT definitions.)"""
-  # https://twiki.cern.ch/twiki/bin/viewauth/CMS/HiggsToTauTauWorkingLegacyRun2#Common_lepton_vetoes
+  return getLeptonVetoSets(event,electrons,muons,[taus],channel)[0]
   
-  extramuon_veto = False
-  extraelec_veto = False
-  dilepton_veto  = False
+
+def getLeptonVetoSets(event, electrons, muons, tausets, channel):
+  """Check if event has extra electrons or muons (see getLeptonVetoes) for several sets of
+  taus to remove overlap with at once, using array operations, e.g.
+    vetoes_tau, vetoes = getLeptonVetoSets(event,[ ],[muon],[[tau],[ ]],'mutau')
+  Return list of (extramuon_veto, extraelec_veto, dilepton_veto) for each set of taus."""
+  # https://twiki.cern.ch/twiki/bin/viewauth/CMS/HiggsToTauTauWorkingLegacyRun2#Common_lepton_vetoes
+  from TauFW.PicoProducer.analysis.columnar import getarray, deltaR as deltaRs # here to avoid circular import
   
-  # EXTRA MUON VETO
-  looseMuons = [ ]
-  for muon in Collection(event,'Muon'):
-    if muon.pt<10: continue
-    if abs(muon.eta)>2.4: continue
-    if abs(muon.dz)>0.2: continue
-    if abs(muon.dxy)>0.045: continue
-    if muon.pfRelIso04_all>0.3: continue
-    if any(muon.DeltaR(tau)<0.4 for tau in taus): continue
-    if muon.mediumId and all(m._index!=muon._index for m in muons):
-      extramuon_veto = True
-    if muon.pt>15 and muon.isPFcand and muon.isGlobal and muon.isTracker:
-      looseMuons.append(muon)
+  # LOOSE MUONS
+  nmuon     = event.nMuon
+  mu_eta    = getarray(event.Muon_eta,nmuon)
+  mu_phi    = getarray(event.Muon_phi,nmuon)
+  mu_pt     = getarray(event.Muon_pt,nmuon)
+  mu_pass   = (mu_pt>=10) & (abs(mu_eta)<=2.4) & (abs(getarray(event.Muon_dz,nmuon))<=0.2) &\
+              (abs(getarray(event.Muon_dxy,nmuon))<=0.045) & (getarray(event.Muon_pfRelIso04_all,nmuon)<=0.3)
+  mu_extra  = getarray(event.Muon_mediumId,nmuon,bool)
+  mu_extra[[m._index for m in muons]] = False # not selected
+  mu_dilep  = (mu_pt>15) & getarray(event.Muon_isPFcand,nmuon,bool) &\
+              getarray(event.Muon_isGlobal,nmuon,bool) & getarray(event.Muon_isTracker,nmuon,bool)
   
-  # EXTRA ELECTRON VETO
-  looseElectrons = [ ]
-  for electron in Collection(event,'Electron'):
-    if electron.pt<10: continue
-    if abs(electron.eta)>2.5: continue
-    if abs(electron.dz)>0.2: continue
-    if abs(electron.dxy)>0.045: continue
-    if electron.pfRelIso03_all>0.3: continue
-    if any(electron.DeltaR(tau)<0.4 for tau in taus): continue
-    if all(e._index!=electron._index for e in electrons): continue
-    if electron.convVeto==1 and electron.lostHits<=1 and electron.mvaFall17V2Iso_WP90:
-      extraelec_veto = True
-    if electron.pt>15 and electron.cutBased>0 and electron.mvaFall17V2Iso_WPL:
-      looseElectrons.append(electron)
+  # LOOSE ELECTRONS
+  nelec     = event.nElectron
+  ele_eta   = getarray(event.Electron_eta,nelec)
+  ele_phi   = getarray(event.Electron_phi,nelec)
+  ele_pt    = getarray(event.Electron_pt,nelec)
+  ele_pass  = (ele_pt>=10) & (abs(ele_eta)<=2.5) & (abs(getarray(event.Electron_dz,nelec))<=0.2) &\
+              (abs(getarray(event.Electron_dxy,nelec))<=0.045) & (getarray(event.Electron_pfRelIso03_all,nelec)<=0.3)
+  ele_sel   = np.zeros(nelec,dtype=bool)
+  ele_sel[[e._index for e in electrons]] = True
+  ele_pass &= ele_sel # only electrons in the given list are considered (as in the original loop)
+  ele_extra = (getarray(event.Electron_convVeto,nelec,np.int32)==1) & (getarray(event.Electron_lostHits,nelec,np.int32)<=1) &\
+              getarray(event.Electron_mvaFall17V2Iso_WP90,nelec,bool)
+  ele_dilep = (ele_pt>15) & (getarray(event.Electron_cutBased,nelec,np.int32)>0) & getarray(event.Electron_mvaFall17V2Iso_WPL,nelec,bool)
   
-  # DILEPTON VETO
+  # DILEPTON PAIRS
   if channel=='mutau':
-    for muon1, muon2 in combinations(looseMuons,2):
-      if muon1.charge*muon2.charge<0 and muon1.DeltaR(muon2)>0.15:
-        dilepton_veto = True
-        break
+    pairs   = getoppositepairs(getarray(event.Muon_charge,nmuon,np.int32),mu_eta,mu_phi,mu_pass&mu_dilep,0.15)
   elif channel=='eletau':
-    for electron1, electron2 in combinations(looseElectrons,2):
-      if electron1.charge*electron2.charge<0 and electron1.DeltaR(electron2)>0.20:
-        dilepton_veto = True
-        break
+    pairs   = getoppositepairs(getarray(event.Electron_charge,nelec,np.int32),ele_eta,ele_phi,ele_pass&ele_dilep,0.20)
+  else:
+    pairs   = None
+  
+  # VETOES for each set of taus
+  vetoes = [ ]
+  for taus in tausets:
+    if taus:
+      taueta  = np.array([t.eta for t in taus])
+      tauphi  = np.array([t.phi for t in taus])
+      mu_iso  = mu_pass  & ~(deltaRs(mu_eta[:,None],mu_phi[:,None],taueta,tauphi)<0.4).any(axis=1)
+      ele_iso = ele_pass & ~(deltaRs(ele_eta[:,None],ele_phi[:,None],taueta,tauphi)<0.4).any(axis=1)
+    else:
+      mu_iso, ele_iso = mu_pass, ele_pass
+    extramuon_veto = bool((mu_iso & mu_extra).any())
+    extraelec_veto = bool((ele_iso & ele_extra).any())
+    dilepton_veto  = False
+    if pairs!=None: # both leptons of an opposite-sign pair pass
+      leps = mu_iso if channel=='mutau' else ele_iso
+      dilepton_veto = bool((leps[pairs[0]] & leps[pairs[1]]).any())
+    vetoes.append((extramuon_veto, extraelec_veto, dilepton_veto))
   
-  return extramuon_veto, extraelec_veto, dilepton_veto
+  return vetoes
+  
+
+def getoppositepairs(charge, eta, phi, mask, dRmin):
+  """Return indices of all pairs of objects passing a mask,
+  with opposite charge and separated by more than dRmin."""
+  from TauFW.PicoProducer.analysis.columnar import deltaR as deltaRs # here to avoid circular import
+  index    = np.flatnonzero(mask)
+  i1, i2   = np.triu_indices(len(index),1)
+  i1, i2   = index[i1], index[i2]
+  pair     = (charge[i1]*charge[i2]<0) & (deltaRs(eta[i1],phi[i1],eta[i2],phi[i2])>dRmin)
+  return i1[pair], i2[pair]
   
 
 class LeptonPair:
@@ -268,3 +333,16 @@ class Cutflow(object):
     index = self.cuts[cut]
     self.hist.Fill(index,*args)
   
+  def fillbulk(self, cut, nevts, sumw=None, sumw2=None):
+    """Fill a cut for many events at once, e.g. from counters in columnar mode.
+    If no sum of weights is given, assume unit weights."""
+    assert cut in self.cuts, "Did not find cut '%s'! Choose from %s"%(cut,self.cuts)
+    bin  = 1+self.cuts[cut]
+    err2 = self.hist.GetBinError(bin)**2
+    if sumw==None:
+      sumw, sumw2 = nevts, nevts
+    self.hist.AddBinContent(bin,sumw)
+    if self.hist.GetSumw2N()>0 or sumw!=nevts or sumw2!=nevts:
+      self.hist.SetBinError(bin,sqrt(err2+sumw2)) # also creates sum of squares of weights
+    self.hist.SetEntries(self.hist.GetEntries()+nevts)
+
@@ -1,6 +1,8 @@
 # Author: Izaak Neutelings (May 2020)
 import os, glob
+import time
 import importlib
+from subprocess import Popen, STDOUT
 import TauFW.PicoProducer.tools.config as GLOB
 from TauFW.PicoProducer.batch import moddir
 from TauFW.common.tools.log import Logger
@@ -56,3 +58,69 @@ def getcfgsamples(jobcfgnames,filter=[ ],veto=[ ],dtype=[ ],verb=0):
       samples.append(sample)
   return samples
   
+
+
+def getlastline(fname,pattern="",nbytes=4096):
+  """Help function to get the last line of a (growing) log file that contains a pattern."""
+  if not os.path.isfile(fname):
+    return ""
+  with open(fname,'r') as file:
+    file.seek(0,os.SEEK_END)
+    file.seek(max(0,file.tell()-nbytes))
+    lines = [l.strip() for l in file.read().splitlines() if pattern in l and l.strip()]
+  return lines[-1] if lines else ""
+  
+
+def runjobs(jobcmds,ncores=1,logfiles=[ ],names=[ ],interval=60,verb=0):
+  """Run a list of job commands on the local machine with a pool of ncores processes.
+  The output of each job is written to its log file, and the progress of the running jobs
+  is printed every 'interval' seconds. Return list of exit codes."""
+  njobs   = len(jobcmds)
+  names   = names or [str(i) for i in xrange(1,njobs+1)]
+  pending = range(njobs)
+  running = { } # job index -> (process, log file, start time)
+  codes   = [None]*njobs
+  tprint  = time.time()
+  try:
+    while pending or running:
+      
+      # START new jobs
+      while pending and len(running)<ncores:
+        i       = pending.pop(0)
+        logfile = open(logfiles[i],'w') if logfiles else None
+        if verb>=1:
+          print ">>> runjobs: Starting job %d/%d (%s): %s"%(i+1,njobs,names[i],jobcmds[i])
+        else:
+          print ">>> runjobs: Starting job %d/%d (%s)..."%(i+1,njobs,names[i])
+        process = Popen(jobcmds[i],shell=True,stdout=logfile,stderr=STDOUT)
+        running[i] = (process,logfile,time.time())
+      time.sleep(1)
+      
+      # CHECK finished jobs
+      for i, (process, logfile, tstart) in running.items():
+        code = process.poll()
+        if code==None: continue
+        if logfile:
+          logfile.close()
+        codes[i] = code
+        running.pop(i)
+        ndone    = njobs-len(pending)-len(running)
+        if code==0:
+          print ">>> runjobs: Job %d/%d (%s) done after %.1f seconds (%d/%d finished)"%(i+1,njobs,names[i],time.time()-tstart,ndone,njobs)
+        else:
+          LOG.warning("runjobs: Job %d/%d (%s) failed with exit code %s! See %s"%(i+1,njobs,names[i],code,logfiles[i] if logfiles else "output"))
+      
+      # PRINT progress of running jobs (last line of nanoAOD-tools' event loop)
+      if logfiles and running and time.time()-tprint>=interval:
+        tprint = time.time()
+        for i in sorted(running):
+          print ">>> runjobs:   %-30s %s"%(names[i]+':',getlastline(logfiles[i],"Processed") or "running...")
+  except KeyboardInterrupt:
+    LOG.warning("runjobs: Interrupted! Terminating %d running jobs..."%(len(running)))
+    for process, logfile, tstart in running.itervalues():
+      process.terminate()
+    raise
+  nfailed = sum(c!=0 for c in codes)
+  print ">>> runjobs: %d/%d jobs finished successfully"%(njobs-nfailed,njobs)
+  return codes
+  
@@ -9,12 +9,15 @@
 #   nanoAOD-tools/python/postprocessing/modules/btv/btagSFProducer.py
 #   https://github.com/cms-nanoAOD/nanoAOD-tools/blob/master/python/postprocessing/modules/btv/btagSFProducer.py
 import os
+import __future__
 from array import array
+import numpy as np
 import ROOT
 #ROOT.gROOT.ProcessLine('.L ./BTagCalibrationStandalone.cpp+')
 from TauFW.PicoProducer import datadir
 from TauFW.common.tools.file import ensureTFile
 from TauFW.common.tools.log import Logger
+from TauFW.PicoProducer.corrections.ScaleFactorTool import LookupTable
 from ROOT import TH2F, BTagCalibration, BTagCalibrationReader
 from ROOT.BTagEntry import OP_LOOSE, OP_MEDIUM, OP_TIGHT, OP_RESHAPING
 from ROOT.BTagEntry import FLAV_B, FLAV_C, FLAV_UDSG
@@ -55,6 +58,50 @@ class BTagWPs:
         self.tight    = 0.9693
         
 
+class BTagCalibrationArray:
+  """Evaluate the SF formulas of a BTagCalibration CSV file for arrays of jets with numpy,
+  like BTagCalibrationReader.eval: each formula is evaluated once for all jets in its
+  (flavor, eta, pt) bin, and SFs are zero for jets outside any bin."""
+  
+  functions = { 'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt, 'pow': np.power,
+                'max': np.maximum, 'min': np.minimum, 'abs': np.abs }
+  operatingpoints = { 'L': OP_LOOSE, 'M': OP_MEDIUM, 'T': OP_TIGHT, 'shape': OP_RESHAPING }
+  
+  def __init__(self, csvname, op, systypes=['central'], type_bc='comb', type_udsg='incl'):
+    measurements  = { FLAV_B: type_bc, FLAV_C: type_bc, FLAV_UDSG: type_udsg }
+    self.systypes = systypes
+    self.entries  = { (s,f): [ ] for s in systypes for f in measurements } # (systype, FLAV) -> list of bins
+    with open(csvname,'r') as file:
+      for line in file:
+        if line.count('"')<2: continue # header
+        fields   = [f.strip() for f in line.split('"')[0].split(',')]
+        formula  = line.split('"')[1].replace('TMath::','')
+        opfield  = fields[0]
+        opfield  = self.operatingpoints[opfield] if opfield in self.operatingpoints else int(opfield)
+        systype  = fields[2]
+        flavor   = int(fields[3])
+        if opfield!=op or (systype,flavor) not in self.entries or fields[1]!=measurements[flavor]: continue
+        etamin, etamax, ptmin, ptmax = [float(f) for f in fields[4:8]]
+        code     = compile(formula,csvname,'eval',__future__.division.compiler_flag,True)
+        self.entries[(systype,flavor)].append((etamin,etamax,ptmin,ptmax,code))
+    for (systype,flavor), bins in self.entries.iteritems():
+      if not bins:
+        LOG.warning("BTagCalibrationArray: No %r SFs for flavor %s in %s!"%(systype,flavor,csvname))
+  
+  def eval(self, FLAV, eta, pt, systype='central'):
+    """Evaluate SFs for arrays of BTagEntry flavors, eta and pt."""
+    sfs  = np.zeros(len(pt))
+    done = np.zeros(len(pt),dtype=bool)
+    for flavor in np.unique(FLAV):
+      isflav = (FLAV==flavor)
+      for etamin, etamax, ptmin, ptmax, code in self.entries[(systype,flavor)]:
+        mask = isflav & ~done & (etamin<=eta) & (eta<=etamax) & (ptmin<pt) & (pt<=ptmax)
+        if not mask.any(): continue
+        sfs[mask]  = eval(code,dict(self.functions,x=pt[mask]))
+        done[mask] = True
+    return sfs
+  
+
 class BTagWeightTool:
   
   def __init__(self, tagger, wp='medium', channel='mutau', year=2017, maxeta=2.4, loadsys=False, type_bc='comb'):
@@ -93,8 +140,10 @@ class BTagWeightTool:
     self.wpname = wp
     self.wp     = getattr(BTagWPs(tagger,year),wp)
     if 'deep' in tagger.lower():
+      self.tagbranch = 'btagDeepB'
       tagged = lambda j: j.btagDeepB>self.wp
     else:
+      self.tagbranch = 'btagCSVV2'
       tagged = lambda j: j.btagCSVV2>self.wp
     
     # CSV READER
@@ -112,14 +161,17 @@ class BTagWeightTool:
       reader.load(calib,FLAV_B,   type_bc)
       reader.load(calib,FLAV_C,   type_bc)
       reader.load(calib,FLAV_UDSG,type_udsg)
+    systypes       = { 'Nom': 'central', 'Up': 'up', 'Down': 'down' }
+    systypes       = { u: systypes[u] for u in readers }
+    sfarray        = BTagCalibrationArray(csvname,op,systypes.values(),type_bc,type_udsg) # for getWeights
     
     # EFFICIENCIES
     hists      = { } # histograms to compute the b tagging efficiencies in MC
-    effmaps    = { } # b tag efficiencies in MC to compute b tagging weight for an event
-    efffile    = ensureTFile(effname)
+    efftables  = { } # b tag efficiencies in MC to compute b tagging weight for an event
+    efffname   = effname
     default    = False
-    if not efffile:
-      LOG.warning("File %s with efficiency histograms does not exist! Reverting to default efficiency histogram..."%(effname))
+    if not os.path.isfile(efffname):
+      LOG.warning("File %s with efficiency histograms does not exist! Reverting to default efficiency histogram..."%(efffname))
       default  = True
     for flavor in [0,4,5]:
       flavor   = flavorToString(flavor)
@@ -127,29 +179,32 @@ class BTagWeightTool:
       effname  = "%s/eff_%s_%s_%s"%(channel,tagger,flavor,wp)
       hists[flavor]        = getEffMap(histname)        # numerator   = b tagged jets
       hists[flavor+'_all'] = getEffMap(histname+'_all') # denominator = all jets
-      if efffile:
-        effmaps[flavor]    = efffile.Get(effname)
-        if not effmaps[flavor]:
-          LOG.warning("Histogram '%s' does not exist in %s! Reverting to default efficiency histogram..."%(effname,efffile.GetName()))
-          default          = True
-          effmaps[flavor]  = getDefaultEffMap(effname,flavor,wp)
-      else:
-        effmaps[flavor]    = getDefaultEffMap(effname,flavor,wp)
-      effmaps[flavor].SetDirectory(0)
-    efffile.Close()
+      efftables[flavor]    = None
+      if os.path.isfile(efffname):
+        try:
+          efftables[flavor] = LookupTable.load(efffname,effname) # from bundle, if available
+        except IOError:
+          LOG.warning("Histogram '%s' does not exist in %s! Reverting to default efficiency histogram..."%(effname,efffname))
+      if not efftables[flavor]:
+        default            = True
+        efftables[flavor]  = LookupTable(getDefaultEffMap(effname,flavor,wp))
     
     if default:
       LOG.warning("Made use of default efficiency histograms! The b tag weights from this module should be regarded as placeholders only,\n"+\
                   "and should NOT be used for analyses. B (mis)tag efficiencies in MC are analysis dependent. Please create your own\n"+\
                   "efficiency histogram with data/btag/getBTagEfficiencies.py after running all MC samples with BTagWeightTool.")
     
-    self.tagged  = tagged
-    self.calib   = calib
-    self.readers = readers
-    self.loadsys = loadsys
-    self.hists   = hists
-    self.effmaps = effmaps
-    self.maxeta  = maxeta
+    self.tagged    = tagged
+    self.calib     = calib
+    self.readers   = readers
+    self.systypes  = systypes
+    self.sfarray   = sfarray
+    self.loadsys   = loadsys
+    self.hists     = hists
+    self.effbuffer = [ ] # buffered (pt, eta, flavor, tagged) of jets for the efficiency maps
+    self.maxbuffer = 100000 # number of jets buffered before filling the histograms
+    self.efftables = efftables
+    self.maxeta    = maxeta
   
   def getWeight(self,jets,unc='Nom'):
     """Get b tagging event weight for a given set of jets."""
@@ -159,6 +214,39 @@ class BTagWeightTool:
         weight *= self.getSF(jet.pt,jet.eta,jet.partonFlavour,self.tagged(jet),unc=unc)
     return weight
   
+  def getWeights(self,pt,eta,flavor,tagged,counts=None):
+    """Get b tagging event weights for arrays of jet pt, eta, flavor and tagged (b tag discriminator
+    above WP), e.g. for all selected jets in a chunk of events, with counts the number of jets per event.
+    Return dictionary of the nominal ('Nom') and, if loaded, 'Up' and 'Down' weights as arrays per event,
+    or as floats for a single event if counts is not given."""
+    pt      = np.asarray(pt,dtype=np.float64)
+    eta     = np.asarray(eta,dtype=np.float64)
+    flavor  = np.abs(np.asarray(flavor))
+    tagged  = np.asarray(tagged,dtype=bool)
+    inside  = abs(eta)<self.maxeta
+    eta     = np.where(eta>=+2.4,+2.399,np.where(eta<=-2.4,-2.399,eta)) # reader returns zero if |eta| > 2.4
+    FLAV    = np.where(flavor==5,FLAV_B,np.where((flavor==4) | (flavor==15),FLAV_C,FLAV_UDSG))
+    eff     = self.getEff(pt,eta,flavor)
+    untag   = ~tagged & inside
+    if (untag & (eff==1)).any():
+      LOG.warning("BTagWeightTool.getWeights: MC efficiency is 1 for %d jets"%((untag & (eff==1)).sum()))
+    single  = counts is None
+    counts  = np.asarray([len(pt)] if single else counts)
+    starts  = np.cumsum(counts)-counts
+    filled  = counts>0
+    weights = { }
+    for unc, systype in self.systypes.iteritems():
+      sf = self.sfarray.eval(FLAV,abs(eta),pt,systype)
+      with np.errstate(divide='ignore',invalid='ignore'):
+        jetweights = np.where(tagged,sf,np.where(eff==1,1.,(1.-sf*eff)/(1.-eff)))
+      jetweights[~inside] = 1.
+      weights[unc] = np.ones(len(counts))
+      if filled.any():
+        weights[unc][filled] = np.multiply.reduceat(jetweights,starts[filled])
+    if single:
+      weights = { u: float(w[0]) for u, w in weights.iteritems() }
+    return weights
+  
   def getSF(self,pt,eta,flavor,tagged,unc='Nom'):
     """Get b tag SF for a single jet."""
     FLAV = flavorToFLAV(flavor)
@@ -177,32 +265,53 @@ class BTagWeightTool:
     return weight
   
   def getEff(self,pt,eta,flavor):
-    """Get b tag efficiency for a single jet in MC."""
-    flavor = flavorToString(flavor)
-    hist   = self.effmaps[flavor]
-    xbin   = hist.GetXaxis().FindBin(pt)
-    ybin   = hist.GetYaxis().FindBin(eta)
-    if xbin==0: xbin = 1
-    elif xbin>hist.GetXaxis().GetNbins(): xbin -= 1
-    if ybin==0: ybin = 1
-    elif ybin>hist.GetYaxis().GetNbins(): ybin -= 1
-    eff    = hist.GetBinContent(xbin,ybin)
+    """Get b tag efficiency for a single jet in MC, or for arrays of jets."""
+    if np.ndim(flavor)>0:
+      flavor = np.abs(flavor)
+      eff    = self.efftables['udsg'](pt,eta)
+      eff    = np.where(flavor==4,self.efftables['c'](pt,eta),eff)
+      eff    = np.where(flavor==5,self.efftables['b'](pt,eta),eff)
+      return eff
+    eff    = self.efftables[flavorToString(flavor)](pt,eta)
     ###if eff==1:
     ###  print "Warning! BTagWeightTool.getEff: MC efficiency is 1 for pt=%s, eta=%s, flavor=%s, sf=%s"%(pt,eta,flavor,sf)
     return eff
   
   def fillEffMaps(self,jets,usejec=False):
     """Fill histograms to make efficiency map for MC, split by true jet flavor,
-    and jet pT and eta. Numerator = b tagged jets; denominator = all jets."""
+    and jet pT and eta. Numerator = b tagged jets; denominator = all jets.
+    Jets are buffered, and binned in bulk by flushEffMaps."""
     for jet in jets:
       jetpt  = jet.pt_nom if usejec else jet.pt
-      flavor = flavorToString(jet.partonFlavour)
-      if self.tagged(jet):
-        self.hists[flavor].Fill(jetpt,jet.eta)
-      self.hists[flavor+'_all'].Fill(jetpt,jet.eta)
+      self.effbuffer.append((jetpt,jet.eta,jet.partonFlavour,self.tagged(jet)))
+    if len(self.effbuffer)>=self.maxbuffer:
+      self.flushEffMaps()
+  
+  def fillEffMapArrays(self,pt,eta,flavor,tagged):
+    """Fill efficiency map histograms for arrays of jet pt, eta, flavor and tagged at once with numpy.
+    Like TH2.Fill, values outside the binning are added to the under- and overflow bins."""
+    pt      = np.asarray(pt,dtype=np.float64)
+    eta     = np.asarray(eta,dtype=np.float64)
+    flavor  = np.abs(np.asarray(flavor))
+    tagged  = np.asarray(tagged,dtype=bool)
+    flavors = { 'b': flavor==5, 'c': flavor==4 }
+    flavors['udsg'] = ~(flavors['b'] | flavors['c'])
+    for flavor, isflav in flavors.iteritems():
+      for histname, mask in [(flavor,isflav & tagged),(flavor+'_all',isflav)]:
+        if mask.any():
+          addToHist(self.hists[histname],pt[mask],eta[mask])
+  
+  def flushEffMaps(self):
+    """Fill the buffered jets into the efficiency map histograms."""
+    if not self.effbuffer: return
+    pt, eta, flavor, tagged = zip(*self.effbuffer)
+    self.fillEffMapArrays(pt,eta,flavor,tagged)
+    self.effbuffer = [ ]
   
   def setDir(self,directory,subdirname=None):
-    """Set directory of histograms (efficiency map) before writing."""
+    """Set directory of histograms (efficiency map) before writing.
+    Buffered jets are filled first, so call this at the end of the job."""
+    self.flushEffMaps()
     if subdirname:
       subdir = directory.Get(subdirname)
       if not subdir:
@@ -235,6 +344,24 @@ def getEffMap(histname):
   return hist
   
 
+def addToHist(hist,xvals,yvals):
+  """Help function to add arrays of (x,y) entries to a TH2 with numpy's histogram2d,
+  including the under- and overflow bins, like calling TH2.Fill for each entry."""
+  xaxis, yaxis = hist.GetXaxis(), hist.GetYaxis()
+  xbins  = [-np.inf]+[xaxis.GetBinLowEdge(i) for i in xrange(1,xaxis.GetNbins()+2)]+[np.inf]
+  ybins  = [-np.inf]+[yaxis.GetBinLowEdge(i) for i in xrange(1,yaxis.GetNbins()+2)]+[np.inf]
+  counts = np.histogram2d(xvals,yvals,bins=[xbins,ybins])[0]
+  sumw2  = hist.GetSumw2N()>0
+  nevts  = hist.GetEntries()+len(xvals) # SetBinContent increments the number of entries
+  for xbin, ybin in zip(*np.nonzero(counts)):
+    xbin, ybin = int(xbin), int(ybin)
+    count = counts[xbin,ybin]
+    if sumw2:
+      hist.SetBinError(xbin,ybin,np.sqrt(hist.GetBinError(xbin,ybin)**2+count))
+    hist.SetBinContent(xbin,ybin,hist.GetBinContent(xbin,ybin)+count)
+  hist.SetEntries(nevts)
+  
+
 def getDefaultEffMap(histname,flavor,wp='medium'):
   """Create default efficiency histograms. WARNING! Do not use this for analysis! Use it as a placeholder,
   until you have made an efficiency map from MC for you analysis."""
@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# Description: Cache the histograms of the correction tools as numpy arrays in one bundle per era,
+#              so jobs do not need to open dozens of ROOT files at startup (see LookupTable.load).
+#              Entries are read from the source file instead if its checksum changed.
+#              Build the bundles in advance with
+#                python python/corrections/CorrectionBundle.py -y 2016 2017 2018
+#              Jobs only read the bundle, unless it is opened with readonly=False.
+import os, json, hashlib, socket
+import numpy as np
+from TauFW.PicoProducer import datadir
+from TauFW.common.tools.log import Logger
+bundledir = os.path.join(datadir,"bundles")
+LOG       = Logger('CorrectionBundle',showname=True)
+_bundle   = None # active bundle
+
+
+def checksum(fname,blocksize=1<<20):
+  """Compute MD5 checksum of a file."""
+  md5 = hashlib.md5()
+  with open(fname,'rb') as file:
+    for block in iter(lambda: file.read(blocksize),b''):
+      md5.update(block)
+  return md5.hexdigest()
+  
+
+class CorrectionBundle(object):
+  """Bundle of histogram arrays (bin edges and contents) in a single numpy file,
+  with metadata of the source file, histogram name and checksum of the source file per entry.
+  Arrays are only read from the bundle when they are needed.
+  A read-only bundle is never saved, so jobs do not write to the shared source tree."""
+  
+  def __init__(self, era, fname=None, readonly=True, verb=0):
+    self.era       = era
+    self.fname     = fname or os.path.join(bundledir,"corrections_%s.npz"%(era))
+    self.readonly  = readonly
+    self.verbosity = verb
+    self.data      = None # lazy NpzFile
+    self.meta      = { }  # entry key -> metadata
+    self.new       = { }  # entry key -> (edges, values), added since loading
+    self.checksums = { }  # source file -> checksum, computed once
+    if os.path.isfile(self.fname):
+      try:
+        self.data = np.load(self.fname)
+        self.meta = json.loads(str(self.data['meta']))
+      except (IOError,ValueError,KeyError) as error:
+        LOG.warning("Could not load correction bundle %s: %s. Reading the source files..."%(self.fname,error))
+        self.data = None
+        self.meta = { }
+  
+  def __repr__(self):
+    return '<%s(%r) at %s>'%(self.__class__.__name__,self.fname,hex(id(self)))
+  
+  @staticmethod
+  def getkey(fname, histname):
+    return "%s:%s"%(os.path.realpath(fname),histname)
+  
+  def getchecksum(self, fname):
+    fname = os.path.realpath(fname)
+    if fname not in self.checksums:
+      self.checksums[fname] = checksum(fname)
+    return self.checksums[fname]
+  
+  def isuptodate(self, entry, fname):
+    """Check if the source file is unchanged: compare size and modification time first,
+    and only compute the checksum if they differ (e.g. for a fresh checkout)."""
+    stat = os.stat(fname)
+    if entry.get('size',None)==stat.st_size and entry.get('mtime',None)==stat.st_mtime:
+      return True
+    return entry['checksum']==self.getchecksum(fname)
+  
+  def get(self, fname, histname):
+    """Return bin edges and contents of a histogram, or None if it is missing or outdated."""
+    key   = self.getkey(fname,histname)
+    entry = self.meta.get(key,None)
+    if entry==None or not os.path.isfile(fname):
+      return None
+    if not self.isuptodate(entry,fname):
+      LOG.warning("Source file %s of %r changed! Reading it instead of the correction bundle %s..."%(fname,histname,self.fname))
+      return None
+    if key in self.new:
+      return self.new[key]
+    index  = entry['index']
+    edges  = [self.data['edges%d_%d'%(index,i)] for i in xrange(entry['ndim'])]
+    values = self.data['values%d'%(index)]
+    if self.verbosity>=1:
+      print ">>> CorrectionBundle.get: Loaded %r from %s"%(histname,self.fname)
+    return edges, values
+  
+  def add(self, fname, histname, edges, values):
+    """Add bin edges and contents of a histogram from a source file."""
+    key  = self.getkey(fname,histname)
+    stat = os.stat(fname)
+    self.new[key]  = (edges,values)
+    self.meta[key] = { 'file': os.path.realpath(fname), 'hist': histname, 'checksum': self.getchecksum(fname),
+                       'size': stat.st_size, 'mtime': stat.st_mtime, 'ndim': len(edges), 'index': -1 }
+  
+  def save(self):
+    """Write bundle to file if entries were added. The file is replaced atomically,
+    so parallel jobs never read an incomplete bundle."""
+    if not self.new:
+      return False
+    if self.readonly:
+      LOG.warning("Correction bundle %s is missing or outdated for %d histograms. Please rebuild it with"%(self.fname,len(self.new))+\
+                  "\n  python python/corrections/CorrectionBundle.py -y %s"%(self.era))
+      return False
+    arrays = { }
+    meta   = { }
+    for index, key in enumerate(sorted(self.meta)):
+      entry = self.meta[key]
+      if key in self.new:
+        edges, values = self.new[key]
+      else:
+        edges  = [self.data['edges%d_%d'%(entry['index'],i)] for i in xrange(entry['ndim'])]
+        values = self.data['values%d'%(entry['index'])]
+      for i, edge in enumerate(edges):
+        arrays['edges%d_%d'%(index,i)] = edge
+      arrays['values%d'%(index)] = values
+      meta[key] = dict(entry,index=index)
+    arrays['meta'] = np.array(json.dumps(meta))
+    tmpname = "%s.%s.%d.tmp.npz"%(self.fname[:-4],socket.gethostname(),os.getpid()) # unique on shared file systems
+    try:
+      if not os.path.isdir(os.path.dirname(self.fname)):
+        os.makedirs(os.path.dirname(self.fname))
+      np.savez(tmpname,**arrays)
+      os.rename(tmpname,self.fname)
+    except (IOError,OSError) as error:
+      LOG.warning("Could not write correction bundle %s: %s"%(self.fname,error))
+      return False
+    print ">>> Saved %d corrections to bundle %s"%(len(meta),self.fname)
+    self.data = np.load(self.fname)
+    self.meta = meta
+    self.new  = { }
+    return True
+  
+
+def openbundle(era, **kwargs):
+  """Set active bundle, used by LookupTable.load while the correction tools are created.
+  It is read-only by default; use readonly=False to save missing or outdated entries in closebundle."""
+  global _bundle
+  if _bundle==None or _bundle.era!=era or _bundle.readonly!=kwargs.get('readonly',True):
+    _bundle = CorrectionBundle(era,**kwargs)
+  return _bundle
+  
+
+def getbundle():
+  """Return active bundle, or None."""
+  return _bundle
+  
+
+def closebundle():
+  """Save the active bundle if corrections were (re)built and it is not read-only, and deactivate it."""
+  global _bundle
+  if _bundle!=None:
+    _bundle.save()
+  _bundle = None
+  
+
+def buildbundle(era, channels=['mutau','etau'], verb=0):
+  """Build the bundle for an era by creating all correction tools that use histograms."""
+  from TauFW.PicoProducer.corrections.MuonSFs import MuonSFs
+  from TauFW.PicoProducer.corrections.ElectronSFs import ElectronSFs
+  from TauFW.PicoProducer.corrections.PileupTool import PileupWeightTool
+  from TauFW.PicoProducer.corrections.RecoilCorrectionTool import ZptCorrectionTool
+  from TauFW.PicoProducer.corrections.BTagTool import BTagWeightTool
+  year = int(era)
+  openbundle(era,readonly=False,verb=verb)
+  MuonSFs(year=year)
+  ElectronSFs(year=year)
+  ZptCorrectionTool(year=year)
+  for sigma in ['central','up','down']:
+    PileupWeightTool(year=year,sigma=sigma)
+  for channel in channels:
+    BTagWeightTool('DeepCSV','medium',channel=channel,year=year)
+  closebundle()
+  
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="Build bundles of correction histograms per era.")
+  parser.add_argument('-y','--era',     dest='eras', nargs='+', default=['2016','2017','2018'],
+                                        help="eras to build, default=%(default)s")
+  parser.add_argument('-c','--channel', dest='channels', nargs='+', default=['mutau','etau'],
+                                        help="channels for b tag efficiencies, default=%(default)s")
+  parser.add_argument('-v','--verbose', dest='verbosity', type=int, nargs='?', const=1, default=0,
+                                        help="set verbosity" )
+  args = parser.parse_args()
+  for era in args.eras:
+    buildbundle(era,channels=args.channels,verb=args.verbosity)
+  
@@ -1,8 +1,10 @@
 # Author: Izaak Neutelings (November 2018)
 import os, re
+import numpy as np
 from TauFW.PicoProducer import datadir
 from TauFW.common.tools.file import ensureTFile
 from TauFW.common.tools.log import Logger
+from TauFW.PicoProducer.corrections.ScaleFactorTool import LookupTable
 datadir = os.path.join(datadir,"pileup")
 LOG     = Logger('PileupTool',showname=True)
 
@@ -40,22 +42,23 @@ class PileupWeightTool:
       mcfilename   = os.path.join(datadir,"MC_PileUp_%d_FlatPU0to75.root"%year)
     
     print "Loading PileupWeightTool for '%s' and '%s'"%(datafilename,mcfilename)
-    self.datafile = ensureTFile(datafilename, 'READ')
-    self.mcfile   = ensureTFile(mcfilename, 'READ')
-    self.datahist = self.datafile.Get('pileup')
-    self.mchist   = self.mcfile.Get('pileup')
-    self.datahist.SetDirectory(0)
-    self.mchist.SetDirectory(0)
-    self.datahist.Scale(1./self.datahist.Integral())
-    self.mchist.Scale(1./self.mchist.Integral())
-    self.datafile.Close()
-    self.mcfile.Close()
+    self.datatable = LookupTable.load(datafilename,'pileup',clamp=False)
+    self.mctable   = LookupTable.load(mcfilename,'pileup',clamp=False)
+    for table in [self.datatable,self.mctable]: # normalize, like TH1::Scale(1./TH1::Integral())
+      table.values = table.values/table.values[1:-1].sum()
     
   
   def getWeight(self,npu):
-    """Get pileup weight for a given number of pileup interactions."""
-    data = self.datahist.GetBinContent(self.datahist.GetXaxis().FindBin(npu))
-    mc   = self.mchist.GetBinContent(self.mchist.GetXaxis().FindBin(npu))
+    """Get pileup weight for a given number of pileup interactions, or an array of them."""
+    data = self.datatable(npu)
+    mc   = self.mctable(npu)
+    if np.ndim(mc)>0:
+      weights = np.ones(len(mc))
+      valid   = mc>0.
+      weights[valid] = np.minimum(data[valid]/mc[valid],5.)
+      if not valid.all():
+        LOG.warning("PileupWeightTools.getWeight: Could not make pileup weight for npu=%s"%(np.asarray(npu)[~valid]))
+      return weights
     if mc>0.:
       ratio = data/mc
       if ratio>5.: return 5.
@@ -3,9 +3,10 @@
 #  https://twiki.cern.ch/twiki/bin/view/CMS/L1ECALPrefiringWeightRecipe
 #  https://github.com/cms-nanoAOD/nanoAOD-tools/blob/master/python/postprocessing/modules/common/PrefireCorr.py
 import os
-from math import sqrt
-from corrections import modulepath, extractTH1
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection 
+import numpy as np
+from TauFW.common.tools.file import ensureTFile
+from TauFW.PicoProducer.corrections.ScaleFactorTool import LookupTable
+from TauFW.PicoProducer.analysis.columnar import Jagged, getarray
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 path = os.path.join(os.getenv('CMSSW_BASE'),"src/PhysicsTools/NanoAODTools/data/prefire_maps/")
 
@@ -19,8 +20,8 @@ class PreFireTool():
         jethistname       = "L1prefiring_jetpt_%s"%dataset
         photonhistname    = "L1prefiring_photonpt_%s"%dataset
         
-        self.jetmap       = extractTH1(jetfilename,   jethistname)
-        self.photonmap    = extractTH1(photonfilename,photonhistname)
+        self.jetmaps      = getPrefireMaps(jetfilename,   jethistname)
+        self.photonmaps   = getPrefireMaps(photonfilename,photonhistname)
         ###self.UseEMpT      = "jetempt" in jetroot
         self.JetMinPt     = 20 # Min/Max Values may need to be fixed for new maps
         self.JetMaxPt     = 500
@@ -30,86 +31,101 @@ class PreFireTool():
         self.PhotonMaxPt  = 500
         self.PhotonMinEta = 2.0
         self.PhotonMaxEta = 3.0
+        self.branches     = [ 'Jet_pt', 'Jet_eta', 'Photon_pt', 'Photon_eta', 'Photon_jetIdx', 'Photon_electronIdx',
+                              'Electron_pt', 'Electron_eta', 'Electron_jetIdx', 'Electron_photonIdx' ]
         
     
     def getWeight(self, event):
-        """Get pre-fire weight"""
-        
-        # WEIGHTS
-        weightDown = 1.
-        weightNom  = 1.
-        weightUp   = 1.
-        
-        # LOOP over JETS
-        jets = Collection(event,'Jet')
-        for jid, jet in enumerate(jets): # First loop over all jets
-          jetpt = jet.pt
-          ###if self.UseEMpT:
-          ###  jetpt *= (jet.chEmEF + jet.neEmEF)
-          
-          if jetpt>=self.JetMinPt and self.JetMinEta<=abs(jet.eta)<=self.JetMaxEta:
-            pfProbDown, pfProbNom, pfProbUp = self.getPrefireProbability(self.jetmap,jet.eta,jetpt,self.JetMaxPt)
-            jetWeightDown = 1.-pfProbDown
-            jetWeightNom  = 1.-pfProbNom
-            jetWeightUp   = 1.-pfProbUp
-          else:
-            jetWeightDown = 1.0
-            jetWeightNom  = 1.0
-            jetWeightUp   = 1.0
-          
-          # The higher prefire-probablity between the jet and the lower-pt photon(s)/elecron(s) from the jet is chosen
-          egWeightDown, egWeightNom, egWeightUp = self.getEGPrefireWeight(event,jid)
-          weightDown *= min(jetWeightDown,egWeightDown)
-          weightNom  *= min(jetWeightNom, egWeightNom)
-          weightUp   *= min(jetWeightUp,  egWeightUp)
-        
-        # Then loop over all photons/electrons not associated to jets
-        egWeightDown, egWeightNom, egWeightUp = self.getEGPrefireWeight(event,-1)
-        weightDown *= egWeightDown
-        weightNom  *= egWeightNom
-        weightUp   *= egWeightUp
-        
-        return weightDown, weightNom, weightUp
+        """Get pre-fire weights (Down, Nom, Up) of a single event."""
+        arrays  = { }
+        for branch in self.branches:
+          collection = branch.split('_')[0]
+          dtype      = np.int64 if 'Idx' in branch else np.float64
+          count      = getattr(event,'n'+collection)
+          arrays[branch] = Jagged(getarray(getattr(event,branch),count,dtype),[count])
+        return tuple(float(w[0]) for w in self.getWeights(arrays))
         
     
-    def getEGPrefireWeight(self, event, jid):
-        egWeightDown = 1.0
-        egWeightNom  = 1.0
-        egWeightUp   = 1.0
-        photonInJet  = [ ]
+    def getWeights(self, arrays):
+        """Get pre-fire weights (Down, Nom, Up) as arrays for a chunk of events, given a dictionary of
+        the jagged arrays of the branches in self.branches (see analysis/columnar.py).
+        The probabilities of all jets, photons and electrons are looked up at once. For each jet,
+        the higher prefire probability between the jet and the photons/electrons in that jet is chosen.
+        Photons/electrons not associated to any jet are included separately."""
+        jets      = arrays['Jet_pt']
+        photons   = arrays['Photon_pt']
+        electrons = arrays['Electron_pt']
+        njets     = len(jets.content)
+        nphotons  = len(photons.content)
+        nevts     = len(jets)
         
-        # LOOP over PHOTONS
-        for pid, pho in enumerate(Collection(event,'Photon')):
-          if pho.jetIdx==jid and pho.pt>=self.PhotonMinPt and self.PhotonMinEta<=abs(pho.eta)<=self.PhotonMaxEta:
-            phoProbDown, phoProbNom, phoProbUp = self.getPrefireProbability(self.photonmap,pho.eta,pho.pt,self.PhotonMaxPt)
-            eleProbDown, eleProbNom, eleProbUp = 1., 1., 1.
-            if pho.electronIdx>-1: # What if the electron corresponding to the photon would return a different value?
-              if event.Electron_pt[pho.electronIdx]>=self.PhotonMinPt and self.PhotonMinEta<=abs(event.Electron_eta[pho.electronIdx])<=self.PhotonMaxEta:
-                eleProbDown, eleProbNom, eleProbUp = self.getPrefireProbability(self.photonmap,event.Electron_eta[pho.electronIdx],event.Electron_pt[pho.electronIdx],self.PhotonMaxPt)
+        # PROBABILITIES of jets, and of photons & electrons
+        jetprobs  = self.getPrefireProbabilities(self.jetmaps,self.JetMinPt,self.JetMaxPt,self.JetMinEta,self.JetMaxEta,
+                                                 jets.content,arrays['Jet_eta'].content)
+        egprobs   = self.getPrefireProbabilities(self.photonmaps,self.PhotonMinPt,self.PhotonMaxPt,self.PhotonMinEta,self.PhotonMaxEta,
+                                                 np.concatenate([photons.content,electrons.content]),
+                                                 np.concatenate([arrays['Photon_eta'].content,arrays['Electron_eta'].content]))
+        egprobs   = np.append(egprobs,-np.ones((3,1)),axis=1) # dummy for missing objects (index -1)
+        phoprobs  = egprobs[:,:nphotons]
+        eleprobs  = egprobs[:,nphotons:]
+        phopassed = phoprobs[1]>=0
+        phojetidx = arrays['Photon_jetIdx'].content
+        elejetidx = arrays['Electron_jetIdx'].content
             
-            # Choose higher prefire-probablity between the photon and corresponding electron
-            egWeightDown *= 1.-max(phoProbDown,eleProbDown)
-            egWeightNom  *= 1.-max(phoProbNom, eleProbNom)
-            egWeightUp   *= 1.-max(phoProbUp,  eleProbUp)
-            photonInJet.append(pid)
+        # PHOTONS: choose higher prefire probability between the photon and corresponding electron
+        ieles     = arrays['Photon_electronIdx'].content
+        ieles     = np.where(ieles>-1,electrons.starts[photons.parents]+ieles,-1)
+        phoprobs  = np.where(phopassed,np.maximum(phoprobs,eleprobs[:,ieles]),0.)
+        
+        # ELECTRONS: skip if the corresponding photon is already included for the same jet
+        iphos     = arrays['Electron_photonIdx'].content
+        iphos     = np.where(iphos>-1,photons.starts[electrons.parents]+iphos,-1)
+        inphoton  = np.append(phopassed,False)[iphos] & (np.append(phojetidx,-2)[iphos]==elejetidx)
+        eleprobs  = np.where((eleprobs[:,:-1]>=0) & ~inphoton,eleprobs[:,:-1],0.)
         
-        # LOOP over ELECTRONS
-        for ele in Collection(event,'Electron'):
-          if ele.jetIdx == jid and ele.photonIdx not in photonInJet and ele.pt>=self.PhotonMinPt and self.PhotonMinEta<=abs(ele.eta)<=self.PhotonMaxEta:
-            pfProbDown, pfProbNom, pfProbUp = self.getPrefireProbability(self.photonmap,ele.eta,ele.pt,self.PhotonMaxPt)
-            egWeightDown *= 1.-pfProbDown
-            egWeightNom  *= 1.-pfProbNom
-            egWeightUp   *= 1.-pfProbUp
+        # GROUP photons & electrons per jet: index of jet, or njets + event index if not in any jet
+        groups    = np.concatenate([
+          np.where(phojetidx>-1,jets.starts[photons.parents]+phojetidx,njets+photons.parents),
+          np.where(elejetidx>-1,jets.starts[electrons.parents]+elejetidx,njets+electrons.parents) ])
+        egweights = np.ones((3,njets+nevts))
+        for i, probs in enumerate(np.concatenate([phoprobs,eleprobs],axis=1)):
+          np.multiply.at(egweights[i],groups,1.-probs)
         
-        return egWeightDown, egWeightNom, egWeightUp
+        # EVENT WEIGHTS
+        jetweights = np.minimum(1.-np.where(jetprobs>=0,jetprobs,0.),egweights[:,:njets])
+        weights    = egweights[:,njets:].copy()
+        for i in xrange(3):
+          np.multiply.at(weights[i],jets.parents,jetweights[i])
+        return weights[0], weights[1], weights[2]
         
     
-    def getPrefireProbability(self, map, eta, pt, maxpt):
-      bin      = map.FindBin(eta,min(pt,maxpt-0.01))
-      prob     = map.GetBinContent(bin)
-      stat     = map.GetBinError(bin) # bin statistical uncertainty
-      syst     = 0.2*prob # 20% of prefire rate
-      probDown = max(prob-sqrt(stat*stat+syst*syst),0.0)
-      probUp   = min(prob+sqrt(stat*stat+syst*syst),1.0)
-      return probDown, prob, probUp
+    def getPrefireProbabilities(self, maps, minpt, maxpt, mineta, maxeta, pt, eta):
+        """Look up the prefire probabilities (Down, Nom, Up) for arrays of objects, shape (3,nobjects);
+        objects that fail the pt and eta requirements get -1."""
+        pt       = np.asarray(pt,dtype=np.float64)
+        eta      = np.asarray(eta,dtype=np.float64)
+        passed   = (pt>=minpt) & (mineta<=abs(eta)) & (abs(eta)<=maxeta)
+        probmap, errmap = maps
+        pt_      = np.minimum(pt,maxpt-0.01)
+        prob     = probmap(eta,pt_)
+        stat     = errmap(eta,pt_) # bin statistical uncertainty
+        syst     = 0.2*prob # 20% of prefire rate
+        unc      = np.sqrt(stat*stat+syst*syst)
+        probs    = np.array([np.maximum(prob-unc,0.0),prob,np.minimum(prob+unc,1.0)]).reshape(3,len(pt))
+        return np.where(passed,probs,-1.)
       
+
+def getPrefireMaps(filename, histname):
+  """Help function to convert a prefire map (TH2 of eta vs. pt) to lookup tables
+  of the probability and its statistical uncertainty."""
+  file    = ensureTFile(filename)
+  hist    = file.Get(histname)
+  if not hist:
+    raise IOError('getPrefireMaps: histogram "%s" does not exist in "%s"'%(histname,filename))
+  probmap = LookupTable(hist,clamp=False)
+  nxbins, nybins = probmap.values.shape
+  errors  = np.array([[hist.GetBinError(i,j) for j in xrange(nybins)] for i in xrange(nxbins)])
+  errmap  = LookupTable((probmap.edges,errors),clamp=False,name=histname+'_err')
+  file.Close()
+  return probmap, errmap
+  
@@ -9,6 +9,7 @@ from math import sqrt, exp
 from ctypes import c_float
 from TauFW.PicoProducer import datadir
 from TauFW.common.tools.file import ensureTFile
+from TauFW.PicoProducer.corrections.ScaleFactorTool import LookupTable
 from TauFW.PicoProducer.analysis.utils import hasbit
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 import ROOT
@@ -31,24 +32,12 @@ class ZptCorrectionTool:
     else:
       filename = zptpath+"Zpt_weights_2018.root"
     
-    file    = ensureTFile(filename,'READ')
-    hist = file.Get('zptmass_weights')
-    hist.SetDirectory(0)
-    file.Close()
-    
-    self.hist      = hist
+    self.table     = LookupTable.load(filename,'zptmass_weights')
     self.filename  = filename
     
   def getZptWeight(self,Zpt,Zmass):
-    """Get Z pT weight for a given Z boson pT and mass."""
-    xbin = self.hist.GetXaxis().FindBin(Zmass)
-    ybin = self.hist.GetYaxis().FindBin(Zpt)
-    if xbin==0: xbin = 1
-    elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-    if ybin==0: ybin = 1
-    elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-    weight = self.hist.GetBinContent(xbin,ybin)
-    return weight
+    """Get Z pT weight for a given Z boson pT and mass, or for arrays of them."""
+    return self.table(Zmass,Zpt)
   
 
 
@@ -1,6 +1,67 @@
 # Author: Izaak Neutelings (November 2018)
 import os, re
+import numpy as np
 from TauFW.common.tools.file import ensureTFile
+from TauFW.PicoProducer.corrections.CorrectionBundle import getbundle
+
+
+class LookupTable(object):
+  """Convert a TH1 or TH2 once to numpy arrays of bin edges and contents, to look up values
+  without PyROOT calls, for single values, or for whole arrays at once (e.g. for all muons in a chunk).
+  Bins are found like TAxis::FindBin; if clamp=True, under- and overflow are moved to the first and last bin.
+  Instead of a histogram, a tuple of the list of bin edges and the contents (with under- and overflow) can be given."""
+  
+  def __init__(self, hist, clamp=True, name=None):
+    self.clamp  = clamp
+    if isinstance(hist,tuple): # arrays, e.g. from CorrectionBundle
+      self.name = name
+      self.edges, self.values = hist
+      return
+    self.name   = name or hist.GetName()
+    axes        = [hist.GetXaxis(),hist.GetYaxis()][:hist.GetDimension()]
+    self.edges  = [np.array([a.GetBinLowEdge(i) for i in xrange(1,a.GetNbins()+2)]) for a in axes]
+    nxbins      = hist.GetXaxis().GetNbins()+2 # including under- and overflow
+    if len(axes)==1:
+      self.values = np.array([hist.GetBinContent(i) for i in xrange(nxbins)])
+    else:
+      nybins      = hist.GetYaxis().GetNbins()+2
+      self.values = np.array([[hist.GetBinContent(i,j) for j in xrange(nybins)] for i in xrange(nxbins)])
+  
+  @staticmethod
+  def load(filename, histname, clamp=True, name=None):
+    """Load table of a histogram from the active correction bundle (see CorrectionBundle),
+    or else from the ROOT file, and add it to the bundle."""
+    bundle = getbundle()
+    arrays = bundle.get(filename,histname) if bundle else None
+    if arrays:
+      return LookupTable(arrays,clamp=clamp,name=name or histname)
+    file   = ensureTFile(filename)
+    hist   = file.Get(histname)
+    if not hist:
+      raise IOError('LookupTable.load: histogram "%s" does not exist in "%s"'%(histname,filename))
+    table  = LookupTable(hist,clamp=clamp,name=name)
+    file.Close()
+    if bundle:
+      bundle.add(filename,histname,table.edges,table.values)
+    return table
+  
+  def findbin(self, iaxis, x):
+    """Find bin index of given value(s) along axis: 0 is underflow, nbins+1 overflow."""
+    edges = self.edges[iaxis]
+    bins  = np.searchsorted(edges,x,side='right') # lower edge is included in bin
+    if self.clamp:
+      bins = np.clip(bins,1,len(edges)-1)
+    return bins
+  
+  def __call__(self, x, y=None):
+    """Get content for value(s) x (and y). Return float for a single value, or array."""
+    if y is None:
+      value = self.values[self.findbin(0,x)]
+    else:
+      value = self.values[self.findbin(0,x),self.findbin(1,y)]
+    if np.ndim(value)==0:
+      return float(value)
+    return value
 
 
 class ScaleFactor:
@@ -10,13 +71,7 @@ class ScaleFactor:
     self.name     = name
     self.ptvseta  = ptvseta
     self.filename = filename
-    self.file     = ensureTFile(filename)
-    self.hist     = self.file.Get(histname)
-    if not self.hist:
-      print '>>> ScaleFactor(%s).__init__: histogram "%s" does not exist in "%s"'%(self.name,histname,filename)
-      exit(1)
-    self.hist.SetDirectory(0)
-    self.file.Close()
+    self.table    = LookupTable.load(filename,histname,name=name)
     
     if ptvseta: self.getSF = self.getSF_ptvseta
     else:       self.getSF = self.getSF_etavspt
@@ -25,26 +80,14 @@ class ScaleFactor:
     return ScaleFactorProduct(self, oScaleFactor)
   
   def getSF_ptvseta(self, pt, eta):
-    """Get SF for a given pT, eta."""
-    xbin = self.hist.GetXaxis().FindBin(eta)
-    ybin = self.hist.GetYaxis().FindBin(pt)
-    if xbin==0: xbin = 1
-    elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-    if ybin==0: ybin = 1
-    elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-    sf   = self.hist.GetBinContent(xbin,ybin)
+    """Get SF for a given pT, eta, or for arrays of pT and eta."""
+    sf   = self.table(eta,pt)
     #print "ScaleFactor(%s).getSF_ptvseta: pt = %6.2f, eta = %6.3f, sf = %6.3f"%(self.name,pt,eta,sf)
     return sf
   
   def getSF_etavspt(self, pt, eta):
-    """Get SF for a given pT, eta."""
-    xbin = self.hist.GetXaxis().FindBin(pt)
-    ybin = self.hist.GetYaxis().FindBin(eta)
-    if xbin==0: xbin = 1
-    elif xbin>self.hist.GetXaxis().GetNbins(): xbin -= 1
-    if ybin==0: ybin = 1
-    elif ybin>self.hist.GetYaxis().GetNbins(): ybin -= 1
-    sf   = self.hist.GetBinContent(xbin,ybin)
+    """Get SF for a given pT, eta, or for arrays of pT and eta."""
+    sf   = self.table(pt,eta)
     #print "ScaleFactor(%s).getSF_etavspt: pt = %6.2f, eta = %6.3f, sf = %6.3f"%(self.name,pt,eta,sf)
     return sf
     
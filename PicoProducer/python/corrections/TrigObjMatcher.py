@@ -5,8 +5,10 @@
 #   https://github.com/cms-sw/cmssw/blob/master/PhysicsTools/NanoAOD/python/triggerObjects_cff.py
 #   https://cms-nanoaod-integration.web.cern.ch/integration/master-106X/mc106X_doc.html#TrigObj
 import os, sys, yaml #, json
+import numpy as np
 from collections import namedtuple
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Object
+from TauFW.PicoProducer.analysis.columnar import getarray, deltaR
 TriggerData = namedtuple('TriggerData',['trigdict','combdict']) # simple container class
 objectTypes = { 1: 'Jet', 6: 'FatJet', 2: 'MET', 3: 'HT', 4: 'MHT',
                 11: 'Electron', 13: 'Muon', 15: 'Tau', 22: 'Photon', } 
@@ -109,6 +111,74 @@ def loadTriggerDataFromJSON(filename,channel=None,isdata=True,verbose=False):
     return TriggerData(trigdict,combdict)
   
 
+class TriggerDecision(object):
+  """Picklable method to check if any of a list of trigger paths was fired for a given event,
+  replacing a lambda. The TTreeReaderValue of each path is resolved once per input file (see setup),
+  and run ranges (for data) are checked first."""
+  
+  def __init__(self,triggers):
+    self.paths     = [getattr(t,'path',t) for t in triggers] # HLT paths, or Trigger objects
+    self.runranges = [getattr(t,'runrange',None) for t in triggers]
+    self.hasrange  = any(self.runranges)
+    self._tree     = None # current input tree
+    self._version  = None # version of the readers in nanoAOD-tools' InputTree
+    self._checks   = None # list of (path, runrange, reader) per trigger
+  
+  def __getstate__(self):
+    """Do not pickle the ROOT tree and readers; they are resolved again for the next event."""
+    state = self.__dict__.copy()
+    state['_tree'] = state['_version'] = state['_checks'] = None
+    return state
+  
+  def __repr__(self):
+    return "<%s(%s) at %s>"%(self.__class__.__name__,' || '.join(self.paths),hex(id(self)))
+  
+  def setup(self,tree):
+    """Resolve TTreeReaderValue of each path in the input tree (nanoAOD-tools' InputTree).
+    Missing branches (e.g. set to a default by ensurebranches) are read as event attribute."""
+    self._tree    = tree
+    self._version = getattr(tree,'_ttreereaderversion',None)
+    self._checks  = [ ]
+    for path, runrange in zip(self.paths,self.runranges):
+      reader = None
+      if hasattr(tree,'valueReader') and tree.GetBranch(path):
+        reader = tree.valueReader(path)
+      self._checks.append((path,runrange,reader))
+  
+  def __call__(self,event):
+    """Return True if any trigger was fired in a given event."""
+    tree = getattr(event,'_tree',None)
+    if tree is None: # not a nanoAOD-tools Event
+      return self.getattrfired(event)
+    if tree is not self._tree or getattr(tree,'_ttreereaderversion',None)!=self._version: # new file, or readers were remade
+      self.setup(tree)
+    run = event.run if self.hasrange else None
+    for path, runrange, reader in self._checks:
+      if runrange and not (runrange[0]<=run<=runrange[1]): continue
+      if (reader.Get()[0] if reader else getattr(event,path)):
+        return True
+    return False
+  
+  def getattrfired(self,event):
+    """Return True if any trigger was fired, reading the paths as event attributes."""
+    run = event.run if self.hasrange else None
+    for path, runrange in zip(self.paths,self.runranges):
+      if runrange and not (runrange[0]<=run<=runrange[1]): continue
+      if getattr(event,path):
+        return True
+    return False
+  
+  def chunk(self,arrays):
+    """Return mask of events that fired any trigger in a chunk of events (columnar mode)."""
+    fired = np.zeros(len(arrays),dtype=bool)
+    for path, runrange in zip(self.paths,self.runranges):
+      passed = getattr(arrays,path).astype(bool)
+      if runrange:
+        passed = passed & (arrays.run>=runrange[0]) & (arrays.run<=runrange[1])
+      fired |= passed
+    return fired
+  
+
 class Trigger:
   """Class to contain a single trigger and its trigger object(s)."""
   def __init__(self,path,filters,runrange=None,**kwargs):
@@ -127,9 +197,7 @@ class Trigger:
     self.runrange = runrange                            # range of run for this trigger formatted as (first,last); for data only
     self.path     = path                                # human readable trigger combination
     self.patheval = patheval                            # trigger evaluation per event 'e'
-    self.fireddef = "self.fired = lambda e: "+patheval  # exact definition of 'fired' function
-    exec self.fireddef in locals()                      # method to check if trigger was fired for a given event
-    #self.fired = lambda e: any(e.p for p in self.paths)
+    self.fired    = TriggerDecision([self])             # method to check if trigger was fired for a given event
   
   def __repr__(self):
     """Returns string representation of Trigger object."""
@@ -259,7 +327,6 @@ class TrigObjMatcher:
       else:
         patheval += trigger.patheval
     path    = patheval.replace("e.",'').replace(" or "," || ").replace(" and "," && ")
-    firedef = "self.fired = lambda e: "+patheval
     
     self.triggers = triggers       # list of triggers
     self.nlegs    = nlegs          # number of legs = number of filters
@@ -269,8 +336,15 @@ class TrigObjMatcher:
     self.bits     = bits           # bitwise 'OR'-combination of all filter bits
     self.path     = path           # human readable trigger combination
     self.patheval = patheval       # trigger evaluation per event 'e'
-    self.fireddef = firedef        # exact definition of 'fired' function
-    exec self.fireddef in locals() # method to check if any of the triggers was fired for a given event
+    self.fired    = TriggerDecision(triggers) # method to check if any of the triggers was fired for a given event
+  
+    # PRECOMPUTE per trigger (row) & leg (column) for matching all legs & candidates at once
+    self.paths     = [t.path for t in triggers]
+    self.runranges = np.array([t.runrange or (0,0) for t in triggers],dtype=np.int64)
+    self.hasrange  = np.array([bool(t.runrange) for t in triggers],dtype=bool)
+    self.legbits   = np.array([[f.bits   for f in t.filters] for t in triggers],dtype=np.int64)
+    self.legptmin  = np.array([[f.ptmin  for f in t.filters] for t in triggers],dtype=np.float64)
+    self.legetamax = np.array([[f.etamax for f in t.filters] for t in triggers],dtype=np.float64)
   
   def __repr__(self):
     """Returns string representation of TriggerFilter object."""
@@ -286,14 +360,51 @@ class TrigObjMatcher:
       for i, filter in enumerate(trigger.filters,1):
         print "%s  leg %d: %s, %r"%(indent,i,filter.type,filter.name)
   
+  def setup(self,tree):
+    """Resolve branch readers of the trigger paths once per input file."""
+    self.fired.setup(tree)
+  
+  def firedpaths(self,event):
+    """Return boolean array of the triggers that fired in a given event."""
+    fired = np.array([bool(getattr(event,p)) for p in self.paths],dtype=bool)
+    if self.hasrange.any():
+      fired &= ~self.hasrange | ((self.runranges[:,0]<=event.run) & (event.run<=self.runranges[:,1]))
+    return fired
+  
+  def matchindices(self,event,legs,dR=0.2):
+    """Match reconstructed candidates of all legs to trigger objects at once,
+    given a list of candidates (reconstructed objects) per leg.
+    Return a list with an array per leg of the index of the matched trigger object for each candidate,
+    or -1 if it is not matched. Like match, the first fired trigger and first trigger object is used."""
+    fired   = np.flatnonzero(self.firedpaths(event)) # fired triggers
+    nobjs   = event.nTrigObj
+    objids  = getarray(event.TrigObj_id,nobjs,np.int32)
+    objbits = getarray(event.TrigObj_filterBits,nobjs,np.int64)
+    objeta  = getarray(event.TrigObj_eta,nobjs)
+    objphi  = getarray(event.TrigObj_phi,nobjs)
+    indices = [ ]
+    for leg, cands in enumerate(legs):
+      index = np.full(len(cands),-1,dtype=np.int64)
+      iobjs = np.flatnonzero(objids==self.ids[leg]) # trigger objects of this leg's type
+      if len(cands)>0 and len(fired)>0 and len(iobjs)>0:
+        pt     = np.array([c.pt  for c in cands],dtype=np.float64)
+        eta    = np.array([c.eta for c in cands],dtype=np.float64)
+        phi    = np.array([c.phi for c in cands],dtype=np.float64)
+        bits   = self.legbits[fired,leg][:,None]
+        bitsok = (objbits[iobjs][None,:] & bits)==bits # (trigger, trigobj)
+        kinok  = (pt[None,:]>self.legptmin[fired,leg][:,None]) & (abs(eta)[None,:]<self.legetamax[fired,leg][:,None]) # (trigger, cand)
+        dRok   = deltaR(objeta[iobjs][None,:],objphi[iobjs][None,:],eta[:,None],phi[:,None])<dR # (cand, trigobj)
+        passed = (bitsok[:,None,:] & kinok[:,:,None] & dRok[None,:,:]).transpose(1,0,2).reshape(len(cands),-1)
+        first  = passed.argmax(axis=1) # first matching (trigger, trigobj) combination for each candidate
+        found  = passed[np.arange(len(cands)),first]
+        index[found] = iobjs[first[found]%len(iobjs)]
+      indices.append(index)
+    return indices
+  
   def match(self,event,recoObj,leg=1,dR=0.2):
     """Match given reconstructed object to trigger objects."""
-    leg     -= 1 # index starting at 0
-    trigObjs = [o for o in Collection(event,'TrigObj') if o.id==self.ids[leg]] # and (o.filterBits&self.bits)>0
-    for trigger in self.triggers:
-      if not trigger.fired(event): continue
-      for trigObj in trigObjs:
-        if trigger.filters[leg].matchbits(trigObj) and trigger.filters[leg].match(trigObj,recoObj,dR=dR):
-          return trigObj
-    return None
+    legs    = [[ ] for i in xrange(self.nlegs)]
+    legs[leg-1].append(recoObj) # leg index starting at 0
+    index   = self.matchindices(event,legs,dR=dR)[leg-1][0]
+    return Object(event,'TrigObj',index=int(index)) if index>=0 else None
   
@@ -5,7 +5,7 @@ import os, re
 import time; time0 = time.time()
 import ROOT; ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
-from TauFW.PicoProducer.analysis.utils import getmodule, convertstr
+from TauFW.PicoProducer.analysis.utils import getmodule, convertstr, writebranchsel
 from TauFW.PicoProducer.processors import moddir
 #from TauFW.PicoProducer.corrections.era_config import getjson, getera, getjmecalib
 from argparse import ArgumentParser
@@ -13,7 +13,10 @@ parser = ArgumentParser()
 parser.add_argument('-i', '--infiles',  dest='infiles',   type=str, default=[ ], nargs='+')
 parser.add_argument('-o', '--outdir',   dest='outdir',    type=str, default='.')
 parser.add_argument('-C', '--copydir',  dest='copydir',   type=str, default=None)
-parser.add_argument('-m', '--maxevts',  dest='maxevts',   type=int, default=-1)
+parser.add_argument('-m', '--maxevts', '--maxEntries',
+                                        dest='maxevts',   type=int, default=-1)
+parser.add_argument('--firstEntry',     dest='firstevt',  type=int, default=0,
+                                        help="first entry to process (per file), e.g. for jobs of event ranges")
 parser.add_argument('-t', '--tag',      dest='tag',       type=str, default="")
 parser.add_argument('-d', '--dtype',    dest='dtype',     choices=['data','mc','embed'], default=None)
 parser.add_argument('-y','-e','--era',  dest='era',       type=str, default='2018')
@@ -21,6 +24,12 @@ parser.add_argument('-M', '--module',   dest='module',    type=str, default=None
 parser.add_argument('-c', '--channel',  dest='channel',   type=str, default=None)
 parser.add_argument('-E', '--opts',     dest='extraopts', type=str, default=[ ], nargs='+')
 parser.add_argument('-p', '--prefetch', dest='prefetch',  action='store_true', default=False)
+parser.add_argument('--nopresel',       dest='presel',    action='store_false', default=True,
+                                        help="do not apply the module's fast pre-selection before analyze")
+parser.add_argument('--columnar',       dest='columnar',  action='store_true', default=False,
+                                        help="process events in chunks with array operations (if the module supports it)")
+parser.add_argument('--chunksize',      dest='chunksize', type=int, default=100000,
+                                        help="number of events per chunk in columnar mode, default=%(default)d")
 args = parser.parse_args()
 
 
@@ -43,15 +52,17 @@ dtype     = args.dtype
 outdir    = args.outdir
 copydir   = args.copydir
 maxevts   = args.maxevts if args.maxevts>0 else None
-nfiles    = 1 if maxevts>0 else -1
+firstevt  = args.firstevt
+nfiles    = 1 if maxevts>0 or firstevt>0 else -1
 tag       = args.tag
 if tag:
   tag     = ('' if tag.startswith('_') else '_') + tag
 outfname  = os.path.join(outdir,"pico_%s%s.root"%(channel,tag))
 url       = "root://cms-xrd-global.cern.ch/"
 prefetch  = args.prefetch
-presel    = None #"Muon_pt[0] > 50"
-branchsel = os.path.join(moddir,"keep_and_drop_skim.txt")
+columnar  = args.columnar
+chunksize = args.chunksize
+presel    = args.presel # compiled by module, e.g. "Pileup_nTrueInt>0 && HLT_IsoMu27 && Sum$(Muon_pt>=25)>0"
 json      = None
 modules   = [ ]
 
@@ -86,24 +97,38 @@ print ">>> %-12s = %r"%('modname',modname)
 print ">>> %-12s = %r"%('dtype',dtype)
 print ">>> %-12s = %r"%('kwargs',kwargs)
 print ">>> %-12s = %s"%('maxevts',maxevts)
+print ">>> %-12s = %s"%('firstevt',firstevt)
 print ">>> %-12s = %r"%('outdir',outdir)
 print ">>> %-12s = %r"%('copydir',copydir)
 print ">>> %-12s = %s"%('infiles',infiles)
 print ">>> %-12s = %r"%('outfname',outfname)
-print ">>> %-12s = %r"%('branchsel',branchsel)
 print ">>> %-12s = %r"%('json',json)
 print ">>> %-12s = %s"%('prefetch',prefetch)
+print ">>> %-12s = %s"%('columnar',columnar)
+print ">>> %-12s = %s"%('presel',presel)
 print ">>> %-12s = %s"%('cwd',os.getcwd())
 print '-'*80
 
 # GET MODULE
 module = getmodule(modname)(outfname,**kwargs)
 modules.append(module)
+cut    = None
+if presel and not columnar and hasattr(module,'setpreselection'):
+  cut  = module.setpreselection(maxevts=maxevts,firstevt=firstevt,json=json)
+branchsel = None
+if not columnar and getattr(module,'dolazy',False) and hasattr(module,'getbranches'):
+  branchsel = writebranchsel(os.path.join(outdir,"branchsel_%s%s.txt"%(channel,tag)),module.getbranches())
 
 # RUN
-p = PostProcessor(outdir,infiles,cut=None,branchsel=None,noOut=True,
-                  modules=modules,jsonInput=json,maxEntries=maxevts,prefetch=prefetch)
-p.run()
+if columnar:
+  from TauFW.PicoProducer.analysis.columnar import runcolumnar
+  runcolumnar(module,infiles,maxevts=maxevts,firstevt=firstevt,chunksize=chunksize)
+else:
+  p = PostProcessor(outdir,infiles,cut=cut,branchsel=branchsel,noOut=True,
+                    modules=modules,jsonInput=json,maxEntries=maxevts,firstEntry=firstevt,prefetch=prefetch)
+  p.run()
+  if branchsel:
+    os.remove(branchsel)
 
 # COPY
 if copydir and outdir!=copydir:
@@ -76,11 +76,13 @@ class Sample(object):
     self.blacklist    = kwargs.get('blacklist',    [ ]  ) # black list file
     self.instance     = kwargs.get('instance', 'prod/phys03' if path.endswith('USER') else 'prod/global')
     self.nfilesperjob = kwargs.get('nfilesperjob', -1   ) # number of nanoAOD files per job
+    self.nevtsperjob  = kwargs.get('nevtsperjob',  -1   ) # number of nanoAOD events per job (split large files)
     self.extraopts    = kwargs.get('opts',         [ ]  ) # extra options for analysis module, e.g. ['doZpt=1','tes=1.1']
     self.subtry       = kwargs.get('subtry',       0    ) # to help keep track of resubmission
     self.jobcfg       = kwargs.get('jobcfg',       { }  ) # to help keep track of resubmission
     self.nevents      = kwargs.get('nevents',      0    ) # number of nanoAOD events that can be processed
     self.files        = kwargs.get('files',        [ ]  ) # list of ROOT files, OR text file with list of files
+    self.filenevts    = kwargs.get('filenevts',    { }  ) # cached number of events per file
     self.postfix      = kwargs.get('postfix',      None ) or "" # post-fix (before '.root') for stored ROOT files
     self.era          = kwargs.get('era',          ""   ) # for expansion of $ERA variable
     self.verbosity    = kwargs.get('verbosity',     0   ) # verbosity level for debugging
@@ -125,6 +127,8 @@ class Sample(object):
           if infile[0]=='#': continue
           if infile.endswith('.root'):
             filelist.append(infile)
+            if len(line)>=2 and line[1].isdigit(): # cached number of events
+              self.filenevts[infile] = int(line[1])
       self.files = filelist
       self.files.sort()
   
@@ -149,8 +153,11 @@ class Sample(object):
     opts     = [str(s) for s in jobcfg['extraopts']]
     subtry   = int(jobcfg['try'])
     nevents  = int(jobcfg['nevents'])
+    nevtsperjob = int(jobcfg.get('nevtsperjob',-1))
+    filenevts   = { str(f): int(n) for f, n in jobcfg.get('filenevts',{ }).iteritems() }
     sample   = Sample(jobcfg['group'],jobcfg['name'],jobcfg['paths'],dtype=dtype,channels=channels,
-                       subtry=subtry,jobcfg=jobcfg,nfilesperjob=nfilesperjob,nevents=nevents,opts=opts)
+                       subtry=subtry,jobcfg=jobcfg,nfilesperjob=nfilesperjob,nevents=nevents,opts=opts,
+                       nevtsperjob=nevtsperjob,filenevts=filenevts)
     return sample
   
   def split(self):
@@ -225,6 +232,26 @@ class Sample(object):
       self.nevents = nevents
     return nevents
   
+  def getfilenevts(self,files=None,refresh=False,verb=0):
+    """Get number of events per file. Files without cached number are opened to
+    count the entries of the 'Events' tree."""
+    from ROOT import TFile
+    if files==None:
+      files = self.getfiles(verb=verb)
+    for fname in files:
+      if fname in self.filenevts and not refresh: continue
+      if verb>=1:
+        print ">>> Sample.getfilenevts: Counting events in %s..."%(fname)
+      file = TFile.Open(fname,'READ')
+      if not file or file.IsZombie():
+        LOG.throw(IOError,"Could not open file %r to count the events!"%(fname))
+      tree = file.Get('Events')
+      if not tree:
+        LOG.throw(IOError,"Could not find 'Events' tree in file %r!"%(fname))
+      self.filenevts[fname] = int(tree.GetEntries())
+      file.Close()
+    return { f: self.filenevts[f] for f in files }
+  
 
 class Data(Sample):
   def __init__(self,*args,**kwargs):
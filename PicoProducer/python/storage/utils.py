@@ -1,11 +1,11 @@
 # Author: Izaak Neutelings (May 2020)
-import os
+import os, re
 import getpass, platform
 import importlib
 from TauFW.PicoProducer import basedir
 from TauFW.common.tools.log import Logger
 from TauFW.common.tools.file import ensurefile
-from TauFW.common.tools.utils import repkey
+from TauFW.common.tools.utils import repkey, chunkify
 LOG  = Logger('Storage')
 host = platform.node()
 
@@ -93,3 +93,34 @@ def getsamples(era,channel="",tag="",dtype=[],filter=[],veto=[],moddict={},verb=
     sampledict[sample.name] = sample
   return samples
   
+  
+
+def getfilerange(fname):
+  """Split an input file with event range, 'FILE.root:FIRST:MAX', into the file name,
+  first entry and maximum number of entries. Return -1 as maximum for a whole file."""
+  match = re.match(r"(.+\.root):(\d+):(\d+)$",fname)
+  if match:
+    return match.group(1), int(match.group(2)), int(match.group(3))
+  return fname, 0, -1
+  
+
+def chunkifyevents(infiles,filenevts,nevtsperjob,nfilesperjob=1):
+  """Divide up input files into job chunks of event ranges. Files with more events than
+  nevtsperjob are split into equal ranges of one job each, written as 'FILE.root:FIRST:MAX';
+  smaller files are grouped per nfilesperjob. Event ranges (e.g. from resubmission) are kept."""
+  chunks = [ ]
+  wholes = [ ]
+  for fname in infiles:
+    nevts = filenevts.get(fname,-1)
+    if getfilerange(fname)[2]>=0: # already an event range
+      chunks.append([fname])
+    elif nevts>nevtsperjob:
+      nranges = (nevts+nevtsperjob-1)//nevtsperjob
+      bounds  = [(i*nevts)//nranges for i in xrange(nranges+1)] # balance ranges
+      for first, last in zip(bounds[:-1],bounds[1:]):
+        chunks.append(["%s:%d:%d"%(fname,first,last-first)])
+    else:
+      wholes.append(fname)
+  chunks.extend(chunkify(wholes,max(1,nfilesperjob)))
+  return chunks
+  
@@ -10,8 +10,8 @@ from TauFW.common.tools.file import ensuredir, ensurefile, ensureinit, getline
 from TauFW.common.tools.utils import execute, chunkify, repkey
 from TauFW.common.tools.log import Logger, color, bold
 from TauFW.PicoProducer.analysis.utils import getmodule, ensuremodule
-from TauFW.PicoProducer.batch.utils import getbatch, getcfgsamples
-from TauFW.PicoProducer.storage.utils import getstorage, getsamples
+from TauFW.PicoProducer.batch.utils import getbatch, getcfgsamples, runjobs
+from TauFW.PicoProducer.storage.utils import getstorage, getsamples, getfilerange, chunkifyevents
 from argparse import ArgumentParser
 os.chdir(GLOB.basedir)
 CONFIG = GLOB.getconfig(verb=0)
@@ -153,7 +153,10 @@ def main_get(args):
               ensuredir(os.path.dirname(flistname))
               with open(flistname,'w+') as flist:
                 for infile in infiles:
-                  flist.write(infile+'\n')
+                  if infile in sample.filenevts: # cached number of events
+                    flist.write("%s %d\n"%(infile,sample.filenevts[infile]))
+                  else:
+                    flist.write(infile+'\n')
   
   # CONFIGURATION
   else:
@@ -308,6 +311,8 @@ def main_run(args):
   """Run given module locally."""
   if args.verbosity>=1:
     print ">>> main_run", args
+  if args.ncores>0: # run all job chunks with a local process pool
+    return main_run_parallel(args)
   eras      = args.eras
   channels  = args.channels
   tag       = args.tag
@@ -457,6 +462,63 @@ def main_run(args):
       
 
 
+def main_run_parallel(args):
+  """Run jobs of given samples locally in parallel with a pool of processes.
+  Jobs are prepared like for batch submission (see preparejobs), with the same job configuration
+  and output of numbered chunks, so 'pico.py status' and 'pico.py hadd' work the same way."""
+  verbosity = args.verbosity
+  ncores    = args.ncores
+  maxevts   = args.maxevts
+  dryrun    = args.dryrun
+  if args.infiles:
+    LOG.throw(IOError,"Running in parallel (--ncores) is only possible for samples in the sample list, not input files (-i)!")
+  jobcmds   = [ ]
+  logfiles  = [ ]
+  names     = [ ]
+  tmpdirs   = [ ] # separate output directory per job, as jobs write their output to the same file name
+  for jobcfg in preparejobs(args):
+    cfgname = jobcfg['cfgname']
+    nchunks = jobcfg['nchunks']
+    if nchunks<=0:
+      print ">>>   Nothing to run!"
+      continue
+    with open(jobcfg['joblist'],'r') as listfile:
+      for ichunk, jobcmd in zip(jobcfg['chunks'],listfile.read().splitlines()):
+        tmpdir  = os.path.join(jobcfg['jobdir'],"tmp_%s_%d"%(jobcfg['name'],ichunk))
+        jobcmd += " -o %s"%(tmpdir)
+        if maxevts:
+          match = re.search(r"--maxEntries (\d+)",jobcmd)
+          if match: # event range: only shorten range, to not overlap with the next chunk
+            jobcmd = jobcmd.replace(match.group(0),"--maxEntries %d"%(min(maxevts,int(match.group(1)))))
+          else:
+            jobcmd += " -m %s"%(maxevts)
+        jobcmds.append(jobcmd)
+        tmpdirs.append(tmpdir)
+        logfiles.append(os.path.join(jobcfg['logdir'],"%s%s.local.%d.log"%(jobcfg['name'],jobcfg['jobtag'],ichunk)))
+        names.append("%s_%d"%(jobcfg['name'],ichunk))
+    
+    # WRITE JOBCONFIG (no job IDs)
+    if not dryrun:
+      if verbosity>=1:
+        print ">>> Creating config file '%s'..."%(cfgname)
+      with open(cfgname,'w') as file:
+        json.dump(jobcfg,file,indent=2)
+  
+  # RUN
+  print ">>> Running %d jobs with %d processes..."%(len(jobcmds),ncores)
+  if dryrun:
+    for jobcmd in jobcmds:
+      print ">>> Executing: "+bold(jobcmd)
+  elif jobcmds:
+    for tmpdir in tmpdirs:
+      ensuredir(tmpdir)
+    runjobs(jobcmds,ncores=ncores,logfiles=logfiles,names=names,verb=verbosity)
+    for tmpdir in tmpdirs: # output was copied to the sample's output directory
+      if os.path.isdir(tmpdir) and not os.listdir(tmpdir):
+        os.rmdir(tmpdir)
+      
+
+
 ####################
 #   PREPARE JOBS   #
 ####################
@@ -479,6 +541,7 @@ def preparejobs(args):
   extraopts    = args.extraopts
   prefetch     = args.prefetch
   nfilesperjob = args.nfilesperjob
+  nevtsperjob  = args.nevtsperjob
   split_nfpj   = args.split_nfpj
   testrun      = args.testrun
   verbosity    = args.verbosity
@@ -565,6 +628,11 @@ def preparejobs(args):
         nfilesperjob_ = sample.nfilesperjob if sample.nfilesperjob>0 else nfilesperjob
         if split_nfpj>1:
           nfilesperjob_ = min(1,nfilesperjob_/split_nfpj)
+        nevtsperjob_ = sample.nevtsperjob if sample.nevtsperjob>0 else nevtsperjob
+        if skim and nevtsperjob_>0:
+          LOG.warning("Splitting files in event ranges is not possible for skimming jobs, as the output "
+                      "has one file per input file! Ignoring nevtsperjob=%s..."%(nevtsperjob_))
+          nevtsperjob_ = -1
         outdir     = repkey(outdirformat,ERA=era,CHANNEL=channel,TAG=tag,SAMPLE=sample.name,
                                          DAS=sample.paths[0].strip('/'),GROUP=sample.group)
         jobdir     = ensuredir(repkey(jobdirformat,ERA=era,CHANNEL=channel,TAG=tag,SAMPLE=sample.name,
@@ -622,11 +690,15 @@ def preparejobs(args):
           chunkdict = { }
         if testrun:
           infiles = infiles[:2] # only run two files per sample
+        filenevts = { }
+        if nevtsperjob_>0: # get (cached) number of events per file to split them
+          filenevts = sample.getfilenevts([f for f in infiles if getfilerange(f)[2]<0],verb=verbosity-1)
         if verbosity==1:
           print ">>> %-12s = %s"%('nfilesperjob',nfilesperjob_)
           print ">>> %-12s = %s"%('nfiles',len(infiles))
         elif verbosity>=2:
           print ">>> %-12s = %s"%('nfilesperjob',nfilesperjob_)
+          print ">>> %-12s = %s"%('nevtsperjob',nevtsperjob_)
           print ">>> %-12s = %s"%('nfiles',len(infiles))
           print ">>> %-12s = [ "%('infiles')
           for file in infiles:
@@ -637,7 +709,10 @@ def preparejobs(args):
         # CHUNKS
         infiles.sort() # to have consistent order with resubmission
         chunks    = [ ] # chunk indices
-        fchunks   = chunkify(infiles,nfilesperjob_) # file chunks
+        if nevtsperjob_>0:
+          fchunks = chunkifyevents(infiles,filenevts,nevtsperjob_,nfilesperjob_) # file & event range chunks
+        else:
+          fchunks = chunkify(infiles,nfilesperjob_) # file chunks
         nfiles    = len(infiles)
         nchunks   = len(fchunks)
         if verbosity>=1:
@@ -656,6 +731,11 @@ def preparejobs(args):
                 ichunk  += 1 # allows for different nfilesperjob on resubmission
                 continue
               jobfiles   = ' '.join(fchunk) # list of input files
+              fname, firstevt, maxevts = getfilerange(fchunk[0])
+              if maxevts>=0: # event range of single file
+                jobfiles = fname
+                if testrun:
+                  maxevts = min(maxevts,testrun)
               filetag    = postfix
               if not skim:
                 filetag += "_%d"%(ichunk)
@@ -670,7 +750,9 @@ def preparejobs(args):
                 jobcmd  += " -y %s -d %r -c %s -M %s --copydir %s -t %s"%(era,dtype,channel,module,outdir,filetag)
               if prefetch:
                 jobcmd  += " -p"
-              if testrun:
+              if maxevts>=0:
+                jobcmd  += " --firstEntry %d --maxEntries %d"%(firstevt,maxevts) # process an event range
+              elif testrun:
                 jobcmd  += " -m %d"%(testrun) # process a limited amount of events
               if extraopts_:
                 jobcmd  += " --opt '%s'"%("' '".join(extraopts_))
@@ -691,6 +773,7 @@ def preparejobs(args):
           ('outdir',outdir),      ('jobdir',jobdir),      ('cfgdir',cfgdir),    ('logdir',logdir),
           ('cfgname',cfgname),    ('joblist',joblist),
           ('nfiles',nfiles),      ('files',infiles),      ('nfilesperjob',nfilesperjob_), #('nchunks',nchunks),
+          ('nevtsperjob',nevtsperjob_), ('filenevts',filenevts),
           ('nchunks',nchunks),    ('chunks',chunks),      ('chunkdict',chunkdict),
         ])
         
@@ -722,7 +805,7 @@ def checkchuncks(sample,**kwargs):
   verbosity    = kwargs.get('verb',           0)
   oldjobcfg    = sample.jobcfg
   oldcfgname   = oldjobcfg['config']
-  chunkdict    = oldjobcfg['chunkdict'] # filenames
+  chunkdict    = oldjobcfg['chunkdict'] # filenames, or event ranges 'FILE.root:FIRST:MAX' (see chunkifyevents)
   jobids       = oldjobcfg['jobids']
   joblist      = oldjobcfg['joblist']
   postfix      = oldjobcfg['postfix']
@@ -753,7 +836,7 @@ def checkchuncks(sample,**kwargs):
     print ">>> %-12s = %s"%('chunkdict',chunkdict)
   
   # CHECK PENDING JOBS
-  if checkqueue<0 or pendjobs:
+  if jobids and (checkqueue<0 or pendjobs): # no job IDs for local runs (see main_run_parallel)
     batch = getbatch(CONFIG,verb=verbosity)
     if checkqueue!=1 or not pendjobs:
       pendjobs = batch.jobs(jobids,verb=verbosity-1) # get refreshed job list
@@ -1274,6 +1357,8 @@ if __name__ == "__main__":
                                                 help='extra options for the batch system')
   parser_job.add_argument('-n','--filesperjob', dest='nfilesperjob', type=int, default=CONFIG.nfilesperjob,
                                                 help='number of files per job, default=%(default)d')
+  parser_job.add_argument('--evtsperjob',       dest='nevtsperjob', type=int, default=-1,
+                          metavar='N',          help="split files with more than N events into jobs of event ranges" )
   parser_job.add_argument('--split',            dest='split_nfpj', type=int, nargs='?', const=2, default=1, action='store',
                           metavar='N',          help="divide default number of files per job, default=%(const)d" )
   
@@ -1330,6 +1415,14 @@ if __name__ == "__main__":
                                                 help="input files (nanoAOD)")
   parser_run.add_argument('-o', '--outdir',     dest='outdir', type=str, default='output',
                                                 help="output directory, default=%(default)r")
+  parser_run.add_argument('-j', '--ncores',     dest='ncores', type=int, default=0,
+                          metavar='N',          help="run all files of the samples in chunks like batch jobs, "
+                                                     "in parallel on N local cores, with the output in outdir of the configuration")
+  parser_run.add_argument('--filesperjob',      dest='nfilesperjob', type=int, default=CONFIG.nfilesperjob,
+                                                help='number of files per job with --ncores, default=%(default)d')
+  parser_run.add_argument('--evtsperjob',       dest='nevtsperjob', type=int, default=-1,
+                          metavar='N',          help="split files with more than N events into jobs of event ranges with --ncores" )
+  parser_run.set_defaults(checkqueue=0,prefetch=False,testrun=0,split_nfpj=1) # for preparejobs
   parser_get.add_argument('-w','--write',       dest='write', type=str, nargs='?', const=str(CONFIG.filelistdir), default="", action='store',
                           metavar='FILE',       help="write file list, default=%(const)r" )
   
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# Author: Izaak Neutelings (July 2020)
+# Description: Test vectorized b tag event weights of BTagWeightTool against the per-jet weights
+#   test/testBTagTool.py -v2
+from TauFW.common.tools.log import Logger
+from TauFW.PicoProducer.corrections.BTagTool import BTagWeightTool
+LOG = Logger('testBTagTool')
+
+
+class Jet:
+  """Simple jet object with the attributes used by BTagWeightTool."""
+  def __init__(self, pt, eta, partonFlavour, btagDeepB):
+    self.pt            = pt
+    self.eta           = eta
+    self.partonFlavour = partonFlavour
+    self.btagDeepB     = btagDeepB
+  def __repr__(self):
+    return "Jet(%s,%s,%s,%s)"%(self.pt,self.eta,self.partonFlavour,self.btagDeepB)
+  
+
+def getevents():
+  """Create a handful of events with jets at the edges of the SF bins, outside the pt and eta range,
+  of all flavors, and tagged or untagged."""
+  events = [
+    [ Jet(45.,  0.5,  5, 0.9), Jet(35., -1.2,  4, 0.1), Jet(80., 2.1,  0, 0.05) ],
+    [ ], # no jets
+    [ Jet(20.,  0.0,  5, 0.9), Jet(30.,  2.4, -5, 0.2), Jet(50., -2.4, 21, 0.6) ], # pt and eta bin edges
+    [ Jet(1000., 1.0, 4, 0.9), Jet(15.,  1.0,  0, 0.1), Jet(1200., 0.3, 5, 0.1) ], # edge of, and outside pt range
+    [ Jet(60.,  2.5,  5, 0.9), Jet(60., -2.6,  0, 0.1), Jet(25., 2.399, 15, 0.1) ], # outside eta range, tau
+    [ Jet(250., 0.8,  0, 0.1), Jet(250., -1.8, 21, 0.1), Jet(250., 1.2, 0, 0.9) ], # untagged with eff==1
+    [ Jet(300., -0.7, 5, 0.3) ],
+  ]
+  return events
+  
+
+def testWeights(tool, events):
+  """Compare getWeights for all jets at once to getWeight per event."""
+  LOG.header("testWeights")
+  table = tool.efftables['udsg']
+  table.values = table.values.copy()
+  table.values[8,:] = 1. # pt bin 200-300: untagged light jets with eff==1
+  jets   = [j for event in events for j in event]
+  pt     = [j.pt for j in jets]
+  eta    = [j.eta for j in jets]
+  flavor = [j.partonFlavour for j in jets]
+  tagged = [tool.tagged(j) for j in jets]
+  counts = [len(event) for event in events]
+  arrays = tool.getWeights(pt,eta,flavor,tagged,counts)
+  for unc in tool.readers:
+    for ievt, event in enumerate(events):
+      expected = tool.getWeight(event,unc=unc)
+      result   = arrays[unc][ievt]
+      LOG.verb("%4s, event %d: getWeight=%.8f, getWeights=%.8f, jets=%s"%(unc,ievt,expected,result,event),level=2)
+      assert abs(result-expected)<=1e-6*max(1.,abs(expected)),\
+        "%s weight of event %d: getWeights=%r != getWeight=%r for jets %s"%(unc,ievt,result,expected,event)
+    single = tool.getWeights(pt[:3],eta[:3],flavor[:3],tagged[:3])[unc] # single event without counts
+    assert abs(single-tool.getWeight(events[0],unc=unc))<=1e-6, "%s weight of single event does not match!"%(unc)
+  print ">>> Weights of %d events with %d jets match for %s: OK"%(len(events),len(jets),', '.join(tool.readers))
+  
+
+def main():
+  tool   = BTagWeightTool('DeepCSV','medium',channel='mutau',year=2017,loadsys=True)
+  events = getevents()
+  testWeights(tool,events)
+  
+
+if __name__ == "__main__":
+  import sys
+  from argparse import ArgumentParser
+  argv = sys.argv
+  description = """Script to test vectorized b tag event weights."""
+  parser = ArgumentParser(prog="testBTagTool",description=description,epilog="Good luck!")
+  parser.add_argument('-v', '--verbose', dest='verbosity', type=int, nargs='?', const=1, default=0, action='store',
+                                         help="set verbosity" )
+  args = parser.parse_args()
+  LOG.verbosity = args.verbosity
+  main()
+  print "\n>>> Done."
+  
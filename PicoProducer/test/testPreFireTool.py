@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+# Author: Izaak Neutelings (July 2020)
+# Description: Test vectorized prefire weights of PreFireTool against a loop over objects
+#   test/testPreFireTool.py -v2
+import numpy as np
+from TauFW.common.tools.log import Logger
+from TauFW.common.tools.file import ensureTFile
+from TauFW.PicoProducer.analysis.columnar import Jagged
+from TauFW.PicoProducer.corrections.PreFireTool import PreFireTool, path
+LOG = Logger('testPreFireTool')
+
+
+def getevents():
+  """Create a handful of events by hand with jets, photons and electrons inside and outside
+  the pt and eta range of the maps, with and without matching between them."""
+  events = [
+    { # photon & electron in same jet, matched to each other (counted once), and extra electron in jet
+      'Jet':      [ (60.,2.5) ],
+      'Photon':   [ (40.,2.4,0,0) ],   # (pt, eta, jetIdx, electronIdx)
+      'Electron': [ (42.,2.4,0,0), (30.,-2.2,0,-1) ], # (pt, eta, jetIdx, photonIdx)
+    },
+    { # no jets: photon & electrons not in any jet
+      'Jet':      [ ],
+      'Photon':   [ (50.,-2.6,-1,0) ],
+      'Electron': [ (55.,-2.6,-1,0), (35.,2.1,-1,-1) ],
+    },
+    { # jet outside eta range; photon below pt threshold, but its electron passes (counted separately)
+      'Jet':      [ (80.,1.0), (45.,-2.3) ],
+      'Photon':   [ (15.,2.2,0,0), (25.,-2.3,1,-1) ],
+      'Electron': [ (35.,2.2,0,0) ],
+    },
+    { # no objects
+      'Jet':      [ ],
+      'Photon':   [ ],
+      'Electron': [ ],
+    },
+    { # jet above max pt; electron in other jet than its photon
+      'Jet':      [ (800.,-2.7), (100.,2.9) ],
+      'Photon':   [ (600.,-2.7,0,0), (30.,3.5,1,-1) ],
+      'Electron': [ (30.,2.9,1,0), (25.,2.05,-1,-1) ],
+    },
+  ]
+  return events
+  
+
+def getarrays(events):
+  """Convert events to a dictionary of jagged arrays of the branches, like in the columnar mode."""
+  fields = {
+    'Jet':      ['pt','eta'],
+    'Photon':   ['pt','eta','jetIdx','electronIdx'],
+    'Electron': ['pt','eta','jetIdx','photonIdx'],
+  }
+  arrays = { }
+  for collection, names in fields.iteritems():
+    counts = [len(event[collection]) for event in events]
+    for i, name in enumerate(names):
+      dtype   = np.int64 if 'Idx' in name else np.float64
+      content = np.array([o[i] for event in events for o in event[collection]],dtype=dtype)
+      arrays["%s_%s"%(collection,name)] = Jagged(content,counts)
+  return arrays
+  
+
+class RefPrefire:
+  """Straightforward loop over objects with TH2.FindBin, following PrefireCorr.py in nanoAOD-tools."""
+  
+  def __init__(self, tool, year=2017):
+    dataset     = '2017BtoF' if year==2017 else '2016BtoH'
+    self.tool   = tool
+    self.files  = [ ]
+    self.jetmap = self.gethist("L1prefiring_jetpt_%s"%dataset)
+    self.phomap = self.gethist("L1prefiring_photonpt_%s"%dataset)
+  
+  def gethist(self, histname):
+    file = ensureTFile(path+histname+".root")
+    self.files.append(file)
+    return file.Get(histname)
+  
+  def getprob(self, hist, eta, pt, maxpt, var):
+    bin  = hist.FindBin(eta,min(pt,maxpt-0.01))
+    prob = hist.GetBinContent(bin)
+    stat = hist.GetBinError(bin)
+    unc  = np.sqrt(stat**2+(0.2*prob)**2)
+    if var==0:
+      return max(prob-unc,0.0)
+    elif var==2:
+      return min(prob+unc,1.0)
+    return prob
+  
+  def getegprob(self, obj, var):
+    tool = self.tool
+    pt, eta = obj[:2]
+    if pt>=tool.PhotonMinPt and tool.PhotonMinEta<=abs(eta)<=tool.PhotonMaxEta:
+      return self.getprob(self.phomap,eta,pt,tool.PhotonMaxPt,var)
+    return None
+  
+  def getegweight(self, event, jid, var):
+    weight = 1.0
+    phoinjet = [ ]
+    for pid, pho in enumerate(event['Photon']):
+      if pho[2]!=jid: continue
+      phoprob = self.getegprob(pho,var)
+      if phoprob==None: continue
+      eleprob = self.getegprob(event['Electron'][pho[3]],var) if pho[3]>-1 else None
+      weight *= 1.-max(phoprob,eleprob or 0.)
+      phoinjet.append(pid)
+    for ele in event['Electron']:
+      if ele[2]!=jid or ele[3] in phoinjet: continue
+      eleprob = self.getegprob(ele,var)
+      if eleprob!=None:
+        weight *= 1.-eleprob
+    return weight
+  
+  def getweight(self, event, var):
+    tool   = self.tool
+    weight = 1.0
+    for jid, (pt, eta) in enumerate(event['Jet']):
+      jetweight = 1.0
+      if pt>=tool.JetMinPt and tool.JetMinEta<=abs(eta)<=tool.JetMaxEta:
+        jetweight = 1.-self.getprob(self.jetmap,eta,pt,tool.JetMaxPt,var)
+      weight *= min(jetweight,self.getegweight(event,jid,var))
+    weight *= self.getegweight(event,-1,var) # photons & electrons not in any jet
+    return weight
+  
+
+def testWeights(year=2017):
+  """Compare PreFireTool.getWeights for all events at once to a loop per event."""
+  LOG.header("testWeights")
+  tool    = PreFireTool(year)
+  ref     = RefPrefire(tool,year)
+  events  = getevents()
+  weights = tool.getWeights(getarrays(events))
+  for var, varname in enumerate(['Down','Nom','Up']):
+    for ievt, event in enumerate(events):
+      expected = ref.getweight(event,var)
+      result   = weights[var][ievt]
+      LOG.verb("%4s, event %d: loop=%.8f, getWeights=%.8f"%(varname,ievt,expected,result),level=2)
+      assert abs(result-expected)<=1e-9, "%s weight of event %d: getWeights=%r != loop=%r"%(varname,ievt,result,expected)
+  print ">>> Prefire weights of %d events match: OK"%(len(events))
+  
+
+def main():
+  testWeights(2017)
+  
+
+if __name__ == "__main__":
+  import sys
+  from argparse import ArgumentParser
+  argv = sys.argv
+  description = """Script to test vectorized prefire weights."""
+  parser = ArgumentParser(prog="testPreFireTool",description=description,epilog="Good luck!")
+  parser.add_argument('-v', '--verbose', dest='verbosity', type=int, nargs='?', const=1, default=0, action='store',
+                                         help="set verbosity" )
+  args = parser.parse_args()
+  LOG.verbosity = args.verbosity
+  main()
+  print "\n>>> Done."
+  
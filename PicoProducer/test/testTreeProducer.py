@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# Author: Izaak Neutelings (July 2020)
+# Description: Test buffered filling of TreeProducer with titled branches
+#   test/testTreeProducer.py -v2
+import os
+from TauFW.common.tools.log import Logger
+from TauFW.PicoProducer.analysis.TreeProducer import TreeProducer
+from ROOT import TFile
+LOG = Logger('testTreeProducer')
+
+
+def testBuffer(fname="testTreeProducer.root",nrows=25,buffersize=10):
+  """Fill rows through a small buffer with titled branches, and compare to the input."""
+  LOG.header("testBuffer")
+  out = TreeProducer(fname,None,buffersize=buffersize)
+  out.addBranch('pt_1', 'f', title="pt of first tau candidate")
+  out.addBranch('q_1',  'i', title="charge of first tau candidate")
+  out.addBranch('id_1', '?', title="ID of first tau candidate")
+  out.addBranch('evt',  'l', default=-1)
+  expected = [ ]
+  for i in xrange(nrows):
+    if i%2:
+      out.setrow(('pt_1','q_1','id_1','evt'),(20.+i,(-1)**i,i%3==0,i))
+    else:
+      out.pt_1[0] = 20.+i
+      out.q_1[0]  = (-1)**i
+      out.id_1[0] = i%3==0
+      out.evt[0]  = i
+    out.fill()
+    expected.append((20.+i,(-1)**i,i%3==0,i))
+  rows = out.getrow()
+  rows = rows.repeat(3)
+  rows['evt'] = [nrows,nrows+1,nrows+2]
+  out.fillrows(rows) # crosses buffer boundary
+  for i in xrange(nrows,nrows+3):
+    expected.append(expected[nrows-1][:3]+(i,))
+  out.endJob()
+  
+  file = TFile.Open(fname)
+  tree = file.Get('tree')
+  assert tree.GetEntries()==len(expected), "Expected %d entries, got %d"%(len(expected),tree.GetEntries())
+  assert tree.GetBranch('pt_1').GetTitle()=="pt of first tau candidate", "Branch title was not kept!"
+  for i, (pt, q, id, evt) in enumerate(expected):
+    tree.GetEntry(i)
+    result = (tree.pt_1,tree.q_1,bool(tree.id_1),tree.evt)
+    LOG.verb("row %2d: expected %r, got %r"%(i,(pt,q,id,evt),result),level=2)
+    assert result==(pt,q,id,evt), "Row %d: expected %r, got %r"%(i,(pt,q,id,evt),result)
+  file.Close()
+  os.remove(fname)
+  print ">>> Filled %d rows with buffer size %d: OK"%(len(expected),buffersize)
+  
+
+def main():
+  testBuffer(buffersize=10)
+  testBuffer(buffersize=0)
+  
+
+if __name__ == "__main__":
+  import sys
+  from argparse import ArgumentParser
+  argv = sys.argv
+  description = """Script to test buffered filling of TreeProducer."""
+  parser = ArgumentParser(prog="testTreeProducer",description=description,epilog="Good luck!")
+  parser.add_argument('-v', '--verbose', dest='verbosity', type=int, nargs='?', const=1, default=0, action='store',
+                                         help="set verbosity" )
+  args = parser.parse_args()
+  LOG.verbosity = args.verbosity
+  main()
+  print "\n>>> Done."
+  
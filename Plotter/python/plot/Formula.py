@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Description: Parse TTreeFormula strings (cuts, weights, variables) into an expression tree
+#              that can be evaluated on whole numpy column arrays, e.g.
+#                formula = getformula("(NUP==1?0.53:1)*(q_1*q_2<0 && abs(eta_1)<2.1)")
+#                values  = formula.evaluate({ 'NUP': nup, 'q_1': q1, 'q_2': q2, 'eta_1': eta1 })
+#              Compiled formulas are cached per unique string.
+import re
+import numpy as np
+from TauFW.Plotter.plot.utils import LOG
+
+tokenregex = re.compile(r"""\s*(?:
+  (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|          # number
+  (?P<name>[A-Za-z_]\w*(?:::[A-Za-z_]\w*)*)|              # branch, function or TMath::Function
+  (?P<op>&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%^&|~!<>?:(),]) # operator
+)""",re.VERBOSE)
+binaryops = [ # precedence from low to high (as in C, with '^' as power like TFormula)
+  ['||'], ['&&'], ['|'], ['&'], ['==','!='], ['<','<=','>','>='], ['<<','>>'], ['+','-'], ['*','/','%'],
+]
+precedence = { op: i for i, ops in enumerate(binaryops) for op in ops }
+constants  = {
+  'true': 1.0, 'false': 0.0, 'kTRUE': 1.0, 'kFALSE': 0.0,
+}
+functions  = { # function name -> vectorized function
+  'abs':   np.abs,     'fabs':  np.abs,     'TMath::Abs':   np.abs,
+  'min':   np.minimum, 'max':   np.maximum, 'TMath::Min':   np.minimum, 'TMath::Max':  np.maximum,
+  'sqrt':  np.sqrt,    'TMath::Sqrt':  np.sqrt,   'pow':   np.power, 'TMath::Power': np.power,
+  'exp':   np.exp,     'TMath::Exp':   np.exp,    'log':   np.log,   'TMath::Log':   np.log,
+  'log10': np.log10,   'TMath::Log10': np.log10,
+  'cos':   np.cos,     'sin':   np.sin,     'tan':   np.tan,  'cosh': np.cosh, 'sinh': np.sinh, 'tanh': np.tanh,
+  'acos':  np.arccos,  'asin':  np.arcsin,  'atan':  np.arctan, 'atan2': np.arctan2,
+  'TMath::Cos':  np.cos,  'TMath::Sin':  np.sin,  'TMath::Tan':   np.tan,
+  'TMath::CosH': np.cosh, 'TMath::SinH': np.sinh, 'TMath::ATan2': np.arctan2,
+  'floor': np.floor,   'ceil':  np.ceil,    'TMath::Floor': np.floor, 'TMath::Ceil': np.ceil,
+  'TMath::Pi': lambda: np.pi,
+}
+def toint(value):
+  return np.asarray(value).astype(np.int64)
+def divide(a, b):
+  """Divide like TTreeFormula, which returns 0 for division by zero."""
+  a, b = np.broadcast_arrays(np.asarray(a,dtype=np.float64),np.asarray(b,dtype=np.float64))
+  return np.divide(a,b,out=np.zeros(a.shape),where=(b!=0))
+operations = { # operator -> vectorized operation
+  '||':  lambda a, b: np.logical_or(a,b),
+  '&&':  lambda a, b: np.logical_and(a,b),
+  '|':   lambda a, b: toint(a)|toint(b),
+  '&':   lambda a, b: toint(a)&toint(b),
+  '<<':  lambda a, b: toint(a)<<toint(b),
+  '>>':  lambda a, b: toint(a)>>toint(b),
+  '==':  lambda a, b: a==b,    '!=': lambda a, b: a!=b,
+  '<':   lambda a, b: a<b,     '<=': lambda a, b: a<=b,
+  '>':   lambda a, b: a>b,     '>=': lambda a, b: a>=b,
+  '+':   lambda a, b: a+b,     '-':  lambda a, b: a-b,
+  '*':   lambda a, b: a*b,     '/':  divide,
+  '%':   lambda a, b: np.fmod(toint(a),toint(b)),
+  '^':   lambda a, b: np.power(a,b),
+  'neg': lambda a: -a,
+  'pos': lambda a: a,
+  '!':   lambda a: np.logical_not(a),
+  '~':   lambda a: ~toint(a),
+}
+formulas = { } # cache of compiled formulas
+
+
+def tokenize(string):
+  """Split a TTreeFormula string into a list of (type, value) tokens."""
+  tokens = [ ]
+  pos    = 0
+  string = string.rstrip()
+  while pos<len(string):
+    match = tokenregex.match(string,pos)
+    if not match or match.end()==pos:
+      raise ValueError("Formula: Could not parse %r at position %d: %r"%(string,pos,string[pos:pos+10]))
+    for type in ['num','name','op']:
+      if match.group(type)!=None:
+        tokens.append((type,match.group(type)))
+        break
+    pos = match.end()
+  return tokens
+
+
+class Formula(object):
+  """Expression tree of a TTreeFormula string, evaluated elementwise on numpy arrays.
+  Nodes are tuples: ('num',value), ('var',branch), ('call',func,args),
+  ('op',operator,args) and ('?:',condition,iftrue,iffalse)."""
+
+  def __init__(self, string):
+    self.string   = string
+    self.branches = set()
+    self.tokens   = tokenize(string.strip() or '1')
+    self.pos      = 0
+    self.tree     = self.parseternary()
+    if self.pos<len(self.tokens):
+      raise ValueError("Formula: Unexpected token %r in %r"%(self.tokens[self.pos][1],string))
+    del self.tokens
+
+  def __repr__(self):
+    return "<%s(%r) at %s>"%(self.__class__.__name__,self.string,hex(id(self)))
+
+  def peek(self):
+    if self.pos<len(self.tokens):
+      return self.tokens[self.pos]
+    return (None,None)
+
+  def next(self, expect=None):
+    type, value = self.peek()
+    if type==None:
+      raise ValueError("Formula: Unexpected end of %r"%(self.string))
+    if expect!=None and value!=expect:
+      raise ValueError("Formula: Expected %r, but found %r in %r"%(expect,value,self.string))
+    self.pos += 1
+    return type, value
+
+  def parseternary(self):
+    """Parse 'cond ? a : b' (lowest precedence, right-associative)."""
+    node = self.parsebinary(0)
+    if self.peek()==('op','?'):
+      self.next('?')
+      iftrue  = self.parseternary()
+      self.next(':')
+      iffalse = self.parseternary()
+      node    = ('?:',node,iftrue,iffalse)
+    return node
+
+  def parsebinary(self, level):
+    """Parse left-associative binary operators by precedence climbing."""
+    if level>=len(binaryops):
+      return self.parseunary()
+    node = self.parsebinary(level+1)
+    while True:
+      type, value = self.peek()
+      if type!='op' or precedence.get(value)!=level: break
+      self.next()
+      node = ('op',value,(node,self.parsebinary(level+1)))
+    return node
+
+  def parseunary(self):
+    type, value = self.peek()
+    if type=='op' and value in ['-','+','!','~']:
+      self.next()
+      op = {'-':'neg','+':'pos'}.get(value,value)
+      return ('op',op,(self.parseunary(),))
+    return self.parsepower()
+
+  def parsepower(self):
+    """Parse 'a^b' (right-associative, binds stronger than unary minus)."""
+    node = self.parseprimary()
+    if self.peek()==('op','^'):
+      self.next()
+      node = ('op','^',(node,self.parseunary()))
+    return node
+
+  def parseprimary(self):
+    type, value = self.next()
+    if type=='num':
+      return ('num',float(value))
+    elif type=='name':
+      if self.peek()==('op','('): # function call
+        if value not in functions:
+          raise ValueError("Formula: Unknown function %r in %r"%(value,self.string))
+        self.next('(')
+        args = [ ]
+        if self.peek()!=('op',')'):
+          args.append(self.parseternary())
+          while self.peek()==('op',','):
+            self.next(',')
+            args.append(self.parseternary())
+        self.next(')')
+        return ('call',value,tuple(args))
+      elif value in constants:
+        return ('num',constants[value])
+      self.branches.add(value)
+      return ('var',value)
+    elif value=='(':
+      node = self.parseternary()
+      self.next(')')
+      return node
+    raise ValueError("Formula: Unexpected token %r in %r"%(value,self.string))
+
+  def evaluate(self, columns, cache=None):
+    """Evaluate on a dictionary of numpy arrays (branch -> array).
+    Subexpressions can be shared between formulas via a cache dictionary."""
+    return self.evalnode(self.tree,columns,cache)
+
+  def evalnode(self, node, columns, cache=None):
+    if cache!=None and node in cache:
+      return cache[node]
+    kind = node[0]
+    if kind=='num':
+      return node[1]
+    elif kind=='var':
+      return columns[node[1]]
+    elif kind=='op':
+      result = operations[node[1]](*[self.evalnode(n,columns,cache) for n in node[2]])
+    elif kind=='call':
+      result = functions[node[1]](*[self.evalnode(n,columns,cache) for n in node[2]])
+    else: # ternary
+      condition = self.evalnode(node[1],columns,cache)
+      result    = np.where(condition,self.evalnode(node[2],columns,cache),self.evalnode(node[3],columns,cache))
+    if cache!=None:
+      cache[node] = result
+    return result
+
+
+def getformula(string):
+  """Get compiled formula from cache, or parse a new one."""
+  if string not in formulas:
+    formulas[string] = Formula(string)
+    LOG.verb("getformula: Compiled %r with branches %s"%(string,sorted(formulas[string].branches)),level=3)
+  return formulas[string]
+
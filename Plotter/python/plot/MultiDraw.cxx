@@ -8,22 +8,48 @@
 #include <TH1.h>
 #include <TH2.h>
 #include <TTreeFormula.h>
+#include <TTreeFormulaManager.h>
+#include <TEntryList.h>
+#include <TFile.h>
+#include <TROOT.h>
 #include <TStopwatch.h>
 #include <iostream>
+#include <vector>
+#include <string>
+#include <map>
+#include <thread>
+#include <mutex>
 using std::cout;
 using std::endl;
 
-void MultiDraw( TTree* tree, TTreeFormula* commonFormula, TObjArray* formulae, TObjArray* weights, TObjArray* hists, UInt_t listLen ){
+// Evaluate formula with index k at most once per event; values are cached until the next entry
+#define VALUE(k) (evaluated[k]==i ? values[k] : (evaluated[k]=i, values[k]=formulae[k]->EvalInstance()))
+
+void MultiDraw( TTree* tree, TTreeFormula* commonFormula, TObjArray* formulaList,
+                const std::vector<int>& xidx, const std::vector<int>& widx, TObjArray* hists,
+                Long64_t firstEntry=0, Long64_t nEntries=-1 ){
     
-    // Get an Element from an array
-    #define EL(type, array, index) dynamic_cast<type*>(array->At(index))
+    // Each histogram j is filled with the unique formulae with index xidx[j] and widx[j],
+    // so identical expressions are evaluated only once per event
+    UInt_t listLen = xidx.size(), nFormulae = formulaList->GetEntries();
+    std::vector<TTreeFormula*> formulae(nFormulae);
+    std::vector<TH1*> histos(listLen);
+    for(UInt_t k=0; k<nFormulae; k++)
+      formulae[k] = (TTreeFormula*) formulaList->At(k);
+    for(UInt_t j=0; j<listLen; j++)
+      histos[j] = (TH1*) hists->At(j);
+    std::vector<Double_t> values(nFormulae,0);
+    std::vector<Long64_t> evaluated(nFormulae,-1);
     
-    Long64_t i = 0, NumEvents = tree->GetEntries();
+    // Loop over entry range [firstEntry,firstEntry+nEntries), e.g. to split tree over several processes
+    // If the tree has an entry list, only loop over the entries in the list
+    Long64_t i = 0, NumEvents = (tree->GetEntryList() ? tree->GetEntryList()->GetN() : tree->GetEntries());
+    if(nEntries>=0 && firstEntry+nEntries<NumEvents) NumEvents = firstEntry+nEntries;
     Double_t commonWeight = 0, treeWeight = tree->GetWeight();
     Int_t treeNumber = -1;
     
     //TStopwatch watch;
-    for(i=0; i<NumEvents; i++){
+    for(i=firstEntry; i<NumEvents; i++){
         
         // Display progress every 20000 events
         //if (i%20000==0){
@@ -48,34 +74,41 @@ void MultiDraw( TTree* tree, TTreeFormula* commonFormula, TObjArray* formulae, T
         if(!commonWeight) continue;        
         commonWeight *= treeWeight;
         
-        Double_t value = 0, weight = 0;
         for(UInt_t j=0; j<listLen; j++){
-            // If the value or the weight formula is the same as the previous, then it can be re-used.
-            // In which case, this element fails to dynamic_cast to a formula, and evaluates to NULL
-            if(EL(TTreeFormula, formulae, j))
-              value = EL(TTreeFormula, formulae, j)->EvalInstance();
-            
-            if(EL(TTreeFormula, weights,  j))
-              weight = EL(TTreeFormula, weights, j)->EvalInstance() * commonWeight;
-            
+            // Evaluate the weight first, so the value is not computed if the weight vanishes
+            Double_t weight = VALUE(widx[j]) * commonWeight;
             if(weight)
-              EL(TH1, hists, j)->Fill(value, weight);
+              histos[j]->Fill(VALUE(xidx[j]), weight);
         }
     }
 }
 
 
 
-void MultiDraw2D( TTree* tree, TTreeFormula* commonFormula, TObjArray* xformulae, TObjArray* yformulae, TObjArray* weights, TObjArray* hists, UInt_t listLen ){
+void MultiDraw2D( TTree* tree, TTreeFormula* commonFormula, TObjArray* formulaList,
+                  const std::vector<int>& xidx, const std::vector<int>& yidx, const std::vector<int>& widx,
+                  TObjArray* hists, Long64_t firstEntry=0, Long64_t nEntries=-1 ){
     
-    // Get an Element from an array
-    #define EL(type, array, index) dynamic_cast<type*>(array->At(index))
+    // Each histogram j is filled with the unique formulae with index xidx[j], yidx[j] and widx[j],
+    // so identical expressions are evaluated only once per event
+    UInt_t listLen = xidx.size(), nFormulae = formulaList->GetEntries();
+    std::vector<TTreeFormula*> formulae(nFormulae);
+    std::vector<TH2*> histos(listLen);
+    for(UInt_t k=0; k<nFormulae; k++)
+      formulae[k] = (TTreeFormula*) formulaList->At(k);
+    for(UInt_t j=0; j<listLen; j++)
+      histos[j] = (TH2*) hists->At(j);
+    std::vector<Double_t> values(nFormulae,0);
+    std::vector<Long64_t> evaluated(nFormulae,-1);
     
-    Long64_t i = 0, NumEvents = tree->GetEntries();
+    // Loop over entry range [firstEntry,firstEntry+nEntries), e.g. to split tree over several processes
+    // If the tree has an entry list, only loop over the entries in the list
+    Long64_t i = 0, NumEvents = (tree->GetEntryList() ? tree->GetEntryList()->GetN() : tree->GetEntries());
+    if(nEntries>=0 && firstEntry+nEntries<NumEvents) NumEvents = firstEntry+nEntries;
     Double_t commonWeight = 0, treeWeight = tree->GetWeight();
     Int_t treeNumber = -1;
     
-    for(i=0; i<NumEvents; i++){
+    for(i=firstEntry; i<NumEvents; i++){
         
         if(treeNumber!=tree->GetTreeNumber()){
             treeWeight = tree->GetWeight();
@@ -87,23 +120,165 @@ void MultiDraw2D( TTree* tree, TTreeFormula* commonFormula, TObjArray* xformulae
         if(!commonWeight) continue;        
         commonWeight *= treeWeight;
         
-        Double_t xvalue = 0, yvalue = 0, weight = 0;
         for(UInt_t j=0; j<listLen; j++){
-            // If the value or the weight formula is the same as the previous, then it can be re-used.
-            // In which case, this element fails to dynamic_cast to a formula, and evaluates to NULL
-            if(EL(TTreeFormula, xformulae, j))
-                xvalue = EL(TTreeFormula, xformulae, j)->EvalInstance();
-            
-            if(EL(TTreeFormula, yformulae, j))
-                yvalue = EL(TTreeFormula, yformulae, j)->EvalInstance();
-            
-            if(EL(TTreeFormula, weights,  j))
-                weight = EL(TTreeFormula, weights, j)->EvalInstance() * commonWeight;
-            
+            // Evaluate the weight first, so the values are not computed if the weight vanishes
+            Double_t weight = VALUE(widx[j]) * commonWeight;
             if(weight)
-                EL(TH2, hists, j)->Fill(xvalue, yvalue, weight);
+              histos[j]->Fill(VALUE(xidx[j]), VALUE(yidx[j]), weight);
+        }
+    }
+}
+
+
+
+std::mutex MultiDrawMutex; // protect compilation of formulae
+
+void MultiDrawThread( const char* fname, const char* tname, const std::string selection,
+                      const std::vector<std::string>* xexps, const std::vector<std::string>* yexps,
+                      const std::vector<std::string>* wexps, std::vector<TH1*> hists,
+                      Long64_t firstEntry, Long64_t lastEntry, TEntryList* entryList, std::string* error ){
+    
+    // Each thread has its own file, tree and formulae
+    // Identical expressions are compiled & evaluated only once per event
+    // If a formula does not compile, the error is returned, and no entries are processed
+    TFile* file = 0;
+    TTree* tree = 0;
+    TTreeFormula* commonFormula = 0;
+    std::vector<TTreeFormula*> formulae;
+    std::vector<std::string> exprs;
+    std::vector<int> xidx, yidx, widx;
+    {
+      std::lock_guard<std::mutex> lock(MultiDrawMutex);
+      file = TFile::Open(fname,"READ");
+      tree = (TTree*) file->Get(tname);
+      if(entryList) tree->SetEntryList(entryList);
+      commonFormula = new TTreeFormula("commonFormula",selection.c_str(),tree);
+      commonFormula->SetQuickLoad(true);
+      if(!commonFormula->GetTree())
+        *error = Form("TTreeFormula did not compile: selection \"%s\"",selection.c_str());
+      TTreeFormulaManager* manager = new TTreeFormulaManager();
+      manager->Add(commonFormula);
+      auto getindex = [&](const std::string& expr) -> int {
+        if(expr.empty()) return -1;
+        for(size_t k=0; k<exprs.size(); k++)
+          if(exprs[k]==expr) return k;
+        TTreeFormula* formula = new TTreeFormula(Form("formula%lu",exprs.size()),expr.c_str(),tree);
+        formula->SetQuickLoad(true);
+        if(!formula->GetTree() && error->empty())
+          *error = Form("TTreeFormula did not compile: \"%s\"",expr.c_str());
+        manager->Add(formula);
+        formulae.push_back(formula);
+        exprs.push_back(expr);
+        return exprs.size()-1;
+      };
+      for(size_t j=0; j<hists.size(); j++){
+        xidx.push_back(getindex(xexps->at(j)));
+        yidx.push_back(getindex(yexps->at(j)));
+        widx.push_back(getindex(wexps->at(j)));
+      }
+      manager->Sync();
+      tree->SetNotify(manager);
+    }
+    
+    Double_t commonWeight = 0, treeWeight = tree->GetWeight();
+    std::vector<Double_t> values(formulae.size(),0);
+    std::vector<Long64_t> evaluated(formulae.size(),-1);
+    if(!error->empty()) lastEntry = firstEntry; // skip loop
+    for(Long64_t i=firstEntry; i<lastEntry; i++){
+        tree->LoadTree(tree->GetEntryNumber(i));
+        commonWeight = commonFormula->EvalInstance();
+        if(!commonWeight) continue;
+        commonWeight *= treeWeight;
+        for(size_t j=0; j<hists.size(); j++){
+          Double_t weight = VALUE(widx[j])*commonWeight;
+          if(!weight) continue;
+          if(yidx[j]<0)
+            hists[j]->Fill(VALUE(xidx[j]),weight);
+          else
+            ((TH2*) hists[j])->Fill(VALUE(xidx[j]),VALUE(yidx[j]),weight);
         }
     }
+    
+    {
+      std::lock_guard<std::mutex> lock(MultiDrawMutex);
+      tree->SetNotify(0);
+      tree->SetEntryList(0);
+      // TTreeFormulaManager does not own its formulae: delete them explicitly;
+      // the manager itself is deleted by ~TTreeFormula when its last formula is removed
+      for(size_t k=0; k<formulae.size(); k++)
+        delete formulae[k];
+      delete commonFormula;
+      delete entryList;
+      file->Close();
+      delete file;
+    }
 }
 
 
+
+std::string MultiDrawMT( const char* fname, const char* tname, const char* selection,
+                         const std::vector<std::string>& xexps, const std::vector<std::string>& yexps,
+                         const std::vector<std::string>& wexps, TObjArray* hists, UInt_t nThreads,
+                         Long64_t firstEntry=0, Long64_t nEntries=-1, TEntryList* entryList=0 ){
+    
+    // Split the entry range over nThreads threads, each filling its own clones of the histograms,
+    // which are added to the original histograms at the end
+    // If an entry list is given, only loop over the entries in the list
+    // Return an error message if a formula did not compile, else an empty string
+    ROOT::EnableThreadSafety();
+    Long64_t NumEvents = 0;
+    if(entryList){
+      NumEvents = entryList->GetN();
+    }else{
+      TFile* file = TFile::Open(fname,"READ");
+      NumEvents = ((TTree*) file->Get(tname))->GetEntries();
+      file->Close();
+      delete file;
+    }
+    if(nEntries>=0 && firstEntry+nEntries<NumEvents) NumEvents = firstEntry+nEntries;
+    if(NumEvents<=firstEntry) return "";
+    if(nThreads>NumEvents-firstEntry) nThreads = NumEvents-firstEntry;
+    
+    UInt_t listLen = hists->GetEntries();
+    std::vector<std::vector<TH1*> > clones(nThreads);
+    std::vector<std::thread> threads;
+    std::vector<std::string> errors(nThreads);
+    Long64_t step = (NumEvents-firstEntry)/nThreads;
+    for(UInt_t t=0; t<nThreads; t++){
+      std::map<TH1*,TH1*> cloned; // same histogram may be filled by several expressions
+      for(UInt_t j=0; j<listLen; j++){
+        TH1* hist = (TH1*) hists->At(j);
+        if(!cloned[hist]){
+          cloned[hist] = (TH1*) hist->Clone(Form("%s_thread%d",hist->GetName(),t));
+          cloned[hist]->SetDirectory(0);
+          cloned[hist]->Reset();
+        }
+        clones[t].push_back(cloned[hist]);
+      }
+      Long64_t first = firstEntry+t*step;
+      Long64_t last  = (t+1==nThreads ? NumEvents : first+step);
+      TEntryList* list = 0; // each thread needs its own copy
+      if(entryList){
+        list = (TEntryList*) entryList->Clone();
+        list->SetDirectory(0);
+      }
+      threads.push_back(std::thread(MultiDrawThread,fname,tname,std::string(selection),
+                                    &xexps,&yexps,&wexps,clones[t],first,last,list,&errors[t]));
+    }
+    for(UInt_t t=0; t<nThreads; t++)
+      threads[t].join();
+    
+    // Merge, unless a formula did not compile
+    std::string error = errors[0];
+    for(UInt_t t=0; t<nThreads; t++){
+      std::map<TH1*,bool> added;
+      for(UInt_t j=0; j<listLen; j++){
+        if(added[clones[t][j]]) continue;
+        if(error.empty())
+          ((TH1*) hists->At(j))->Add(clones[t][j]);
+        added[clones[t][j]] = true;
+        delete clones[t][j];
+      }
+    }
+    return error;
+}
@@ -4,12 +4,13 @@
 #              This script injects a MultiDraw method into TTree when it is imported.
 # Source: https://github.com/pwaller/minty/blob/master/minty/junk/MultiDraw.py
 import os, re
-from ROOT import gROOT, gDirectory, TObject, TTree, TObjArray, TTreeFormula,\
-                 TH1D, TH2D, TH2, SetOwnership, TTreeFormulaManager
+from ROOT import gROOT, gDirectory, TTree, TChain, TObjArray, TTreeFormula,\
+                 TH1D, TH2D, TH2, SetOwnership, TTreeFormulaManager, std
 moddir = os.path.dirname(__file__)
 gROOT.ProcessLine(".L %s/MultiDraw.cxx+O"%moddir)
 from ROOT import MultiDraw as _MultiDraw
 from ROOT import MultiDraw2D as _MultiDraw2D
+from ROOT import MultiDrawMT as _MultiDrawMT
 
 def makeTObjArray(theList):
   """Turn a python iterable into a ROOT TObjArray"""
@@ -23,6 +24,14 @@ def makeTObjArray(theList):
   return result
   
 
+def makestdvector(theList,type='string'):
+  """Turn a python iterable into a std::vector"""
+  result = std.vector(type)()
+  for item in theList:
+    result.push_back(item)
+  return result
+  
+
 varregex   = re.compile(r"(.*?)\s*>>\s*(.*?)\s*\(\s*(.*?)\s*\)$")
 varregex2D = re.compile(r"(.*?)\s*>>\s*(.*?)\s*$")
 binregex   = re.compile(r"(\d+)\s*,\s*([+-]?\d*\.?\d*)\s*,\s*([+-]?\d*\.?\d*)")
@@ -41,24 +50,50 @@ def MultiDraw(self, varexps, selection='1', drawoption="", **kwargs):
     either be specified with just a string containing the formula to be 
     drawn, the histogram name and bin configuration. 
     Alternatively it can be a tuple, with  said string, and an additional
-    string specifying the weight to be applied to that histogram only."""
+    string specifying the weight to be applied to that histogram only.
+    With nthreads>1, the entry range is split over several threads, each with
+    its own copy of the tree, formulae and histograms, which are merged at the end."""
     
     selection = kwargs.get('cut',       selection ) # selections cuts
     verbosity = kwargs.get('verbosity', 0         ) # verbosity
     poisson   = kwargs.get('poisson',   False     ) # kPoisson errors for data
     sumw2     = kwargs.get('sumw2',     False     ) # sumw2 for MC
     histlist  = kwargs.get('hists',     [ ]       ) # to not rely on gDirectory.Get(histname)
+    first     = kwargs.get('firstentry', 0        ) # first entry to process
+    nentries  = kwargs.get('nentries',  -1        ) # number of entries to process (-1 = all)
+    nthreads  = kwargs.get('nthreads',  1         ) # number of threads to split the entry range over
     
     hists     = { }
-    results, xformulae, yformulae, weights = [ ], [ ], [ ], [ ]
-    lastXVar, lastYVar, lastWeight = None, None, None
+    results, formulae, formidx = [ ], [ ], { } # unique formulae, and their index
+    xidx, yidx, widx    = [ ], [ ], [ ] # index of formula for each histogram
+    xexps, yexps, wexps = [ ], [ ], [ ] # formula strings for multithreading
+    
+    # MULTITHREADING: each thread compiles its own formulae from the strings, so do not compile them here
+    file = self.GetCurrentFile()
+    multithread = nthreads>1
+    if multithread and (isinstance(self,TChain) or not file):
+      print ">>> MultiDraw: Warning! Multithreading only supported for a TTree in a file, using one thread..."
+      multithread = False
     
     # A weight common to everything being drawn
-    commonFormula = TTreeFormula("commonFormula", selection, self)
-    commonFormula.SetQuickLoad(True)
+    if not multithread:
+      commonFormula = TTreeFormula("commonFormula", selection, self)
+      commonFormula.SetQuickLoad(True)
+      
+      if not commonFormula.GetTree():
+        raise RuntimeError('MultiDraw: TTreeFormula did not compile:\n  selection:  "%s"\n  varexps:    %s'%(selection,varexps))
     
-    if not commonFormula.GetTree():
-      raise RuntimeError('MultiDraw: TTreeFormula did not compile:\n  selection:  "%s"\n  varexps:    %s'%(selection,varexps))
+    def getindex(expr,type,varexp):
+      """Return index of expression in table of unique formulae, compiling it if new."""
+      if expr not in formidx:
+        if not multithread:
+          formula = TTreeFormula("formula%i"%len(formulae),expr,self)
+          if not formula.GetTree():
+            raise RuntimeError("MultiDraw: TTreeFormula %r did not compile:\n  %-7s  %r\n  varexp:  %r"%(type,type+':',expr,varexp))
+          formula.SetQuickLoad(True)
+          formulae.append(formula)
+        formidx[expr] = len(formidx)
+      return formidx[expr]
     
     for i, varexp in enumerate(varexps):
         #print '  Variable expression: %s'%(varexp,)
@@ -127,59 +162,50 @@ def MultiDraw(self, varexps, selection='1', drawoption="", **kwargs):
           hists[name] = hist
         results.append(hist)
         
-        # CHECK that the next formula is different to the previous one.
-        # If it is not, we add an ordinary TObject. In this way, the
-        # dynamic cast in MultiDraw.cxx fails, giving 'NULL', and the previous
-        # value is used. This saves the recomputing of identical values
-        if xvar!=lastXVar:
-          formula = TTreeFormula("formula%i"%i,xvar,self)
-          if not formula.GetTree():
-            raise RuntimeError("MultiDraw: TTreeFormula 'xvar' did not compile:\n  xvar:    %r\n  varexp:  %r"%(xvar,varexp))
-          formula.SetQuickLoad(True)
-          xformulae.append(formula)
-        else:
-          xformulae.append(TObject())
-        
+        # LOOK UP formulae in a table of unique expressions, so that each
+        # expression is compiled once and evaluated at most once per event
+        # in MultiDraw.cxx, no matter how many histograms share it
+        xidx.append(getindex(xvar,'xvar',varexp))
         if yvar!=None:
-          if yvar!=lastYVar:
-            formula = TTreeFormula("formula%i"%i,yvar,self)
-            if not formula.GetTree():
-              raise RuntimeError("MultiDraw: TTreeFormula 'yvar' did not compile:\n  yvar:    %r\n  varexp:  %r"%(yvar,varexp))
-            formula.SetQuickLoad(True)
-            yformulae.append(formula)
-          else:
-            yformulae.append(TObject())
-        
-        if weight!=lastWeight:
-          formula = TTreeFormula("weight%i"%i,weight,self)
-          if not formula.GetTree():
-            raise RuntimeError("MultiDraw: TTreeFormula 'weight' did not compile:\n  weight:  %r\n  varexp:  %r"%(weight,varexp))
-          formula.SetQuickLoad(True)
-          weights.append(formula)
-        else:
-          weights.append(TObject())
-        
-        lastXVar, lastYVar, lastWeight = xvar, yvar, weight
+          yidx.append(getindex(yvar,'yvar',varexp))
+        widx.append(getindex(weight,'weight',varexp))
+        xexps.append(xvar)
+        yexps.append(yvar or "")
+        wexps.append(weight)
+    
+    if len(yidx) not in [0,len(xidx)]:
+      raise RuntimeError("MultiDraw: Given a mix of arguments for 1D (%d) and 2D (%d) histograms"%(len(xidx),len(yidx)))
+    
+    # MULTITHREADING
+    if multithread:
+      treepath = self.GetDirectory().GetPath().split(':',1)[-1].strip('/')
+      treepath = "%s/%s"%(treepath,self.GetName()) if treepath else self.GetName()
+      if verbosity>=2:
+        print ">>> MultiDraw: Running %d threads on %s:%s"%(nthreads,file.GetName(),treepath)
+      error = _MultiDrawMT(file.GetName(),treepath,selection,makestdvector(xexps),makestdvector(yexps),
+                           makestdvector(wexps),makeTObjArray(results),nthreads,first,nentries,self.GetEntryList())
+      if error:
+        raise RuntimeError('MultiDraw: %s\n  selection:  "%s"\n  varexps:    %s'%(error,selection,varexps))
+      return results
     
     # CHECK that formulae are told when tree changes
     manager = TTreeFormulaManager()
-    for formula in xformulae + yformulae + weights + [commonFormula, ]:
-      if isinstance(formula,TTreeFormula):
-        manager.Add(formula)
+    for formula in formulae + [commonFormula, ]:
+      manager.Add(formula)
     
     manager.Sync()
     self.SetNotify(manager)
     
     # DRAW
     if verbosity>=2:
-      print ">>> MultiDraw: xformulae=%s, yformulae=%s"%(xformulae,yformulae)
-      print ">>> MultiDraw: weights=%s, results=%s"%(weights,results)
-    if len(yformulae)==0:
-      _MultiDraw(self,commonFormula,makeTObjArray(xformulae),makeTObjArray(weights),makeTObjArray(results),len(xformulae))
-    elif len(xformulae)==len(yformulae):
-      _MultiDraw2D(self,commonFormula,makeTObjArray(xformulae),makeTObjArray(yformulae),makeTObjArray(weights),makeTObjArray(results),len(xformulae))
+      print ">>> MultiDraw: %d unique formulae for %d histograms: %s"%(len(formulae),len(results),sorted(formidx,key=formidx.get))
+      print ">>> MultiDraw: xidx=%s, yidx=%s, widx=%s, results=%s"%(xidx,yidx,widx,results)
+    if len(yidx)==0:
+      _MultiDraw(self,commonFormula,makeTObjArray(formulae),makestdvector(xidx,'int'),makestdvector(widx,'int'),
+                 makeTObjArray(results),first,nentries)
     else:
-      raise RuntimeError("MultiDraw: Given a mix of arguments for 1D (%d) and 2D (%d) histograms"%(len(xformulae),len(yformulae)))
+      _MultiDraw2D(self,commonFormula,makeTObjArray(formulae),makestdvector(xidx,'int'),makestdvector(yidx,'int'),
+                   makestdvector(widx,'int'),makeTObjArray(results),first,nentries)
     
     return results
     
@@ -3,8 +3,19 @@
 # Source: https://stackoverflow.com/questions/6893968/how-to-get-the-return-value-from-a-thread-in-python
 #         https://stackoverflow.com/questions/10415028/how-can-i-recover-the-return-value-of-a-function-passed-to-multiprocessing-proce/28799109
 #from threading import Thread as _Thread
-from multiprocessing import Process, Pipe, Manager
-manager = Manager()
+from time import sleep
+from array import array
+from math import sqrt
+from multiprocessing import Process, Pipe, cpu_count
+import ROOT
+nworkers = cpu_count() # default maximum number of simultaneous processes
+
+
+def setnworkers(nworkers_):
+  """Set default maximum number of simultaneous processes."""
+  global nworkers
+  nworkers = max(1,int(nworkers_))
+  return nworkers
 
 
 class Thread(Process):
@@ -29,20 +40,98 @@ class Thread(Process):
     
 
 
+class PackedHist(object):
+    """Compact, picklable container of a histogram's binning, contents and style,
+    to send histograms between processes as arrays instead of pickled ROOT objects."""
+
+    def __init__(self,hist):
+      ndim          = hist.GetDimension()
+      axes          = [hist.GetXaxis(),hist.GetYaxis()][:ndim]
+      ncells        = hist.GetNcells()
+      self.clsname  = hist.ClassName()
+      self.name     = hist.GetName()
+      self.title    = hist.GetTitle()
+      self.option   = hist.GetOption()
+      self.edges    = [array('d',[a.GetBinLowEdge(i) for i in xrange(1,a.GetNbins()+2)]) for a in axes]
+      self.titles   = [a.GetTitle() for a in axes]
+      self.contents = array('d',[hist.GetBinContent(i) for i in xrange(ncells)])
+      self.sumw2    = array('d',[hist.GetBinError(i)**2 for i in xrange(ncells)]) if hist.GetSumw2N()>0 else None
+      self.entries  = hist.GetEntries()
+      self.erropt   = hist.GetBinErrorOption()
+      self.style    = (hist.GetLineColor(),hist.GetLineStyle(),hist.GetLineWidth(),
+                       hist.GetFillColor(),hist.GetFillStyle(),hist.GetMarkerColor(),hist.GetMarkerStyle())
+
+    def unpack(self):
+      """Rebuild histogram."""
+      binning = [ ]
+      for edges in self.edges:
+        binning += [len(edges)-1,edges]
+      hist = getattr(ROOT,self.clsname)(self.name,self.title,*binning)
+      hist.SetDirectory(0)
+      for axis, title in zip([hist.GetXaxis(),hist.GetYaxis()],self.titles):
+        axis.SetTitle(title)
+      if self.sumw2!=None:
+        hist.Sumw2()
+        for i, (content, sumw2) in enumerate(zip(self.contents,self.sumw2)):
+          hist.SetBinContent(i,content)
+          hist.SetBinError(i,sqrt(sumw2))
+      else:
+        for i, content in enumerate(self.contents):
+          hist.SetBinContent(i,content)
+      hist.SetEntries(self.entries)
+      hist.SetBinErrorOption(self.erropt)
+      hist.SetOption(self.option)
+      hist.SetLineColor(self.style[0]);   hist.SetLineStyle(self.style[1]);  hist.SetLineWidth(self.style[2])
+      hist.SetFillColor(self.style[3]);   hist.SetFillStyle(self.style[4])
+      hist.SetMarkerColor(self.style[5]); hist.SetMarkerStyle(self.style[6])
+      return hist
+
+
+def packhists(obj):
+  """Recursively replace histograms in (nested) lists, tuples or dictionaries by PackedHist."""
+  if isinstance(obj,ROOT.TH1):
+    return PackedHist(obj)
+  elif isinstance(obj,list):
+    return [packhists(o) for o in obj]
+  elif isinstance(obj,tuple):
+    return tuple(packhists(o) for o in obj)
+  elif isinstance(obj,dict):
+    return { k: packhists(v) for k, v in obj.iteritems() }
+  return obj
+
+
+def unpackhists(obj):
+  """Recursively rebuild histograms from PackedHist."""
+  if isinstance(obj,PackedHist):
+    return obj.unpack()
+  elif isinstance(obj,list):
+    return [unpackhists(o) for o in obj]
+  elif isinstance(obj,tuple):
+    return tuple(unpackhists(o) for o in obj)
+  elif isinstance(obj,dict):
+    return { k: unpackhists(v) for k, v in obj.iteritems() }
+  return obj
+
+
 class MultiProcessor:
-    """Class to get manage multiple processes and their return."""
+    """Class to get manage multiple processes and their return.
+    At most ncores processes run simultaneously. Processes are only started
+    when iterating or joining, the largest tasks first, to keep all workers busy."""
     
-    def __init__(self,name='nameless'):
+    def __init__(self,name='nameless',ncores=None):
       self.name    = name
-      self.procs   = [ ]
+      self.ncores  = ncores or nworkers # maximum number of simultaneous processes
+      self.procs   = [ ] # all processes in order of submission
+      self.queue   = [ ] # processes waiting to be started
       
     def __iter__(self):
       """To loop over processes, and do process.join()."""
-      for process, endin, endout in self.procs:
-        yield ReturnProcess(process,endin,endout)
+      for process in self.procs:
+        yield process
       
-    def start(self, target, args=(), kwargs={}, group=None, name=None, verbose=False, parallel=True, kwret=None):
-      """Start and save process. Create a pipe to return output."""
+    def start(self, target, args=(), kwargs={}, group=None, name=None, verbose=False, parallel=True, kwret=None, size=0):
+      """Queue process with a task size (e.g. file size) for scheduling.
+      Create a pipe to return output."""
       if parallel:
         endout, endin = Pipe(False)
         if kwret:
@@ -53,22 +142,61 @@ class MultiProcessor:
           mptarget    = self.target
         process       = Process(group,mptarget,name,newargs,kwargs)
         process.kwret = kwret
-        process.start()
+        retproc       = ReturnProcess(process,endin,endout,pool=self,size=size)
+        self.queue.append(retproc)
       else:
         process = SimpleProcess(target,name,args,kwargs,kwret=kwret)
-        endin   = None
-        endout  = process.start()
-      self.procs.append((process,endin,endout))
+        retproc = ReturnProcess(process,None,process.start())
+      self.procs.append(retproc)
+
+    def running(self):
+      return [p for p in self.procs if p.started and not p.done]
+
+    def schedule(self):
+      """Start largest queued processes until all workers are busy."""
+      nfree = self.ncores-len(self.running())
+      if nfree>0 and self.queue:
+        self.queue.sort(key=lambda p: -p.size)
+        for retproc in self.queue[:nfree]:
+          retproc.process.start()
+          retproc.started = True
+        self.queue = self.queue[nfree:]
+
+    def wait(self,retproc):
+      """Keep workers busy and collect output until given process is done."""
+      while not retproc.done:
+        self.schedule()
+        for proc in self.running():
+          if proc.endout.poll(): # receive before joining, so large output does not block the pipe
+            proc.output = proc.endout.recv()
+            proc.process.join()
+            proc.done   = True
+          elif not proc.process.is_alive() and not proc.endout.poll(): # crashed without output
+            proc.process.join()
+            proc.done   = True
+            self.terminate()
+            raise RuntimeError("MultiThread.MultiProcessor.wait: Process %r ended without output (exit code %s)!"%(proc.name,proc.process.exitcode))
+        if not retproc.done:
+          sleep(0.01)
+      self.schedule()
+      
+    def terminate(self):
+      """Stop all running processes, and drop the queued ones."""
+      self.queue = [ ]
+      for proc in self.running():
+        proc.process.terminate()
+        proc.process.join()
+        proc.done = True
       
     def target(self,*args,**kwargs):
       """Return the output to a pipe."""
       # endin.send(target(*args,**kwargs))
-      args[0].send(args[1](*args[2:],**kwargs))
+      args[0].send(packhists(args[1](*args[2:],**kwargs)))
       
     def target_with_kwret(self,*args,**kwargs):
       """Return the output to a pipe with an extra key-word return value ("by reference")."""
       # endin.send((target(*args,**kwargs),kwret))
-      args[0].send((args[1](*args[3:],**kwargs), kwargs[args[2]]))
+      args[0].send(packhists((args[1](*args[3:],**kwargs), kwargs[args[2]])))
     
 
 class SimpleProcess:
@@ -89,21 +217,26 @@ class SimpleProcess:
 class ReturnProcess:
     """Class contain a process and its return value passed through a pipe."""
     
-    def __init__(self,process,endin,endout):
+    def __init__(self,process,endin,endout,pool=None,size=0):
       self.name    = process.name
       self.process = process
       self.endin   = endin
       self.endout  = endout
+      self.pool    = pool  # MultiProcessor scheduling this process
+      self.size    = size  # task size for scheduling
+      self.started = False
+      self.done    = False
+      self.output  = None  # output received through pipe
       
     def join(self,*args,**kwargs):
       """Join process, and return output."""
       if isinstance(self.process,Process):
-        self.process.join(*args) # wait for process to finish
+        self.pool.wait(self) # wait for process to finish
         #if self.endin:
         #  self.endin.close()
         kwret = self.process.kwret
         if kwret in kwargs:
-          out, kwretval = self.endout.recv()
+          out, kwretval = unpackhists(self.output)
           if isinstance(kwretval,dict):
             kwargs[kwret].update(kwretval) # dict only
           elif isinstance(kwretval,list):
@@ -111,8 +244,9 @@ class ReturnProcess:
           else:
             print "Warning! MultiThread.ReturnProcess.join: No implementation for keyword return value '%s' of type %s..."%(kwret,type(kwretval))
           return out
-        return self.endout.recv()
+        return unpackhists(self.output)
       else:
+        kwret = self.process.kwret
         if kwret in kwargs:
           kwretval = self.process.kwargs[kwret]
           if isinstance(kwretval,dict):
@@ -123,4 +257,3 @@ class ReturnProcess:
             print "Warning! MultiThread.ReturnProcess.join: No implementation for keyword return value '%s' of type %s..."%(kwret,type(kwretval))
         return self.endout
     
-
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Description: Columnar alternative to MultiDraw: read all branches needed by a list of
+#              variable expressions in large chunks as numpy arrays, evaluate the
+#              selection and weights vectorized, and fill all histograms in bulk.
+#              This script injects a NumpyDraw method into TTree when it is imported.
+#              Branches are read with uproot3 (if available) or root_numpy.
+import re
+from math import sqrt
+import numpy as np
+from ROOT import gDirectory, TTree, TH1, TH2
+from TauFW.Plotter.plot.utils import LOG
+from TauFW.Plotter.plot.Formula import getformula
+try:
+  import uproot
+  if not uproot.__version__.startswith('3.'): # only uproot3's API (entrysteps, namedecode) is supported
+    uproot = None
+except ImportError:
+  uproot = None
+try:
+  from root_numpy import tree2array
+except ImportError:
+  tree2array = None
+
+
+varregex    = re.compile(r"(.*?)\s*>>\s*(.*?)\s*$")
+
+
+def splitvarexp(varexp):
+  """Split 'yvar:xvar' expressions for 2D histograms, ignoring '::' and ternary colons."""
+  nternary = 0
+  for i, char in enumerate(varexp):
+    if char=='?':
+      nternary += 1
+    elif char==':' and varexp[i-1:i]!=':' and varexp[i+1:i+2]!=':':
+      if nternary==0:
+        return varexp[:i].strip(), varexp[i+1:].strip()
+      nternary -= 1
+  return None, varexp
+
+
+def getbinedges(axis):
+  """Get bin edges of a histogram axis as numpy array."""
+  nbins = axis.GetNbins()
+  return np.array([axis.GetBinLowEdge(i) for i in xrange(1,nbins+2)],dtype=np.float64)
+
+
+def getbinindex(edges, values):
+  """Compute ROOT bin index (0 = underflow, nbins+1 = overflow) of each value."""
+  return np.searchsorted(edges,values,side='right')
+
+
+def iterarrays(tree, branches, chunksize=1000000, start=0, stop=None):
+  """Iterate over chunks of a tree, yielding a dictionary of numpy arrays for the given branches."""
+  nentries = tree.GetEntries()
+  if stop==None or stop>nentries:
+    stop = nentries
+  branches = sorted(branches)
+  if uproot: # read with uproot directly from file
+    fname  = tree.GetCurrentFile().GetName()
+    tpath  = tree.GetDirectory().GetPath().split(':',1)[-1].strip('/') # directory of tree in file
+    tpath  = "%s/%s"%(tpath,tree.GetName()) if tpath else tree.GetName()
+    utree  = uproot.open(fname)[tpath]
+    for arrays in utree.iterate(branches,entrysteps=chunksize,entrystart=start,entrystop=stop,namedecode='utf-8'):
+      yield arrays
+  elif tree2array: # read with root_numpy
+    for first in xrange(start,stop,chunksize):
+      array = tree2array(tree,branches=branches,start=first,stop=min(first+chunksize,stop))
+      yield { b: array[b] for b in branches }
+  else:
+    LOG.throw(ImportError,"NumpyDraw: Need uproot3 or root_numpy to read branches as numpy arrays!")
+
+
+def fillhist(hist, sumw, sumw2, nentries, weighted=True):
+  """Add bin contents (incl. under- and overflow) and squared weights to a histogram.
+  Like TH1::Fill, the sum of squared weights is enabled for weights other than 1."""
+  entries  = hist.GetEntries()
+  if weighted and hist.GetSumw2N()==0:
+    hist.Sumw2()
+  dosumw2  = hist.GetSumw2N()>0
+  for bin, (content, content2) in enumerate(zip(sumw,sumw2)):
+    if content2==0: continue
+    if dosumw2:
+      error = hist.GetBinError(bin)
+      hist.SetBinContent(bin,hist.GetBinContent(bin)+content)
+      hist.SetBinError(bin,sqrt(error*error+content2))
+    else:
+      hist.SetBinContent(bin,hist.GetBinContent(bin)+content)
+  hist.SetEntries(entries+nentries)
+  return hist
+
+
+def NumpyDraw(self, varexps, selection='1', drawoption="", **kwargs):
+    """Draws multiple histograms in one loop over chunks of a tree (self).
+    Same interface as MultiDraw:
+      tree.NumpyDraw( [ ("pt_1 >> a", "weightA"), "pt_2 >> b" ], "pt_1>20",
+                      hists=[ahist,bhist] )
+    Instead of evaluating a TTreeFormula per event, all branches used in
+    the variables, selection and weights are read in large chunks as numpy
+    arrays, the expressions are evaluated elementwise, and the histograms
+    are filled in bulk with numpy.bincount."""
+
+    selection = kwargs.get('cut',       selection ) # selections cuts
+    verbosity = kwargs.get('verbosity', 0         ) # verbosity
+    poisson   = kwargs.get('poisson',   False     ) # kPoisson errors for data
+    sumw2     = kwargs.get('sumw2',     False     ) # sumw2 for MC
+    histlist  = kwargs.get('hists',     [ ]       ) # to not rely on gDirectory.Get(histname)
+    chunksize = kwargs.get('chunksize', 1000000   ) # number of entries read per chunk
+    first     = kwargs.get('firstentry', 0        ) # first entry to process
+    nentries  = kwargs.get('nentries',  -1        ) # number of entries to process (-1 = all)
+
+    # PREPARE histograms & formulae
+    hists    = { }
+    results  = [ ]
+    entries  = [ ] # (hist, xedges, yedges, xvar, yvar, weight)
+    formulae = { } # formula string -> compiled Formula
+    for i, varexp in enumerate(varexps):
+      weight = None
+      if isinstance(varexp,tuple):
+        varexp, weight = varexp
+      if not varexp: varexp = '1'
+      if not weight: weight = '1'
+      match = varregex.match(varexp)
+      if not match or '(' in match.group(2):
+        raise RuntimeError('NumpyDraw: Could not parse formula, or binning in varexp is not supported: "%s"'%varexp)
+      xvar, name = match.groups()
+      if name.startswith("+") and name[1:] in hists:
+        hist = hists[name[1:]] # add content to existing histogram
+      elif i<len(histlist):
+        hist = histlist[i]
+      else:
+        hist = gDirectory.Get(name)
+        if not hist:
+          raise RuntimeError('NumpyDraw: Could not find histogram to fill "%s" in current directory (varexp "%s").'%(name,varexp))
+      yvar, xvar = splitvarexp(xvar)
+      if yvar!=None and not isinstance(hist,TH2):
+        raise RuntimeError('NumpyDraw: Existing histogram with name "%s" is not 2D! Found xvar="%s", yvar="%s"...'%(name,xvar,yvar))
+      if sumw2:
+        hist.Sumw2()
+      elif poisson:
+        hist.SetBinErrorOption(TH1.kPoisson)
+      if drawoption:
+        hist.SetDrawOption(drawoption)
+      if name not in hists:
+        hists[name] = hist
+      results.append(hist)
+      xedges = getbinedges(hist.GetXaxis())
+      yedges = getbinedges(hist.GetYaxis()) if yvar!=None else None
+      entries.append((hist,xedges,yedges,xvar,yvar,weight))
+      for formula in [xvar,yvar,weight]:
+        if formula!=None and formula not in formulae:
+          formulae[formula] = None
+    formulae[selection] = None
+
+    # COMPILE formulae & FIND branches
+    branchlist = [b.GetName() for b in self.GetListOfBranches()]
+    branches   = set()
+    for string in formulae:
+      formula = getformula(string)
+      missing = [b for b in formula.branches if b not in branchlist]
+      if missing:
+        raise ValueError("NumpyDraw: Did not find branch(es) %s of formula %r in tree %r"%(', '.join(missing),string,self.GetName()))
+      formulae[string] = formula
+      branches.update(formula.branches)
+    if not branches: # need at least one branch to count number of entries
+      branches.add(branchlist[0])
+    if verbosity>=2:
+      print ">>> NumpyDraw: branches=%s"%(sorted(branches))
+      print ">>> NumpyDraw: formulae=%s"%(formulae.keys())
+
+    # FILL histograms in chunks
+    treeweight = self.GetWeight()
+    nbins      = [h.GetNcells() for h in results]
+    sumws      = [np.zeros(n) for n in nbins]
+    sumw2s     = [np.zeros(n) for n in nbins]
+    nfilled    = [0]*len(results)
+    weighted   = [False]*len(results) # any weight other than 1
+    stop       = first+nentries if nentries>=0 else None
+    for arrays in iterarrays(self,branches,chunksize=chunksize,start=first,stop=stop):
+      columns = { b: np.asarray(a,dtype=np.float64) for b, a in arrays.iteritems() }
+      nevts   = len(columns.itervalues().next())
+      values  = { } # evaluate each formula once per chunk
+      cache   = { } # share common subexpressions between formulae
+      def evaluate(string):
+        if string not in values:
+          value = np.asarray(formulae[string].evaluate(columns,cache),dtype=np.float64)
+          if value.ndim==0: # constant
+            value = np.full(nevts,value,dtype=np.float64)
+          values[string] = value
+        return values[string]
+      common = evaluate(selection)*treeweight
+      mask   = common!=0
+      if not mask.any(): continue
+      common = common[mask]
+      for i, (hist, xedges, yedges, xvar, yvar, weight) in enumerate(entries):
+        wvals  = common*evaluate(weight)[mask]
+        filled = wvals!=0
+        wvals  = wvals[filled]
+        index  = getbinindex(xedges,evaluate(xvar)[mask][filled])
+        if yvar!=None: # global bin = xbin + (nxbins+2)*ybin
+          index += (len(xedges)+1)*getbinindex(yedges,evaluate(yvar)[mask][filled])
+        sumws[i]    += np.bincount(index,weights=wvals,minlength=nbins[i])
+        sumw2s[i]   += np.bincount(index,weights=wvals*wvals,minlength=nbins[i])
+        nfilled[i]  += len(index)
+        weighted[i] = weighted[i] or bool((wvals!=1).any())
+    for hist, sumw, sumw2, nentry, isweighted in zip(results,sumws,sumw2s,nfilled,weighted):
+      fillhist(hist,sumw,sumw2,nentry,isweighted)
+
+    return results
+
+TTree.NumpyDraw = NumpyDraw # add NumpyDraw to TTree as a class method
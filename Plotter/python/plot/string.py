@@ -231,6 +231,18 @@ def joinweights(*weights,**kwargs):
   return weights
   
 
+def subweight(weight,replacements,**kwargs):
+  """Replace substrings of a weight, given one (pattern, substitution) pair, or a list of them."""
+  if not replacements:
+    return weight
+  if len(replacements)==2 and isinstance(replacements[0],str):
+    replacements = [replacements]
+  for pattern, substitution in replacements:
+    weight = re.sub(pattern,substitution,weight)
+  weight = weight.replace("**","*").strip('*')
+  return weight
+  
+
 def joincuts(*cuts,**kwargs):
   """Joins selection strings and apply weight if needed."""
   verbosity = LOG.getverbosity(kwargs)
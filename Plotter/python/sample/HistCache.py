@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Description: Persistent on-disk cache of filled histograms, so replotting the same
+#              variables (e.g. after cosmetic changes) does not need to loop over trees again.
+#              Each histogram is stored in its own ROOT file, named by a hash of
+#              the input file signature, tree name, cuts & weights, variable and binning.
+#              Least-recently-used files are removed if the total size exceeds a maximum.
+#              Entry lists of events passing a selection are cached as well, so later fills
+#              with the same selection only loop over the selected entries.
+import os, re, glob
+from hashlib import md5
+from ROOT import TFile, TObject
+from TauFW.common.tools.file import ensuredir
+from TauFW.common.tools.log import Logger
+LOG = Logger('HistCache')
+
+
+class HistCache(object):
+  """Cache of histograms in a directory with size-bounded LRU eviction."""
+
+  def __init__(self, cachedir, maxsize=2000, **kwargs):
+    self.cachedir  = ensuredir(os.path.expandvars(os.path.expanduser(cachedir)))
+    self.maxsize   = maxsize # maximum total size [MB]
+    self.verbosity = LOG.getverbosity(kwargs)
+    self.nhits     = 0
+    self.nmisses   = 0
+
+  def __repr__(self):
+    return "<%s(%r,maxsize=%sMB) at %s>"%(self.__class__.__name__,self.cachedir,self.maxsize,hex(id(self)))
+
+  @staticmethod
+  def getsignature(file, tree):
+    """Signature of input file and tree: path, UUID, and modification time & size if local."""
+    fname     = file.GetName()
+    signature = [fname,file.GetUUID().AsString(),tree.GetName(),tree.GetEntries()]
+    if os.path.isfile(fname):
+      stat = os.stat(fname)
+      signature += [stat.st_mtime,stat.st_size]
+    return tuple(signature)
+
+  @staticmethod
+  def getkey(signature, cuts, varexp, hist):
+    """Hash of input signature, cuts & weights, variable and binning of a histogram."""
+    varcut = ""
+    if isinstance(varexp,tuple):
+      varexp, varcut = varexp
+    varexp  = re.sub(r"\s*>>.*","",varexp) # strip histogram name
+    binning = [hist.ClassName(),hist.GetSumw2N()>0,hist.GetBinErrorOption()]
+    for axis in [hist.GetXaxis(),hist.GetYaxis()][:hist.GetDimension()]:
+      binning.append(tuple(axis.GetBinLowEdge(i) for i in xrange(1,axis.GetNbins()+2)))
+    string  = repr((signature,cuts,varexp,varcut,binning))
+    return md5(string).hexdigest()
+
+  @staticmethod
+  def getlistkey(signature, cuts):
+    """Hash of input signature and selection of an entry list."""
+    string  = repr((signature,'entrylist',cuts))
+    return md5(string).hexdigest()
+
+  def getfilename(self, key):
+    return os.path.join(self.cachedir,"%s.root"%(key))
+
+  def load(self, key, hist):
+    """Add cached histogram to given (empty) histogram. Return True if found."""
+    fname = self.getfilename(key)
+    if not os.path.isfile(fname):
+      self.nmisses += 1
+      return False
+    file   = TFile.Open(fname,'READ')
+    cached = file.Get('hist') if file and not file.IsZombie() else None
+    if not cached:
+      LOG.warning("HistCache.load: Could not read cached histogram from %s! Ignoring..."%(fname))
+      if file: file.Close()
+      self.nmisses += 1
+      return False
+    hist.Add(cached)
+    file.Close()
+    os.utime(fname,None) # mark as recently used
+    self.nhits += 1
+    LOG.verb("HistCache.load: Loaded %r from %s"%(hist.GetName(),fname),self.verbosity,3)
+    return True
+
+  def loadentrylist(self, key):
+    """Return cached TEntryList, or None if not found."""
+    fname = self.getfilename(key)
+    if not os.path.isfile(fname):
+      return None
+    file   = TFile.Open(fname,'READ')
+    cached = file.Get('elist') if file and not file.IsZombie() else None
+    if not cached:
+      LOG.warning("HistCache.loadentrylist: Could not read cached entry list from %s! Ignoring..."%(fname))
+      if file: file.Close()
+      return None
+    elist = cached.Clone()
+    elist.SetDirectory(0)
+    file.Close()
+    os.utime(fname,None) # mark as recently used
+    LOG.verb("HistCache.loadentrylist: Loaded entry list with %d entries from %s"%(elist.GetN(),fname),self.verbosity,3)
+    return elist
+
+  def write(self, key, obj, oname):
+    """Write object to cache file. Call evict once after storing several objects."""
+    fname = self.getfilename(key)
+    tname = "%s.%s.tmp"%(fname,os.getpid()) # write to temporary file for thread safety
+    file  = TFile(tname,'RECREATE')
+    obj.Write(oname,TObject.kOverwrite)
+    file.Close()
+    os.rename(tname,fname)
+    return fname
+
+  def store(self, key, hist):
+    """Write histogram to cache."""
+    fname = self.write(key,hist,'hist')
+    LOG.verb("HistCache.store: Stored %r in %s"%(hist.GetName(),fname),self.verbosity,3)
+
+  def storeentrylist(self, key, elist):
+    """Write entry list to cache."""
+    fname = self.write(key,elist,'elist')
+    LOG.verb("HistCache.storeentrylist: Stored entry list with %d entries in %s"%(elist.GetN(),fname),self.verbosity,3)
+
+  def evict(self):
+    """Remove least-recently-used files until total size is below maximum."""
+    files = [(os.path.getmtime(f),os.path.getsize(f),f) for f in glob.glob(os.path.join(self.cachedir,"*.root"))]
+    total = sum(s for t, s, f in files)
+    if total<=self.maxsize*1e6:
+      return
+    for mtime, size, fname in sorted(files):
+      LOG.verb("HistCache.evict: Removing %s"%(fname),self.verbosity,3)
+      try:
+        os.remove(fname)
+      except OSError: # removed by other process
+        pass
+      total -= size
+      if total<=self.maxsize*1e6: break
+
+  def clear(self):
+    """Remove all cached histograms and entry lists."""
+    for fname in glob.glob(os.path.join(self.cachedir,"*.root")):
+      os.remove(fname)
+
@@ -26,6 +26,11 @@ class MergedSample(Sample):
     self.fillcolor    = kwargs.get('color',    self.fillcolor) or sample.fillcolor
     self.linecolor    = kwargs.get('linecolor',self.linecolor) or sample.linecolor
   
+  @property
+  def filesize(self):
+    """Total size of input files of all samples."""
+    return sum(s.filesize for s in self.samples)
+  
   def __len__(self):
     """Return number of samples."""
     return len(self.samples)
@@ -109,68 +114,85 @@ class MergedSample(Sample):
   def gethist(self, *args, **kwargs):
     """Create and fill histgram for multiple samples. Overrides Sample.gethist."""
     variables, selection, issingle = unwrap_gethist_args(*args)
+    sumhists = self.getmultihist([(selection,variables)],**kwargs)[0]
+    if issingle:
+      return sumhists[0]
+    return sumhists
+  
+  def getmultihist(self, selections, **kwargs):
+    """Create and fill histograms for several selections for multiple samples.
+    Overrides Sample.getmultihist."""
     verbosity        = LOG.getverbosity(kwargs)
     name             = kwargs.get('name',           self.name+"_merged"  )
     name            += kwargs.get('tag',            ""                   )
     title            = kwargs.get('title',          self.title           )
     parallel         = kwargs.get('parallel',       False                )
+    ncores           = kwargs.get('ncores',         None                 ) # maximum number of parallel processes
+    seltags          = kwargs.get('seltags',        None                 )
     kwargs['cuts']   = joincuts(kwargs.get('cuts'), self.cuts            )
     kwargs['weight'] = joinweights(kwargs.get('weight', ""), self.weight ) # pass weight down
     kwargs['scale']  = kwargs.get('scale', 1.0) * self.scale * self.norm # pass scale down
+    selections       = [unwrap_gethist_args(v,s)[1::-1] for s, v in selections] # list of (selection, variables)
+    if not seltags:
+      seltags        = [""] if len(selections)==1 else ["sel%d"%(i+1) for i in xrange(len(selections))]
     
     # HISTOGRAMS
     allhists = [ ]
     garbage  = [ ]
-    hargs    = (variables, selection)
+    hargs    = (selections,)
     hkwargs  = kwargs.copy()
+    hkwargs['seltags'] = seltags
     if parallel and len(self.samples)>1:
       hkwargs['parallel'] = False
-      processor = MultiProcessor()
+      hkwargs['shards']   = 1 # do not split samples into entry ranges inside worker processes
+      processor = MultiProcessor(ncores=ncores)
       for sample in self.samples:
-        processor.start(sample.gethist,hargs,hkwargs,name=sample.title)        
+        processor.start(sample.getmultihist,hargs,hkwargs,name=sample.title,size=sample.filesize)
       for process in processor:
         allhists.append(process.join())
     else:
       for sample in self.samples:
         if 'name' in kwargs: # prevent memory leaks
           hkwargs['name']  = makehistname(kwargs.get('name',""),sample.name)
-        allhists.append(sample.gethist(*hargs,**hkwargs))
+        allhists.append(sample.getmultihist(*hargs,**hkwargs))
     
     # SUM
-    sumhists = [ ]
-    if any(len(subhists)<len(variables) for subhists in allhists):
-      LOG.error("MergedSample.gethist: len(subhists) = %s < %s = len(variables)"%(len(subhists),len(variables)))
-    for ivar, variable in enumerate(variables):
-      subhists = [subhists[ivar] for subhists in allhists]
-      sumhist  = None
-      for subhist in subhists:
-        if sumhist==None:
-          sumhist = subhist.Clone("%s_%s"%(variable.filename,name))
-          sumhist.SetTitle(title)
-          sumhist.SetDirectory(0)
-          sumhist.SetLineColor(self.linecolor)
-          sumhist.SetFillColor(self.fillcolor)
-          sumhist.SetMarkerColor(self.fillcolor)
-          sumhists.append(sumhist)
-        else:
-          sumhist.Add(subhist)      
-      if verbosity>=4:
-        printhist(sumhist,pre=">>>   ")
-      deletehist(subhists)
+    result = [ ]
+    for isel, (seltag, (selection, variables)) in enumerate(zip(seltags,selections)):
+      sumhists = [ ]
+      if any(len(subhists[isel])<len(variables) for subhists in allhists):
+        LOG.error("MergedSample.gethist: len(subhists) = %s < %s = len(variables)"%(len(subhists),len(variables)))
+      for ivar, variable in enumerate(variables):
+        subhists = [subhists[isel][ivar] for subhists in allhists]
+        hname    = "%s_%s_%s"%(variable.filename,name,seltag) if seltag else "%s_%s"%(variable.filename,name)
+        sumhist  = None
+        for subhist in subhists:
+          if sumhist==None:
+            sumhist = subhist.Clone(hname)
+            sumhist.SetTitle(title)
+            sumhist.SetDirectory(0)
+            sumhist.SetLineColor(self.linecolor)
+            sumhist.SetFillColor(self.fillcolor)
+            sumhist.SetMarkerColor(self.fillcolor)
+            sumhists.append(sumhist)
+          else:
+            sumhist.Add(subhist)      
+        if verbosity>=4:
+          printhist(sumhist,pre=">>>   ")
+        deletehist(subhists)
+      result.append(sumhists)
+      
+      # PRINT
+      if verbosity>=2:
+        nentries, integral = -1, -1
+        for sumhist in sumhists:
+          if sumhist.GetEntries()>nentries:
+            nentries = sumhist.GetEntries()
+            integral = sumhist.Integral()
+        print ">>>\n>>> MergedSample.gethist - %s"%(color(name,color="grey"))
+        print ">>>    entries: %d (%.2f integral)"%(nentries,integral)
     
-    # PRINT
-    if verbosity>=2:
-      nentries, integral = -1, -1
-      for sumhist in sumhists:
-        if sumhist.GetEntries()>nentries:
-          nentries = sumhist.GetEntries()
-          integral = sumhist.Integral()
-      print ">>>\n>>> MergedSample.gethist - %s"%(color(name,color="grey"))
-      print ">>>    entries: %d (%.2f integral)"%(nentries,integral)
-    
-    if issingle:
-      return sumhists[0]
-    return sumhists
+    return result
   
   def gethist2D(self, *args, **kwargs):
     """Create and fill 2D histgram for multiple samples. Overrides Sample.gethist2D."""
@@ -6,7 +6,10 @@ from TauFW.Plotter.plot.string import *
 from TauFW.Plotter.plot.utils import deletehist, printhist, round2digit
 from TauFW.Plotter.sample.SampleStyle import *
 from TauFW.Plotter.plot.MultiDraw import MultiDraw
-from ROOT import TTree
+from TauFW.Plotter.plot.NumpyDraw import NumpyDraw
+import TauFW.Plotter.plot.MultiThread as MultiThread
+from TauFW.Plotter.plot.MultiThread import MultiProcessor
+from ROOT import TTree, gDirectory
 
 
 class Sample(object):
@@ -54,6 +57,8 @@ class Sample(object):
     self.fillcolor    = kwargs.get('color',        None         ) or kBlack if self.isdata else self.setcolor() # fill color
     self.linecolor    = kwargs.get('lcolor',       kBlack       ) # line color
     self.tags         = kwargs.get('tags',         [ ]          ) # extra tags to be used for matching of search terms
+    self.nshards      = kwargs.get('shards',       1            ) # split tree into entry ranges filled in parallel
+    self.nthreads     = kwargs.get('nthreads',     1            ) # number of threads for MultiDraw
     if not isinstance(self,MergedSample):
       file = ensureTFile(self.filename) # check file
       file.Close()
@@ -124,6 +129,13 @@ class Sample(object):
       self._file = ensureTFile(self.filename)
     return self._file
   
+  @property
+  def filesize(self):
+    """Size of input file [B] to estimate processing time. Use number of events if not local."""
+    if os.path.isfile(self.filename):
+      return os.path.getsize(self.filename)
+    return max(0,self.nevents)
+  
   def get_newfile_and_tree(self):
     """Create and return a new TFile and TTree without saving to self for thread safety."""
     file = ensureTFile(self.filename,'READ')
@@ -475,9 +487,123 @@ class Sample(object):
     self.splitsamples = splitsamples # save list of split samples
     return splitsamples
   
+  def filltree(self, varexps, cuts, drawopt, hists, **kwargs):
+    """Fill histograms from a tree in one loop with the chosen backend.
+    Histograms found in the global on-disk cache (see setcache) are not refilled.
+    Large trees can be split into several entry ranges filled in parallel (shards=N).
+    With the cache, the loop only runs over a cached entry list of the selection."""
+    import TauFW.Plotter.sample.utils as GLOB
+    verbosity = LOG.getverbosity(kwargs)
+    nshards   = kwargs.get('shards',   self.nshards ) # split tree into entry ranges filled in parallel
+    minshard  = kwargs.get('minshard', 100000       ) # minimum number of entries per range
+    ncores    = kwargs.get('ncores',   None         ) # maximum number of parallel processes
+    usecache  = kwargs.get('cache',    True         ) # use on-disk cache of histograms
+    cache     = GLOB.histcache if usecache else None
+    file, tree = self.get_newfile_and_tree() # create new file and tree for thread safety
+    
+    # CACHE: only fill histograms that are not cached yet
+    if cache:
+      signature = cache.getsignature(file,tree)
+      keys      = [cache.getkey(signature,cuts,v,h) for v, h in zip(varexps,hists)]
+      missing   = [(k,v,h) for k, v, h in zip(keys,varexps,hists) if not cache.load(k,h)]
+      LOG.verb("Sample.filltree: Found %d/%d histograms of %r in cache"%(len(hists)-len(missing),len(hists),self.name),verbosity,2)
+      if not missing:
+        file.Close()
+        return hists
+      keys, varexps, fillhists = map(list,zip(*missing))
+    else:
+      fillhists = hists
+    
+    # ENTRY LIST: only loop over entries passing the selection
+    elist   = self.setentrylist(file,tree,cuts,**kwargs)
+    
+    # FILL
+    nevts   = elist.GetN() if elist else tree.GetEntries()
+    nshards = min(nshards,nevts//minshard+1)
+    if nshards>1: # split tree into entry ranges and fill in parallel
+      ranges = getentryranges(tree,nshards)
+      file.Close()
+      LOG.verb("Sample.filltree: Splitting %r into entry ranges %s"%(self.name,ranges),verbosity,2)
+      processor = MultiProcessor(ncores=min(ncores or MultiThread.nworkers,len(ranges)))
+      for first, nentries in ranges:
+        rkwargs = dict(kwargs,firstentry=first,nentries=nentries)
+        processor.start(self.fillrange,(varexps,cuts,drawopt,fillhists),rkwargs,name="%s_%d"%(self.name,first))
+      for process in processor:
+        parthists = process.join()
+        for hist, parthist in zip(fillhists,parthists):
+          hist.Add(parthist)
+        deletehist(parthists)
+    else:
+      self.drawtree(tree,varexps,cuts,drawopt,fillhists,**kwargs)
+      file.Close()
+    if cache:
+      for key, hist in zip(keys,fillhists):
+        cache.store(key,hist)
+      cache.evict() # once for all stored histograms
+    return hists
+  
+  def fillrange(self, varexps, cuts, drawopt, hists, **kwargs):
+    """Fill histograms for a range of entries (firstentry, nentries) with a new file and tree."""
+    file, tree = self.get_newfile_and_tree() # create new file and tree for thread safety
+    elist = self.setentrylist(file,tree,cuts,**kwargs) # entry range refers to entry list
+    self.drawtree(tree,varexps,cuts,drawopt,hists,**kwargs)
+    file.Close()
+    return hists
+  
+  def setentrylist(self, file, tree, cuts, **kwargs):
+    """Restrict the tree to the entries passing the selection with a TEntryList.
+    The list is created once and then loaded from the global on-disk cache (see setcache),
+    so later fills with the same selection, but different variables, only read those entries."""
+    import TauFW.Plotter.sample.utils as GLOB
+    verbosity = LOG.getverbosity(kwargs)
+    backend   = kwargs.get('backend',   None ) or GLOB.backend # 'multidraw' or 'numpy'
+    useelist  = kwargs.get('entrylist', True ) # use entry list of selection
+    usecache  = kwargs.get('cache',     True ) # use on-disk cache
+    selcuts   = kwargs.get('selcuts',   cuts ) # selection without weights
+    cache     = GLOB.histcache if usecache else None
+    if not (cache and useelist and selcuts and backend=='multidraw'):
+      return None
+    key   = cache.getlistkey(cache.getsignature(file,tree),selcuts)
+    elist = cache.loadentrylist(key)
+    if not elist:
+      lname = "elist_%s"%(key)
+      tree.Draw(">>%s"%(lname),selcuts,"entrylist goff")
+      elist = gDirectory.Get(lname)
+      elist.SetDirectory(0)
+      cache.storeentrylist(key,elist)
+    tree.SetEntryList(elist)
+    LOG.verb("Sample.setentrylist: %d/%d entries of %r pass %r"%(elist.GetN(),tree.GetEntries(),self.name,selcuts),verbosity,2)
+    return elist
+  
+  def drawtree(self, tree, varexps, cuts, drawopt, hists, **kwargs):
+    """Fill histograms in one loop over a given tree with the chosen backend."""
+    import TauFW.Plotter.sample.utils as GLOB
+    verbosity = LOG.getverbosity(kwargs)
+    backend   = kwargs.get('backend',    None          ) or GLOB.backend # 'multidraw' or 'numpy'
+    first     = kwargs.get('firstentry', 0             ) # first entry
+    nentries  = kwargs.get('nentries',   -1            ) # number of entries (-1 = all)
+    nthreads  = kwargs.get('nthreads',   self.nthreads ) # number of threads for MultiDraw
+    if backend=='numpy':
+      try:
+        return tree.NumpyDraw(varexps,cuts,drawopt,hists=hists,firstentry=first,nentries=nentries,verbosity=verbosity)
+      except (ValueError,ImportError) as error: # unsupported expression or missing package
+        LOG.warning("Sample.drawtree: Falling back to MultiDraw for %r: %s"%(self.name,error))
+    return tree.MultiDraw(varexps,cuts,drawopt,hists=hists,firstentry=first,nentries=nentries,nthreads=nthreads)
+  
   def gethist(self, *args, **kwargs):
     """Create and fill a histogram from a tree."""
     variables, selection, issingle = unwrap_gethist_args(*args)
+    hists = self.getmultihist([(selection,variables)],**kwargs)[0]
+    if issingle:
+      return hists[0]
+    return hists
+  
+  def getmultihist(self, selections, **kwargs):
+    """Create and fill histograms for several selections with one loop over the tree.
+    Selections are given as a list of (selection, variables) pairs. Returns a list
+    of histogram lists, one per selection. Each selection can have its own weight
+    by replacing parts of the weight, e.g. for systematic variations:
+      replaceweights=[None,('idweight_2','idweightUp_2'),('idweight_2','idweightDown_2')]"""
     verbosity  = LOG.getverbosity(kwargs)
     scale      = kwargs.get('scale',    1.0            ) * self.scale * self.norm
     name       = kwargs.get('name',     self.name      ) # hist name
@@ -486,9 +612,14 @@ class Sample(object):
     blind      = kwargs.get('blind',    self.isdata    ) # blind data in some given range, e.g. blind={xvar:(xmin,xmax)}
     fcolor     = kwargs.get('color',    self.fillcolor ) # fill color
     lcolor     = kwargs.get('lcolor',   self.linecolor ) # line color
-    #replaceweight = kwargs.get('replaceweight', None )
-    undoshifts = self.isdata and (any('Up' in v.name or 'Down' in v.name for v in variables)
-                                  or 'Up' in selection or 'Down' in selection)
+    seltags    = kwargs.get('seltags',  None           ) # tag for hist name per selection
+    replaceweight  = kwargs.get('replaceweight',  None         ) # replace substring of weight, e.g. (pattern,substitution)
+    replaceweights = kwargs.get('replaceweights', None         ) # replace substring of weight per selection
+    selections = [unwrap_gethist_args(v,s)[1::-1] for s, v in selections] # list of (selection, variables)
+    if not seltags:
+      seltags  = [""] if len(selections)==1 else ["sel%d"%(i+1) for i in xrange(len(selections))]
+    undoshifts = self.isdata and any(any('Up' in v.name or 'Down' in v.name for v in variables)
+                                     or 'Up' in selection or 'Down' in selection for selection, variables in selections)
     drawopt = 'E0' if self.isdata else 'HIST'
     drawopt = kwargs.get('option', drawopt ) + 'gOff'
     
@@ -497,62 +628,70 @@ class Sample(object):
       weight = joinweights(self.weight,self.extraweight,kwargs.get('weight',""))
     else:
       weight = joinweights(self.weight,self.extraweight,kwargs.get('weight',"")) #,selection.weight)
-    cuts     = joincuts(selection,self.cuts,kwargs.get('cuts',""),kwargs.get('extracuts',"")) #selection.selection
-    #if replaceweight:
-    #  if len(replaceweight)==2 and not isList(replaceweight[0]):
-    #    replaceweight = [replaceweight]
-    #  for pattern, substitution in replaceweight:
-    #    LOG.verb('Sample.gethist: replacing weight: before %r'%weight,verbosity,3)
-    #    weight = re.sub(pattern,substitution,weight)
-    #    weight = weight.replace("**","*").strip('*')
-    #    LOG.verb('Sample.gethist: replacing weight: after  %r'%weight,verbosity,3)
-    cuts = joincuts(cuts,weight=weight)
+    if replaceweight:
+      LOG.verb('Sample.getmultihist: replacing weight: before %r'%weight,verbosity,3)
+      weight = subweight(weight,replaceweight)
+      LOG.verb('Sample.getmultihist: replacing weight: after  %r'%weight,verbosity,3)
+    selweights = [weight]*len(selections) # weight per selection
+    if replaceweights and not self.isdata:
+      selweights = [subweight(weight,r) for r in replaceweights]
+    multisel = len(set(s for s, v in selections))>1 # apply selection per histogram
+    multiwgt = len(set(selweights))>1 # apply weight per histogram
+    if not multisel: # apply selection to all histograms
+      selcuts = joincuts(selections[0][0],self.cuts,kwargs.get('cuts',""),kwargs.get('extracuts',"")) #selection.selection
+    else: # apply each selection per histogram; skip events that pass none
+      anycut  = " || ".join("(%s)"%s for s, v in selections) if all(s for s, v in selections) else ""
+      selcuts = joincuts(anycut,self.cuts,kwargs.get('cuts',""),kwargs.get('extracuts',""))
+    cuts = (selcuts or "1") if multiwgt else joincuts(selcuts,weight=weight)
     
     # PREPARE HISTOGRAMS
     hists   = [ ]
     varexps = [ ]
-    for variable in variables:
-      
-      # VAREXP
-      hname  = makehistname(variable.filename,name)
-      varcut = ""
-      if self.isdata and (blind or variable.blindcuts or variable.cut or variable.dataweight):
-        blindcuts = ""
-        if blind:
-          if isinstance(blind,tuple) and len(blind)==2:
-            blindcuts = variable.blind(*blind)
-          elif variable.name_ in self.blinddict:
-            blindcuts = variable.blind(*self.blinddict[variable.name_])
-          elif variable.blindcuts:
-            blindcuts = variable.blindcuts
-        varcut = joincuts(blindcuts,variable.cut,weight=variable.dataweight)
-      elif not self.isdata and (variable.cut or variable.weight):
-        varcut = joincuts(variable.cut,weight=variable.weight)
-      if varcut:
-        varexp = (variable.drawcmd(hname),varcut)
-      else:
+    for seltag, (selection, variables), selweight in zip(seltags,selections,selweights):
+      for variable in variables:
+        
+        # VAREXP
+        hname  = makehistname(variable.filename,name,seltag) if seltag else makehistname(variable.filename,name)
+        varcut = ""
+        if self.isdata and (blind or variable.blindcuts or variable.cut or variable.dataweight):
+          blindcuts = ""
+          if blind:
+            if isinstance(blind,tuple) and len(blind)==2:
+              blindcuts = variable.blind(*blind)
+            elif variable.name_ in self.blinddict:
+              blindcuts = variable.blind(*self.blinddict[variable.name_])
+            elif variable.blindcuts:
+              blindcuts = variable.blindcuts
+          varcut = joincuts(blindcuts,variable.cut,weight=variable.dataweight)
+        elif not self.isdata and (variable.cut or variable.weight):
+          varcut = joincuts(variable.cut,weight=variable.weight)
+        if multiwgt:
+          varcut = joincuts(varcut,weight=selweight)
+        if multisel:
+          varcut = joincuts(selection,weight=varcut)
         varexp = variable.drawcmd(hname)
-      if undoshifts:
-        varexp = undoshift(varexp)
-      varexps.append(varexp)
-      
-      # HISTOGRAM
-      hist = variable.gethist(hname,title,sumw2=(not self.isdata),poisson=self.isdata)
-      hist.SetDirectory(0)
-      hists.append(hist)
+        if undoshifts:
+          varexp = undoshift(varexp)
+          varcut = undoshift(varcut)
+        if varcut:
+          varexp = (varexp,varcut)
+        varexps.append(varexp)
+        
+        # HISTOGRAM
+        hist = variable.gethist(hname,title,sumw2=(not self.isdata),poisson=self.isdata)
+        hist.SetDirectory(0)
+        hists.append(hist)
     
     # FILL HISTOGRAMS
     if varexps:
-      file, tree = self.get_newfile_and_tree() # create new file and tree for thread safety
-      out = tree.MultiDraw(varexps,cuts,drawopt,hists=hists)
-      file.Close()
-      LOG.insist(len(variables)==len(varexps)==len(hists),
-                 "Number of variables (%d), variable expressions (%d) and histograms (%d) must be equal!"%(len(variables),len(varexps),len(hists)))
+      self.filltree(varexps,cuts,drawopt,hists,selcuts=selcuts,**kwargs)
+      LOG.insist(len(varexps)==len(hists),
+                 "Number of variable expressions (%d) and histograms (%d) must be equal!"%(len(varexps),len(hists)))
     
     # FINISH
     nentries = 0
     integral = 0
-    for variable, hist in zip(variables,hists):
+    for hist in hists:
       if scale!=1.0:   hist.Scale(scale)
       if scale==0.0:   LOG.warning("Scale of %s is 0!"%self.name)
       hist.SetLineColor(lcolor)
@@ -569,16 +708,17 @@ class Sample(object):
       print ">>>   scale: %.6g (scale=%.6g, norm=%.6g)"%(scale,self.scale,self.norm)
       print ">>>   %r"%(cuts)
       if verbosity>=4:
-        for var, varexp, hist in zip(variables,varexps,hists):
-          print '>>>   Variable %r: varexp=%r, entries=%d, integral=%d'%(var.name,varexp,hist.GetEntries(),hist.Integral())
-          #print '>>>   Variable %r: cut=%r, weight=%r, varexp=%r'%(var.name,var.cut,var.weight,varexp)
+        for varexp, hist in zip(varexps,hists):
+          print '>>>   Histogram %r: varexp=%r, entries=%d, integral=%d'%(hist.GetName(),varexp,hist.GetEntries(),hist.Integral())
           if verbosity>=5:
             printhist(hist,pre=">>>   ")
-      
     
-    if issingle:
-      return hists[0]
-    return hists
+    # SPLIT per selection
+    result = [ ]
+    for selection, variables in selections:
+      result.append(hists[:len(variables)])
+      hists = hists[len(variables):]
+    return result
   
   def gethist2D(self, *args, **kwargs):
     """Create and fill a 2D histogram from a tree."""
@@ -596,7 +736,8 @@ class Sample(object):
       weight  = joinweights(self.weight,self.extraweight,kwargs.get('weight',""))
     else:
       weight  = joinweights(self.weight,self.extraweight,kwargs.get('weight',""),selection) #.weight
-    cuts      = joincuts(selection,self.cuts,kwargs.get('cuts',""),kwargs.get('extracuts',""),weight=weight) #.selection
+    selcuts   = joincuts(selection,self.cuts,kwargs.get('cuts',""),kwargs.get('extracuts',"")) #.selection
+    cuts      = joincuts(selcuts,weight=weight)
     
     # PREPARE
     hists     = [ ]
@@ -623,9 +764,7 @@ class Sample(object):
       hist.SetOption(drawopt)
     
     # DRAW
-    file, tree = self.get_newfile_and_tree() # create new file and tree for thread safety
-    out = tree.MultiDraw(varexps,cuts,drawopt,hists=hists)
-    file.Close()
+    self.filltree(varexps,cuts,drawopt,hists,selcuts=selcuts,**kwargs)
     LOG.insist(len(variables)==len(varexps)==len(hists),
                "Number of variables (%d), variable expressions (%d) and histograms (%d) must be equal!"%(len(variables),len(varexps),len(hists)))
     
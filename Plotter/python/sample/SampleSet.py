@@ -330,9 +330,19 @@ class SampleSet(object):
   
   def gethists(self, *args, **kwargs):
     """Create and fill histograms for all samples and return lists of histograms."""
-    verbosity     = LOG.getverbosity(kwargs)
     variables, selection, issingle = unwrap_gethist_args(*args)
-    datavars      = filter(lambda v: v.data,variables)      # filter out gen-level variables
+    result = self.getmultihists([(selection,variables)],**kwargs)[0]
+    if issingle:
+      result.setsingle()
+      return result
+    return result
+  
+  def getmultihists(self, selections, **kwargs):
+    """Create and fill histograms for several selections with one loop over each tree.
+    Selections are given as a list of (selection, variables) pairs.
+    Returns one HistSet per selection."""
+    verbosity     = LOG.getverbosity(kwargs)
+    selections    = [unwrap_gethist_args(v,s)[1::-1] for s, v in selections] # list of (selection, variables)
     dodata        = kwargs.get('data',          True    ) # create data hists
     domc          = kwargs.get('mc',            True    ) # create expected (SM background) hists
     doexp         = kwargs.get('exp',           domc    ) # create expected (SM background) hists
@@ -340,11 +350,14 @@ class SampleSet(object):
     weight        = kwargs.get('weight',        ""      ) # extra weight (for MC only)
     dataweight    = kwargs.get('dataweight',    ""      ) # extra weight for data
     replaceweight = kwargs.get('replaceweight', None    ) # replace substring of weight
+    replaceweights= kwargs.get('replaceweights',None    ) # replace substring of weight per selection
     split         = kwargs.get('split',         True    ) # split samples into components
     blind         = kwargs.get('blind',         True    ) # blind data in some given range: blind={xvar:(xmin,xmax)}
     scaleup       = kwargs.get('scaleup',       0.0     ) # scale up histograms
     reset         = kwargs.get('reset',         False   ) # reset scales
     parallel      = kwargs.get('parallel',      False   ) # create and fill hists in parallel
+    ncores        = kwargs.get('ncores',        None    ) # maximum number of parallel processes (default: all cores)
+    backend       = kwargs.get('backend',       None    ) # backend to fill hists: 'multidraw' or 'numpy' (default: GLOB.backend)
     tag           = kwargs.get('tag',           ""      )
     method        = kwargs.get('method',        None    ) # data-driven method; 'QCD_OSSS', 'QCD_ABCD', 'JTF', 'FakeFactor', ...
     imethod       = kwargs.get('imethod',       -1      ) # position on list; -1 = last (bottom of stack)
@@ -360,6 +373,7 @@ class SampleSet(object):
     sysvars       = kwargs.get('sysvars',       { }     ) # list or dict to be filled up with systematic variations
     addsys        = kwargs.get('addsys',        True    )
     task          = kwargs.get('task',          "Creating histograms" ) # task title for loading bar
+    seltags       = kwargs.get('seltags',       None    ) # tag for hist name per selection
     #saveto        = kwargs.get('saveto',        ""     ) # save to TFile
     #file          = createFile(saveto,text=cuts) if saveto else None
     vetoes        = ensurelist(vetoes)
@@ -387,19 +401,23 @@ class SampleSet(object):
     #  samples = [s for s in samples if not ((not keepWJ and s.match('WJ',"W*J","W*j")) or "gen_match_2==6" in s.cuts or "genPartFlav_2==0" in s.cuts)]
     
     # INPUT / OUTPUT
-    mcargs     = (variables,selection)
-    dataargs   = (datavars, selection)
-    expkwargs  = { 'tag':tag, 'weight': weight, 'replaceweight': replaceweight, 'verbosity': verbosity, } #'nojtf': nojtf 
-    sigkwargs  = { 'tag':tag, 'weight': weight, 'replaceweight': replaceweight, 'verbosity': verbosity, 'scaleup': scaleup }
-    datakwargs = { 'tag':tag, 'weight': dataweight, 'verbosity': verbosity, 'blind': blind, 'parallel': parallel }
-    result     = HistSet(variables,dodata,doexp,dosignal) # container for dictionaries of histogram (list): data, exp, signal
+    if not seltags:
+      seltags  = [""] if len(selections)==1 else ["sel%d"%(i+1) for i in xrange(len(selections))]
+    datasels   = [(s,filter(lambda v: v.data,vs)) for s, vs in selections] # filter out gen-level variables
+    mcargs     = (selections,)
+    dataargs   = (datasels,)
+    expkwargs  = { 'tag':tag, 'weight': weight, 'replaceweight': replaceweight, 'replaceweights': replaceweights, 'verbosity': verbosity, 'backend': backend, 'seltags': seltags, } #'nojtf': nojtf 
+    sigkwargs  = { 'tag':tag, 'weight': weight, 'replaceweight': replaceweight, 'replaceweights': replaceweights, 'verbosity': verbosity, 'backend': backend, 'seltags': seltags, 'scaleup': scaleup }
+    datakwargs = { 'tag':tag, 'weight': dataweight, 'verbosity': verbosity, 'blind': blind, 'parallel': parallel, 'ncores': ncores, 'backend': backend, 'seltags': seltags }
+    results    = [HistSet(vs,dodata,doexp,dosignal) for s, vs in selections] # containers for dictionaries of histogram (list): data, exp, signal
     
     # PRINT
     bar = None
     if verbosity>=2:
       if not ('QCD' in task or 'JFR' in task):
-        LOG.header("Creating histograms for %s"%selection) #.title
-      print ">>> variables: '%s'"%("', '".join(v.filename for v in variables))
+        for selection, variables in selections:
+          LOG.header("Creating histograms for %s"%selection) #.title
+          print ">>> variables: '%s'"%("', '".join(v.filename for v in variables))
       #print ">>> split=%s, makeQCD=%s, makeJTF=%s, nojtf=%s, keepWJ=%s"%(split,makeQCD,makeJTF,nojtf,keepWJ)
       print '>>>   with extra weights "%s" for MC and "%s" for data'%(weight,dataweight)
     elif self.loadingbar and verbosity<=1:
@@ -407,27 +425,30 @@ class SampleSet(object):
     
     # GET HISTOGRAMS (PARALLEL)
     if parallel:
-      expproc  = MultiProcessor()
-      sigproc  = MultiProcessor()
-      dataproc = MultiProcessor()
+      for skwargs in [expkwargs,sigkwargs,datakwargs]:
+        skwargs['shards'] = 1 # do not split samples into entry ranges inside worker processes
+      expproc  = MultiProcessor(ncores=ncores)
+      sigproc  = MultiProcessor(ncores=ncores)
+      dataproc = MultiProcessor(ncores=ncores)
       for sample in samples:
         if reset: sample.resetscale()
         if sample.name in self.ignore: continue
         if dosignal and sample.issignal: # SIGNAL
-          sigproc.start(sample.gethist,mcargs,sigkwargs,name=sample.title)
+          sigproc.start(sample.getmultihist,mcargs,sigkwargs,name=sample.title,size=sample.filesize)
         elif doexp and sample.isexp:     # EXPECTED (SM BACKGROUND)
-          expproc.start(sample.gethist,mcargs,expkwargs,name=sample.title)
+          expproc.start(sample.getmultihist,mcargs,expkwargs,name=sample.title,size=sample.filesize)
         elif dodata and sample.isdata:   # DATA
-          dataproc.start(sample.gethist,dataargs,datakwargs,name=sample.title)
-      for dtype, processor, varset in [('exp',expproc,variables),('sig',sigproc,variables),('data',dataproc,datavars)]:
+          dataproc.start(sample.getmultihist,dataargs,datakwargs,name=sample.title,size=sample.filesize)
+      for dtype, processor, sels in [('exp',expproc,selections),('signal',sigproc,selections),('data',dataproc,datasels)]:
         for process in processor:
           if bar: bar.message(process.name)
           newhists = process.join()
-          for var, hist in zip(varset,newhists): # assume match variables -> histograms
-            if dtype=='data':
-              getattr(result,dtype)[var] = hist
-            else:
-              getattr(result,dtype)[var].append(hist)
+          for result, (selection, varset), hists in zip(results,sels,newhists):
+            for var, hist in zip(varset,hists): # assume match variables -> histograms
+              if dtype=='data':
+                getattr(result,dtype)[var] = hist
+              else:
+                getattr(result,dtype)[var].append(hist)
           if bar: bar.count("%s done"%process.name)
     
     # GET HISTOGRAMS (SEQUENTIAL)
@@ -439,25 +460,32 @@ class SampleSet(object):
           if bar: bar.count("%s skipped"%sample.title)
           continue
         if dosignal and sample.issignal: # SIGNAL
-          hists = sample.gethist(*mcargs,**sigkwargs)
-          for var, hist in zip(variables,hists):
-            result.signal[var].append(hist)
+          allhists = sample.getmultihist(*mcargs,**sigkwargs)
+          for result, (selection, variables), hists in zip(results,selections,allhists):
+            for var, hist in zip(variables,hists):
+              result.signal[var].append(hist)
         elif doexp and sample.isexp:     # EXPECTED (SM BACKGROUND)
-          hists = sample.gethist(*mcargs,**expkwargs)
-          for var, hist in zip(variables,hists):
-            result.exp[var].append(hist)
+          allhists = sample.getmultihist(*mcargs,**expkwargs)
+          for result, (selection, variables), hists in zip(results,selections,allhists):
+            for var, hist in zip(variables,hists):
+              result.exp[var].append(hist)
         elif dodata and sample.isdata:   # DATA
-          hists = sample.gethist(*mcargs,**datakwargs)
-          for var, hist in zip(datavars,hists):
-            result.data[var] = hist
+          allhists = sample.getmultihist(*dataargs,**datakwargs)
+          for result, (selection, datavars), hists in zip(results,datasels,allhists):
+            for var, hist in zip(datavars,hists):
+              result.data[var] = hist
         if bar: bar.count("%s done"%sample.title)
     
     # EXTRA METHODS
     if method:
-      hists = getattr(self,method)(*dataargs,**kwargs)
-      for var, hist in zip(datavars,hists):
-        idx = imethod if imethod>=0 else len(result.exp[var])+1+imethod
-        result.exp[var].insert(idx,hist)
+      for isel, (result, (selection, datavars)) in enumerate(zip(results,datasels)):
+        mkwargs = kwargs
+        if replaceweights and replaceweights[isel]: # weight variation of this selection
+          mkwargs = dict(kwargs,replaceweight=replaceweights[isel],tag=tag+"_"+seltags[isel])
+        hists = getattr(self,method)(datavars,selection,**mkwargs)
+        for var, hist in zip(datavars,hists):
+          idx = imethod if imethod>=0 else len(result.exp[var])+1+imethod
+          result.exp[var].insert(idx,hist)
     
     ## ADD QCD
     #if makeJTF:
@@ -479,29 +507,63 @@ class SampleSet(object):
     #  file.Close()
     
     # YIELDS
-    if verbosity>=2 and len(variables)>0:
-      var = variables[0]
-      print ">>> selection:"
-      print ">>>  '%s'"%(selection) #.selection
-      print ">>> yields: "
-      TAB = LOG.table("%11.1f %11.2f    %r")
-      TAB.printheader("entries","integral","hist name")
-      totint = 0
-      totent = 0
-      if dodata:
-        TAB.printrow(result.data[var].Integral(),result.data[var].GetEntries(),result.data[var].GetName())
-      for hist in result.exp[var]:
-        totint += hist.Integral()
-        totent += hist.GetEntries()
-        TAB.printrow(hist.Integral(),hist.GetEntries(),hist.GetName())
-      TAB.printrow(totint,totent,"total exp.")
-      if dosignal:
-        for hist in result.signal[var]:
+    for result, (selection, variables) in zip(results,selections):
+      if verbosity>=2 and len(variables)>0:
+        var = variables[0]
+        print ">>> selection:"
+        print ">>>  '%s'"%(selection) #.selection
+        print ">>> yields: "
+        TAB = LOG.table("%11.1f %11.2f    %r")
+        TAB.printheader("entries","integral","hist name")
+        totint = 0
+        totent = 0
+        if dodata:
+          TAB.printrow(result.data[var].Integral(),result.data[var].GetEntries(),result.data[var].GetName())
+        for hist in result.exp[var]:
+          totint += hist.Integral()
+          totent += hist.GetEntries()
           TAB.printrow(hist.Integral(),hist.GetEntries(),hist.GetName())
+        TAB.printrow(totint,totent,"total exp.")
+        if dosignal:
+          for hist in result.signal[var]:
+            TAB.printrow(hist.Integral(),hist.GetEntries(),hist.GetName())
     
-    if issingle:
-      result.setsingle()
-      return result
+    return results
+  
+  def getvariations(self, variables, selection, weightvars=[ ], filevars=[ ], **kwargs):
+    """Create and fill histograms for the nominal and systematic variations.
+    Weight variations are filled in the same loop over each tree as the nominal,
+    given as a list of (name, oldweight, upweight, downweight), e.g.
+      ('id', 'idweight_2', 'idweightUp_2', 'idweightDown_2')
+    File variations need their own trees (see SampleSet.shift), and are given as a
+    list of (name, upfile_app, downfile_app) or (name, searchterms, upfile_app, downfile_app), e.g.
+      ('tes', ['ZTT','TTT'], '_TESUp', '_TESDown')
+    Returns a dictionary of HistSets: { 'nominal': nominal, name: (up, down), ... }."""
+    verbosity      = LOG.getverbosity(kwargs)
+    variables, selection, issingle = unwrap_gethist_args(variables,selection)
+    selections     = [(selection,variables)]
+    seltags        = [""]
+    replaceweights = [None]
+    for name, oldweight, upweight, downweight in weightvars:
+      for vary, newweight in [('Up',upweight),('Down',downweight)]:
+        selections.append((selection,variables))
+        seltags.append(name+vary)
+        replaceweights.append((oldweight,newweight))
+    LOG.verb("SampleSet.getvariations: Filling %d weight variations in one loop over each tree"%(len(selections)-1),verbosity,1)
+    results = self.getmultihists(selections,**dict(kwargs,seltags=seltags,replaceweights=replaceweights))
+    result  = { 'nominal': results[0] }
+    for i, (name, oldweight, upweight, downweight) in enumerate(weightvars):
+      result[name] = (results[2*i+1],results[2*i+2])
+    for filevar in filevars:
+      name, searchterms, upapp, downapp = filevar if len(filevar)==4 else (filevar[0],'*')+tuple(filevar[1:])
+      hists = [ ]
+      for vary, fileapp in [('Up',upapp),('Down',downapp)]:
+        LOG.verb("SampleSet.getvariations: Filling file variation %r for %s"%(fileapp,searchterms),verbosity,1)
+        newset = self.shift(searchterms,fileapp," "+name+vary,filter=False,share=True)
+        tag    = kwargs.get('tag',"")+"_"+name+vary
+        hists.append(newset.gethists(variables,selection,**dict(kwargs,tag=tag,data=False)))
+        newset.close(shared=True)
+      result[name] = tuple(hists)
     return result
   
   def gethists2D(self, *args, **kwargs):
@@ -514,6 +576,7 @@ class SampleSet(object):
     dosignal   = kwargs.get('signal',     domc and self.sigsamples ) # create signal hists (for new physics searches)
     weight     = kwargs.get('weight',     ""       ) # extra weight (for MC only)
     dataweight = kwargs.get('dataweight', ""       ) # extra weight for data
+    backend    = kwargs.get('backend',    None     ) # backend to fill hists: 'multidraw' or 'numpy'
     tag        = kwargs.get('tag',        ""       )
     #makeJTF    = kwargs.get('JFR',        False    )
     #nojtf      = kwargs.get('nojtf',      makeJTF  )
@@ -522,9 +585,9 @@ class SampleSet(object):
     
     # INPUT / OUTPUT
     args       = (variables,selection)
-    expkwargs  = { 'tag':tag, 'weight': weight, 'verbosity': verbosity } #, 'nojtf': nojtf
-    sigkwargs  = { 'tag':tag, 'weight': weight, 'verbosity': verbosity }
-    datakwargs = { 'tag':tag, 'weight': dataweight, 'verbosity': verbosity }
+    expkwargs  = { 'tag':tag, 'weight': weight, 'verbosity': verbosity, 'backend': backend } #, 'nojtf': nojtf
+    sigkwargs  = { 'tag':tag, 'weight': weight, 'verbosity': verbosity, 'backend': backend }
+    datakwargs = { 'tag':tag, 'weight': dataweight, 'verbosity': verbosity, 'backend': backend }
     result     = HistSet(variables,dodata,doexp,dosignal)
     
     # FILTER
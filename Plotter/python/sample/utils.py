@@ -5,6 +5,7 @@ from TauFW.common.tools.utils import isnumber, islist, ensurelist, unwraplistarg
 from TauFW.common.tools.file import ensuredir, ensureTFile, ensuremodule
 from TauFW.common.tools.log import Logger, color
 from TauFW.Plotter.plot.Variable import Variable, Var, ensurevar
+from TauFW.Plotter.sample.HistCache import HistCache
 import TauFW.Plotter.plot.CMSStyle as CMSStyle
 import ROOT; ROOT.PyConfig.IgnoreCommandLineOptions = True
 from ROOT import gDirectory, gROOT, TH1, THStack, kDotted, kBlack, kWhite
@@ -13,6 +14,8 @@ LOG  = Logger('Sample')
 era  = None # data period: 2016, 2017, 2018, ...
 lumi = -1   # integrated luminosity [fb-1]
 cme  = 13   # center-of-mass energy [TeV]
+backend = 'multidraw' # backend to fill histograms: 'multidraw' (TTreeFormula per event) or 'numpy' (columnar)
+histcache = None      # on-disk cache of filled histograms, see setcache
 lumi_dict      = {
   '7':      5.1,    '2016': 35.9,
   '8':      19.7,   '2017': 41.5,
@@ -117,6 +120,56 @@ def setera(era_,lumi_=None,**kwargs):
   return lumi
   
 
+def setbackend(backend_,**kwargs):
+  """Set global backend to fill histograms from trees: 'multidraw' or 'numpy'."""
+  global backend
+  backend_ = backend_.lower()
+  if backend_ not in ['multidraw','numpy']:
+    LOG.throw(IOError,"setbackend: Did not recognize backend %r! Choose from 'multidraw' or 'numpy'."%(backend_))
+  backend = backend_
+  LOG.verb("setbackend: backend = %r"%(backend),kwargs,2)
+  return backend
+  
+
+def setcache(cachedir="$HOME/.cache/TauFW/hists",maxsize=2000,**kwargs):
+  """Set global on-disk cache of filled histograms with maximum size [MB].
+  Pass cachedir=None to disable."""
+  global histcache
+  if cachedir:
+    histcache = HistCache(cachedir,maxsize=maxsize,**kwargs)
+  else:
+    histcache = None
+  LOG.verb("setcache: histcache = %r"%(histcache),kwargs,2)
+  return histcache
+  
+
+def getentryranges(tree,nranges):
+  """Split a tree into a number of entry ranges of similar size, aligned with the
+  tree's clusters to avoid reading the same baskets in several processes.
+  If the tree has an entry list, the ranges refer to the entries in the list.
+  Returns a list of (firstentry, nentries) tuples."""
+  elist    = tree.GetEntryList()
+  nentries = elist.GetN() if elist else tree.GetEntries()
+  nranges  = max(1,min(nranges,nentries))
+  clusters = [ ] # first entries of clusters
+  if not elist:
+    iterator = tree.GetClusterIterator(0)
+    start    = iterator.Next()
+    while start<nentries:
+      clusters.append(start)
+      start  = iterator.Next()
+  bounds   = [0]
+  for i in xrange(1,nranges): # find cluster boundary closest to ideal boundary
+    ideal  = i*nentries//nranges
+    bound  = min(clusters,key=lambda c: abs(c-ideal)) if clusters else ideal
+    if bound>bounds[-1]:
+      bounds.append(bound)
+  bounds.append(nentries)
+  ranges   = [(a,b-a) for a, b in zip(bounds[:-1],bounds[1:]) if b>a]
+  LOG.verb("getentryranges: %d entries, %d clusters -> ranges %s"%(nentries,len(clusters),ranges),level=3)
+  return ranges
+  
+
 def unwrap_MergedSamples_args(*args,**kwargs):
   """
   Help function to unwrap arguments for MergedSamples initialization:
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# Description: Compare vectorized Formula evaluation on numpy arrays to ROOT's TTreeFormula
+from time import time
+import numpy as np
+from ROOT import TTreeFormula
+from TauFW.common.tools.file import ensuredir
+from TauFW.Plotter.plot.Formula import getformula
+from TauFW.Plotter.plot.NumpyDraw import iterarrays
+from pseudoSamples import makesamples
+
+
+def compare(tree,strings,nmax=10000):
+  """Evaluate formulas with TTreeFormula and Formula, and compare the results."""
+  print ">>> compare: Comparing Formula to TTreeFormula for %d events..."%(nmax)
+  print ">>>   \033[4m  %-60s %10s %10s %8s\033[0m"%("formula","TTF [s]","numpy [s]","match")
+  for string in strings:
+    formula = getformula(string)
+    arrays  = iterarrays(tree,formula.branches or ['pt_1'],chunksize=nmax,stop=nmax).next()
+    columns = { b: np.asarray(a,dtype=np.float64) for b, a in arrays.iteritems() }
+    start   = time()
+    values  = np.asarray(formula.evaluate(columns),dtype=np.float64)*np.ones(nmax)
+    dtime2  = time()-start
+    start   = time()
+    ttf     = TTreeFormula('ttf',string,tree)
+    results = np.zeros(nmax)
+    for i in xrange(nmax):
+      tree.GetEntry(i)
+      results[i] = ttf.EvalInstance()
+    dtime1  = time()-start
+    match   = np.allclose(values,results)
+    print ">>>     %-60r %10.4f %10.4f %8s"%(string,dtime1,dtime2,match)
+
+
+def main():
+  sample     = 'ZTT'
+  outdir     = ensuredir('plots')
+  filedict   = makesamples(100000,sample=sample,outdir=outdir)
+  file, tree = filedict[sample]
+  strings = [
+    "pt_1>30 && pt_2>30 && abs(eta_1)<2.4 && abs(eta_2)<2.4",
+    "(NUP==1?0.53:1)*(NUP==2?0.2:NUP==3?0.1:1)*weight",
+    "(m_vis<60 || 120<m_vis)",
+    "min(eta_1,eta_2)+max(pt_1,pt_2)/2",
+    "(genmatch&4)>0 && !(njets>=2)",
+    "sqrt(pt_1^2+pt_2^2)-TMath::Abs(-eta_1)",
+  ]
+  compare(tree,strings)
+  file.Close()
+
+
+if __name__ == '__main__':
+  main()
+  print ">>> Done!"
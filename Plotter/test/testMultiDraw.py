@@ -11,6 +11,7 @@ from TauFW.common.tools.file import ensuredir
 from ROOT import gROOT, gSystem, gDirectory, TFile, TTree, TH1D, TH2D, gRandom, TColor
 from TauFW.Plotter.plot.utils import LOG
 from TauFW.Plotter.plot.MultiDraw import MultiDraw
+from TauFW.Plotter.plot.NumpyDraw import NumpyDraw
 #from test.pseudoSamples import makesamples
 from pseudoSamples import makesamples
 
@@ -108,6 +109,40 @@ def multidraw(tree,variables,selections,predefine=False,outdir='plots'):
   return dtime
   
 
+def numpydraw(tree,variables,selections,outdir='plots'):
+  """Fill histograms from tree in chunks of numpy arrays with NumpyDraw."""
+  start = time()
+  fname = "%s/testMultiDraw.root"%(outdir)
+  file  = TFile(fname,'RECREATE')
+  print ">>> numpydraw: Filling histograms with NumpyDraw for %s..."%(fname)
+  for i, (selection, weight) in enumerate(selections):
+    cut = "(%s)*%s"%(selection,weight)
+    print ">>>   cut=%r"%(cut)
+    hists   = [ ]
+    varexps = [ ]
+    for variable in variables:
+      varname = variable[0]
+      binning = variable[1:]
+      hname   = varname.replace('+','_').replace('(','').replace(')','')
+      if len(binning)==1: # variable binning
+        hname  += "_var"
+        binning = (len(binning[0])-1,array('d',list(binning[0])))
+      hname   = "%s_sel%d_numpy"%(hname,i+1)
+      hist    = TH1D(hname,hname,*binning) # NumpyDraw needs predefined histograms
+      varexps.append("%s >> %s"%(varname,hname))
+      hists.append(hist)
+    results = tree.NumpyDraw(varexps,cut,hists=hists)
+    assert len(varexps)==len(results), "Mismatch between histograms (%s) and draw commands (%s)!"%(results,varexps)
+    print ">>>   \033[4m  %-18s %10s %12s %10s %12s   %s\033[0m"%("varname","mean","std. dev.","entries","integral","draw command"+' '*16)
+    for variable, dcmd, hist in zip(variables,varexps,results):
+      print ">>>     %-18r %10.2f %12.2f %10d %12.1f   %r"%(variable[0],hist.GetMean(),hist.GetStdDev(),hist.GetEntries(),hist.Integral(),dcmd)
+      hist.Write(hist.GetName(),TH1D.kOverwrite)
+  file.Close()
+  dtime = time()-start
+  print ">>>   Took %.2fs"%(dtime)
+  return dtime
+  
+
 def multidraw2D(tree,variables,selections,predefine=False,outdir='plots'):
   """Fill 2D histograms from tree in parallel with MultiDraw."""
   start = time()
@@ -182,8 +217,10 @@ def main():
   dtime1 = singledraw(tree,variables,selections,outdir=outdir,predefine=predefine)
   dtime2 = multidraw(tree,variables,selections,outdir=outdir,predefine=predefine)
   dtime3 = multidraw2D(tree,variables2D,selections,outdir=outdir,predefine=predefine)
+  dtime4 = numpydraw(tree,variables,selections,outdir=outdir)
   file.Close()
   print ">>> Result: MultiDraw is %.2f times faster than TTree::Draw for %s events and %s variables!"%(dtime1/dtime2,nevts,len(variables))
+  print ">>> Result: NumpyDraw is %.2f times faster than TTree::Draw for %s events and %s variables!"%(dtime1/dtime4,nevts,len(variables))
   
 
 if __name__ == '__main__':
@@ -129,7 +129,22 @@ def testSampleSet(datasample,expsamples,tag=""):
     else:
       result = samples.gethists(variables,selection)
     result.printall()
+
+  # GET HISTS for all selections in one loop per tree
+  results = samples.getmultihists([(s,variables) for s, w in selections])
+  for result in results:
+    result.printall()
   
+  # GET HISTS for nominal and weight variations in one loop per tree
+  weightvars = [('w','weight','1.1*weight','0.9*weight')]
+  for selection, weight in selections:
+    result = samples.getvariations(variables,selection,weightvars,weight=weight)
+    result['nominal'].printall()
+    for name, (uphists, downhists) in result.iteritems():
+      if name=='nominal': continue
+      uphists.printall()
+      downhists.printall()
+
   # PLOT
   outdir = ensuredir("plots")
   fname  = "%s/testSamplesSet_$VAR%s.png"%(outdir,tag)